@@ -80,7 +80,10 @@ function WIService() {
 		}
 	}
 
-	function get(done, fail, bc, url, failMsg, param1, param) {
+	// with revalidate, the browser may keep the response: the server sends
+	// it with an ETag and "Cache-Control: no-cache", so it is revalidated
+	// every time and answered with 304 while the inventory is unchanged
+	function get(done, fail, bc, url, failMsg, param1, param, revalidate) {
 		if (bc) increaseBusyCount()
 
 		// allow giving parameters separately or as a single object
@@ -93,7 +96,7 @@ function WIService() {
 		}
 
 		// avoid caching
-		param._ = $.now()
+		if (!revalidate) param._ = $.now()
 
 		var f = failFn(fail, bc, failMsg)
 		return $.get(url, param, doneFn(done, bc, f)).fail(f)
@@ -166,7 +169,7 @@ function WIService() {
 			var param = { start: start, end: end, networktype: networktype }
 			var url = configurationProxy.serviceRoot() + 'metadata/networks'
 			var failMsg = "Failed to get networks"
-			return get(done, fail, bc, url, failMsg, start, param)
+			return get(done, fail, bc, url, failMsg, start, param, true)
 		},
 
 		stations: function(done, fail, bc, start, end, networktype, network) {
@@ -174,7 +177,7 @@ function WIService() {
 				network: network }
 			var url = configurationProxy.serviceRoot() + 'metadata/stations'
 			var failMsg = "Failed to get stations"
-			return get(done, fail, bc, url, failMsg, start, param)
+			return get(done, fail, bc, url, failMsg, start, param, true)
 		},
 
 		streams: function(done, fail, bc, start, end, networktype, network, station) {
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# How much memory does the InventoryCache need?
+#
+# Compares the columnar tables of the InventoryCache with the lists of
+# lists (one list per row, datetime objects) used before.
+#
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import time
+import resource
+
+sys.path.append(os.path.join('..', 'wsgi'))  # for wsgicomm
+sys.path.append(os.path.join('..', 'wsgi', 'modules'))
+
+import inventorycache
+import invtables
+
+
+def deep_size(obj, seen=None):
+    """Size in bytes of obj and everything reachable from it.
+
+    Objects reachable through more than one path are counted once.
+
+    """
+
+    if seen is None:
+        seen = set()
+
+    if id(obj) in seen:
+        return 0
+
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            size += deep_size(k, seen) + deep_size(v, seen)
+
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_size(item, seen)
+
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+
+    return size
+
+
+def legacy(tables):
+    """Rebuild the former representation (lists of lists and a dictionary
+    of lists of stream rows) from the tables.
+
+    Strings are copied, as every row had its own copy when read from XML.
+
+    """
+
+    def unshared(row):
+        return [(v + '.')[:-1] if isinstance(v, str) else v for v in row]
+
+    (networks, stations, sensorsLoc, streams, streamidx) = tables
+
+    nets = [unshared(row) for row in networks]
+    stats = [unshared(row) for row in stations]
+    sens = [unshared(row) for row in sensorsLoc]
+    stre = [tuple(unshared(row)) for row in streams]
+
+    index = {}
+    for key, epochs in streamidx.iteritems():
+        index[tuple(unshared(key))] = [stre[s] for s in epochs]
+
+    return (nets, stats, sens, stre, index)
+
+
+def main(inventory):
+    picklefile = os.path.join(os.path.dirname(inventory),
+                              'webinterface-cache.bin')
+    if os.path.exists(picklefile):
+        os.remove(picklefile)
+
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    ic = inventorycache.InventoryCache(inventory)
+    built = time.time() - start
+    rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print 'Networks: %d' % len(ic.networks)
+    print 'Stations: %d' % len(ic.stations)
+    print 'Sensors : %d' % len(ic.sensorsLoc)
+    print 'Streams : %d' % len(ic.streams)
+    print 'Built from XML in %.3f s' % built
+    print 'Peak RSS increase while building: %.1f MB' % \
+        ((rss1 - rss0) / 1024.0)
+
+    # A second instance (e.g. another WSGI process) maps the snapshot
+    start = time.time()
+    inventorycache.InventoryCache(inventory)
+    print 'Snapshot mapped in %.3f s' % (time.time() - start)
+
+    tables = ic.parseXML()
+
+    columnar = deep_size(tables)
+    lists = deep_size(legacy(tables))
+
+    print 'Columnar tables: %10d bytes' % columnar
+    print 'Lists of lists:  %10d bytes' % lists
+    print 'Reduction:       %9.1f %%' % (100.0 * (lists - columnar) / lists)
+    print 'Snapshot file:   %10d bytes (shared by all processes)' % \
+        os.path.getsize(picklefile)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(sys.argv[1])
+    else:
+        main(os.path.join('..', 'data', 'Arclink-inventory.xml'))
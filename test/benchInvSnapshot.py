@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# How long does it take to load the InventoryCache from its cache file?
+#
+# Compares mapping the snapshot (see invsnapshot) with loading the pickle
+# of lists of lists used before, and with loading a pickle of the tables.
+#
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import time
+import tempfile
+import cPickle as pickle
+
+sys.path.append(os.path.join('..', 'wsgi'))  # for wsgicomm
+sys.path.append(os.path.join('..', 'wsgi', 'modules'))
+
+import inventorycache
+import invsnapshot
+from benchInvMemory import legacy
+
+
+def best(func, repeat=5):
+    """Shortest of several runs of func, in seconds."""
+
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+
+    return min(times)
+
+
+def main(inventory):
+    ic = inventorycache.InventoryCache(inventory)
+    tables = ic.parseXML()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        snapfile = os.path.join(tmpdir, 'snapshot.bin')
+        legacyfile = os.path.join(tmpdir, 'legacy.pickle')
+        tablesfile = os.path.join(tmpdir, 'tables.pickle')
+
+        invsnapshot.write(snapfile, zip([name for name, cls in ic.TABLES],
+                                        tables),
+                          invsnapshot.fingerprint(inventory))
+
+        with open(legacyfile, 'wb') as fileobj:
+            pickle.dump(legacy(tables), fileobj, 2)
+
+        with open(tablesfile, 'wb') as fileobj:
+            pickle.dump(tables, fileobj, 2)
+
+        def mapSnapshot(verify):
+            snapshot = invsnapshot.Snapshot(snapfile)
+            if verify:
+                snapshot.verify()
+            return [snapshot.table(name, cls) for name, cls in ic.TABLES]
+
+        def loadPickle(path):
+            with open(path, 'rb') as fileobj:
+                return pickle.load(fileobj)
+
+        print 'Fingerprint of the XML file: %8.4f s' % \
+            best(lambda: invsnapshot.fingerprint(inventory))
+        print 'Snapshot, mapped:            %8.4f s (%d bytes)' % \
+            (best(lambda: mapSnapshot(False)), os.path.getsize(snapfile))
+        print 'Snapshot, mapped + verified: %8.4f s' % \
+            best(lambda: mapSnapshot(True))
+        print 'Pickle of lists (former):    %8.4f s (%d bytes)' % \
+            (best(lambda: loadPickle(legacyfile)),
+             os.path.getsize(legacyfile))
+        print 'Pickle of the tables:        %8.4f s (%d bytes)' % \
+            (best(lambda: loadPickle(tablesfile)),
+             os.path.getsize(tablesfile))
+
+    finally:
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(sys.argv[1])
+    else:
+        main(os.path.join('..', 'data', 'Arclink-inventory.xml'))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#
+# How long does it take to fill in the region names of a response?
+#
+# Compares the former way, a new seiscomp3.Seismology.Regions object and a
+# lookup for every event, with a RegionResolver (see regions.py) looking up
+# the events one by one as the streamed responses do, and all at once, as
+# EventResponse.fill_regions() does for an EventData. Events are those of
+# a sample response, repeated up to 800 as with lookupIfGiven.
+#
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.join('..', 'wsgi'))  # for wsgicomm
+sys.path.append(os.path.join('..', 'wsgi', 'modules'))
+
+import event
+from regions import RegionResolver
+
+SAMPLE = os.path.join('samples', 'comcat_sample.csv')
+COUNT = 800
+
+
+def events():
+    es = event.ESComcat
+    er = event.EventResponse(es.csv_dialect, es.column_map, es.filter_table,
+                             {'lookupIfEmpty': False, 'lookupIfGiven': False})
+    er.load_csv(open(SAMPLE).read(), None, es.csv_dialect)
+
+    data = er.ed.data
+    return [data[i % len(data)] for i in xrange(COUNT)]
+
+
+def former(evs):
+    for ev in evs:
+        event.Seismology.Regions().getRegionName(float(ev[3]), float(ev[4]))
+
+
+def onebyone(resolver):
+    def fill(evs):
+        for ev in evs:
+            resolver.name(ev[3], ev[4])
+    return fill
+
+
+def batched(resolver):
+    def fill(evs):
+        resolver.names([ev[3] for ev in evs], [ev[4] for ev in evs])
+    return fill
+
+
+def best(fill, evs, repeat=5):
+    """Shortest time to fill in the regions of evs, in milliseconds."""
+
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        fill(evs)
+        times.append(time.time() - start)
+
+    return min(times) * 1e3
+
+
+def main():
+    evs = events()
+    print '%i events' % len(evs)
+
+    print '%-24s %8.2f ms' % ('former', best(former, evs))
+
+    for (name, make) in (('one by one', onebyone), ('batched', batched)):
+        # First response, with an empty cache, then the following ones
+        resolver = RegionResolver(event.Seismology.Regions)
+        print '%-24s %8.2f ms' % (name + ' (empty cache)',
+                                  best(make(resolver), evs, 1))
+        print '%-24s %8.2f ms' % (name, best(make(resolver), evs))
+        print '%-24s %s' % ('', resolver.stats())
+
+
+if __name__ == '__main__':
+    main()
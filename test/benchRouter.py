@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# How long does it take to dispatch a request to its action?
+#
+# Compares the router (see router.py and formdata.py), which parses the
+# path and the query string once, with the former dispatch: a lookup of
+# PATH_INFO in the table of actions, cgi.FieldStorage for every request
+# and, for event services, splitting the path and parsing the query string
+# again in getEvents().
+#
+# ----------------------------------------------------------------------
+
+import cgi
+import os
+import re
+import sys
+import time
+
+sys.path.append(os.path.join('..', 'wsgi'))  # for wsgicomm
+
+from router import Router, Request
+from formdata import parseParameters
+
+ROUTES = ('/configuration', '/loader',
+          '/event/catalogs', '/event/dumpconfig', '/event/parse',
+          '/metadata/export', '/metadata/import', '/metadata/networks',
+          '/metadata/networktypes', '/metadata/phases', '/metadata/query',
+          '/metadata/sensortypes', '/metadata/stations', '/metadata/status',
+          '/metadata/streams', '/metadata/timewindows',
+          '/request/download', '/request/nodes', '/request/purge',
+          '/request/resubmit', '/request/status', '/request/submit',
+          '/request/types')
+
+SERVICES = ('geofon', 'emsc', 'comcat', 'fdsnws', 'meteor', 'parser')
+
+REQUESTS = (
+    ('/metadata/networks', 'start=1990&end=2016&networktype=all&_=1'),
+    ('/metadata/stations', 'start=1990&end=2016&networktype=all&network=GE'),
+    ('/event/geofon', 'start=2015-01-01&end=2015-06-30&minmag=5&'
+     'minlat=-90&maxlat=90&minlon=-180&maxlon=180&format=json&limit=800'),
+    ('/configuration', ''),
+)
+
+
+def former():
+    table = dict((route, None) for route in ROUTES)
+    for service in SERVICES:
+        table['/event/%s' % service] = None
+
+    def dispatch(environ):
+        if environ['PATH_INFO'] not in table:
+            return None
+
+        form = cgi.FieldStorage(fp=None, environ=environ)
+        parameters = {}
+        if form:
+            for k in form.keys():
+                parameters[k] = form.getfirst(k)
+
+        if environ['PATH_INFO'].startswith('/event/'):
+            parts = environ['PATH_INFO'].lstrip('/').split('/', 3)
+            service = re.escape(parts[1].lower())
+            service = re.sub(r'([^a-zA-Z0-9-]+)', ' ', service)
+            parameters = cgi.parse_qs(environ.get('QUERY_STRING', ''))
+
+        return parameters
+
+    return dispatch
+
+
+def routed():
+    router = Router()
+    for route in ROUTES + ('/event/{service}',):
+        router.add(route)
+
+    junk = re.compile(r'[^a-zA-Z0-9-]+')
+
+    def dispatch(environ):
+        match = router.match(environ['PATH_INFO'])
+        if match is None:
+            return None
+
+        (route, args) = match
+        request = Request(environ, route, args, parseParameters(environ))
+
+        if 'service' in request.args:
+            service = junk.sub(' ', request.args['service'].lower())
+
+        return request
+
+    return dispatch
+
+
+def best(dispatch, environ, count=20000, repeat=5):
+    """Shortest time of dispatch per request, in microseconds."""
+
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        for j in xrange(count):
+            dispatch(environ)
+        times.append(time.time() - start)
+
+    return min(times) / count * 1e6
+
+
+def main():
+    dispatchers = (('former', former()), ('router', routed()))
+
+    for path, query in REQUESTS:
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path,
+                   'QUERY_STRING': query}
+        print '%-22s' % path,
+        for name, dispatch in dispatchers:
+            print ' %s: %6.2f us' % (name, best(dispatch, environ)),
+        print
+
+
+if __name__ == '__main__':
+    main()
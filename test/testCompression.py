@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+#
+# Run unit tests on the compression of responses of webinterface.
+#
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import zlib
+import unittest
+from unittestTools import WITestRunner
+
+sys.path.append(os.path.join('..', 'wsgi'))  # for wsgicomm
+
+import wsgicomm
+from wsgicomm import JSONStream, Precompressed
+
+
+def decompress(body, encoding):
+    if encoding == 'gzip':
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+    return zlib.decompress(body)
+
+
+class Response(object):
+    """Collect what the application passes to start_response."""
+
+    def __call__(self, status, headers):
+        self.status = status
+        self.headers = dict(headers)
+
+
+class CompressionTests(unittest.TestCase):
+    """Test the compression of responses in wsgicomm.py
+
+    """
+
+    def setUp(self):
+        self.body = '["GE", "APE", 37.07, 25.53], ' * 200
+
+    def testAcceptedEncoding(self):
+        "choice of encoding from Accept-Encoding"
+
+        for (header, expected) in ((None, None), ('', None),
+                                   ('gzip', 'gzip'),
+                                   ('deflate', 'deflate'),
+                                   ('deflate, gzip', 'gzip'),
+                                   ('gzip;q=0.5, deflate', 'deflate'),
+                                   ('gzip;q=0, deflate;q=0', None),
+                                   ('br, *;q=0.1', 'gzip'),
+                                   ('identity', None)):
+            environ = {}
+            if header is not None:
+                environ['HTTP_ACCEPT_ENCODING'] = header
+
+            self.assertEqual(wsgicomm.accepted_encoding(environ), expected,
+                             'Wrong encoding for %s' % header)
+
+    def testPlain(self):
+        "plain responses compressed only if accepted and large"
+
+        for encoding in ('gzip', 'deflate'):
+            response = Response()
+            environ = {'HTTP_ACCEPT_ENCODING': encoding}
+            body = ''.join(wsgicomm.send_plain_response('200 OK', self.body,
+                                                        response, environ))
+            self.assertEqual(response.headers['Content-Encoding'], encoding)
+            self.assertEqual(int(response.headers['Content-Length']),
+                             len(body))
+            self.assertEqual(decompress(body, encoding), self.body)
+
+        response = Response()
+        body = ''.join(wsgicomm.send_plain_response('200 OK', self.body,
+                                                    response, {}))
+        self.assertEqual(body, self.body)
+        self.assertTrue('Content-Encoding' not in response.headers)
+
+        response = Response()
+        body = ''.join(wsgicomm.send_plain_response(
+            '200 OK', 'short', response, {'HTTP_ACCEPT_ENCODING': 'gzip'}))
+        self.assertEqual(body, 'short')
+        self.assertTrue('Content-Encoding' not in response.headers)
+
+    def testStream(self):
+        "streamed responses compressed while they are sent"
+
+        rows = [['GE', 'APE', 37.07, 25.53]] * 2000
+        expected = ''.join(JSONStream(rows))
+
+        response = Response()
+        chunks = wsgicomm.send_stream_response(
+            '200 OK', JSONStream(rows, chunksize=1000), response,
+            {'HTTP_ACCEPT_ENCODING': 'gzip'})
+
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertTrue('Content-Length' not in response.headers)
+        self.assertEqual(decompress(''.join(chunks), 'gzip'), expected)
+
+        # Short streams are sent as plain responses
+        response = Response()
+        body = ''.join(wsgicomm.send_stream_response(
+            '200 OK', JSONStream(rows[:2]), response,
+            {'HTTP_ACCEPT_ENCODING': 'gzip'}))
+        self.assertEqual(body, ''.join(JSONStream(rows[:2])))
+        self.assertEqual(int(response.headers['Content-Length']), len(body))
+
+    def testPrecompressed(self):
+        "precompressed bodies compressed only once"
+
+        body = Precompressed(self.body)
+        self.assertEqual(body, self.body)
+
+        first = body.encoded('gzip')
+        self.assertTrue(body.encoded('gzip') is first)
+        self.assertEqual(decompress(first, 'gzip'), self.body)
+
+        response = Response()
+        sent = wsgicomm.send_plain_response('200 OK', body, response,
+                                            {'HTTP_ACCEPT_ENCODING': 'gzip'})
+        self.assertTrue(sent[0] is first)
+
+    def testNotModified(self):
+        "conditional requests answered from the validators"
+
+        etag = 'W/"0123abcd"'
+        modified = 1450000000
+        headers = dict(wsgicomm.validators_headers(etag, modified))
+        self.assertEqual(headers['ETag'], etag)
+
+        for match in ('"0123abcd"', 'W/"0123abcd"', '"x", W/"0123abcd"', '*'):
+            self.assertTrue(wsgicomm.not_modified(
+                {'HTTP_IF_NONE_MATCH': match}, etag, modified), match)
+
+        self.assertFalse(wsgicomm.not_modified(
+            {'HTTP_IF_NONE_MATCH': 'W/"4567"'}, etag, modified))
+
+        since = {'HTTP_IF_MODIFIED_SINCE': headers['Last-Modified']}
+        self.assertTrue(wsgicomm.not_modified(since, etag, modified))
+        self.assertFalse(wsgicomm.not_modified(since, etag, modified + 1))
+
+        # If-None-Match takes precedence over If-Modified-Since
+        since['HTTP_IF_NONE_MATCH'] = 'W/"4567"'
+        self.assertFalse(wsgicomm.not_modified(since, etag, modified))
+
+        self.assertFalse(wsgicomm.not_modified({}, etag, modified))
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testCompression [-h] [-p]'
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+# Run unit tests on the streamed responses of event services of
+# webinterface.
+#
+# ----------------------------------------------------------------------
+
+import json
+import os
+import sys
+import unittest
+from unittestTools import WITestRunner
+
+sys.path.append(os.path.join('..', 'wsgi'))  # for wsgicomm
+sys.path.append(os.path.join('..', 'wsgi', 'modules'))
+
+import event
+from regions import RegionResolver
+from wsgicomm import JSONStream, TextStream
+
+ROWS = open(os.path.join('samples', 'comcat_sample.csv')).read()
+
+
+class Regions(object):
+    """Flinn-Engdahl regions which remember the points looked up."""
+
+    def __init__(self):
+        self.lookups = []
+
+    def getRegionName(self, lat, lon):
+        self.lookups.append((lat, lon))
+        return 'Somewhere'
+
+
+class EventStreamTests(unittest.TestCase):
+    """Test the streamed output of event.py
+
+    """
+
+    def setUp(self):
+        self.opts = {'lookupIfEmpty': True, 'lookupIfGiven': True,
+                     'defaultLimit': 800}
+        self.regions = Regions()
+        self.resolver = event.regionResolver
+        event.regionResolver = RegionResolver(lambda: self.regions)
+
+    def tearDown(self):
+        event.regionResolver = self.resolver
+
+    def response(self, stream):
+        es = event.ESComcat('comcat', self.opts)
+        er = event.EventResponse(es.csv_dialect, es.column_map,
+                                 es.filter_table, self.opts)
+        if stream:
+            er.stream_csv(ROWS, 500, es.csv_dialect)
+        else:
+            er.load_csv(ROWS, 500, es.csv_dialect)
+        er.fill_regions()
+        return er
+
+    def testSameAsWrite(self):
+        "same text streamed as written at once"
+
+        for fmt in ('csv', 'json', 'fdsnws-text'):
+            for limit in (0, 1, 10, 500):
+                text = self.response(False).write(limit, fmt)
+                stream = self.response(True).write(limit, fmt)
+                self.assertTrue(isinstance(stream, (TextStream, JSONStream)))
+                self.assertEqual(''.join(stream), text,
+                                 'Wrong %s text with limit %i' % (fmt, limit))
+
+    def testLazy(self):
+        "events read and their regions looked up only while sent"
+
+        stream = self.response(True).write(5, 'json')
+        self.assertEqual(self.regions.lookups, [])
+
+        text = ''.join(stream)
+        self.assertEqual(len(self.regions.lookups), 5)
+        self.assertEqual(text.count('Somewhere'), 5)
+
+    def testSendResponse(self):
+        "header sent before the streamed events"
+
+        es = event.ESComcat('comcat', self.opts)
+        body = es.send_response({}, None, '# header\n', ROWS, 3, 'csv')
+        self.assertTrue(isinstance(body, TextStream))
+
+        lines = ''.join(body).splitlines()
+        self.assertEqual(lines[0], '# header')
+        self.assertEqual(lines[1], ','.join(event.EventWriter.output_header))
+        self.assertEqual(lines[-1], '# Lines: 3')
+        self.assertEqual(len(lines), 6)
+
+    def testMalformedRow(self):
+        "failure before the first event raised, later ones end the stream"
+
+        lines = ROWS.splitlines(True)
+        bad = lines[3].split(',')
+        bad[1] = 'north'
+        bad = ','.join(bad)
+
+        es = event.ESComcat('comcat', self.opts)
+        self.assertRaises(ValueError, es.format_response,
+                          lines[0] + bad + ''.join(lines[1:]), 10, 'csv')
+
+        rows = ''.join(lines[:3]) + bad + ''.join(lines[4:])
+        body = ''.join(es.send_response({}, None, '', rows, 10, 'csv'))
+        lines = body.splitlines()
+        self.assertEqual(lines[-2], '# Lines: 2')
+        self.assertTrue(lines[-1].startswith('# Error: '))
+
+        body = ''.join(es.send_response({}, None, '', rows, 10, 'fdsnws-text'))
+        self.assertEqual(len(body.splitlines()), 4)
+        self.assertTrue(body.endswith('\r\n'))
+
+        body = ''.join(es.send_response({}, None, '', rows, 10, 'json'))
+        self.assertEqual(len(json.loads(body)), 3)
+
+    def testTextStream(self):
+        "parts joined in chunks"
+
+        parts = ['%i\n' % i for i in xrange(1000)]
+        chunks = list(TextStream(iter(parts), chunksize=100))
+        self.assertEqual(''.join(chunks), ''.join(parts))
+        self.assertTrue(all(100 <= len(c) < 110 for c in chunks[:-1]))
+        self.assertEqual(list(TextStream(iter([]))), [])
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testEventStream [-h] [-p]'
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#
+# Run unit tests on the parsing of the parameters of requests of
+# webinterface.
+#
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import unittest
+import urllib
+from StringIO import StringIO
+from unittestTools import WITestRunner
+
+sys.path.append(os.path.join('..', 'wsgi'))  # for wsgicomm
+
+import formdata
+from formdata import parseParameters, BodyTooLarge, Upload
+
+
+class Input(StringIO):
+    """Body of a request which counts the bytes read."""
+
+    def __init__(self, body):
+        StringIO.__init__(self, body)
+        self.count = 0
+
+    def read(self, size=-1):
+        data = StringIO.read(self, size)
+        self.count += len(data)
+        return data
+
+
+def post(body, ctype='application/x-www-form-urlencoded', query=''):
+    return {'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': ctype,
+            'CONTENT_LENGTH': str(len(body)), 'QUERY_STRING': query,
+            'wsgi.input': Input(body)}
+
+
+def multipart(boundary, parts):
+    body = ''
+    for (headers, content) in parts:
+        body += '--%s\r\n%s\r\n\r\n%s\r\n' % (boundary, '\r\n'.join(headers),
+                                              content)
+    return body + '--%s--\r\n' % boundary
+
+
+class FormDataTests(unittest.TestCase):
+    """Test the functionality of formdata.py
+
+    """
+
+    def setUp(self):
+        self.blocksize = formdata.BLOCK_SIZE
+        # Small blocks, so that fields and escapes are split between them
+        formdata.BLOCK_SIZE = 7
+
+        self.catalog = ''.join('2015-%02d-01T10:00:00,%d.5,-%d.25,10\n' %
+                               (m, m, m) for m in xrange(1, 13))
+
+    def tearDown(self):
+        formdata.BLOCK_SIZE = self.blocksize
+
+    def testURLEncoded(self):
+        "form-encoded bodies parsed as cgi.parse_qs does"
+
+        pairs = [('networktype', 'all'), ('network', 'GE'),
+                 ('network', 'II'), ('start', '2010-01-01 00:00'),
+                 ('streams', '[["GE","APE","BHZ","--"]]'), ('empty', ''),
+                 ('odd', '%+&;=')]
+        body = urllib.urlencode(pairs) + '&flag;x=1'
+
+        self.assertEqual(parseParameters(post(body, query='_=1')),
+                         {'networktype': ['all'], 'network': ['GE', 'II'],
+                          'start': ['2010-01-01 00:00'],
+                          'streams': ['[["GE","APE","BHZ","--"]]'],
+                          'odd': ['%+&;='], 'x': ['1'], '_': ['1']})
+
+    def testUploadLines(self):
+        "large fields given as uploads, line by line"
+
+        body = urllib.urlencode([('informat', 'csv'),
+                                 ('input', self.catalog)])
+        params = parseParameters(post(body), uploads=('input',))
+
+        self.assertEqual(params['informat'], ['csv'])
+        upload = params['input'][0]
+        self.assertTrue(isinstance(upload, Upload))
+        self.assertEqual(len(upload), len(self.catalog))
+        self.assertEqual(list(upload), self.catalog.splitlines(True))
+        self.assertEqual(str(upload), self.catalog)
+
+    def testMultipart(self):
+        "multipart bodies with files"
+
+        boundary = '----WebKitFormBoundaryzZ7vLMt0iVqkaK1b'
+        parts = [(('Content-Disposition: form-data; name="streams"',),
+                  '[["GE","APE","BHZ",""]]'),
+                 (('Content-Disposition: form-data; name="file"; '
+                   'filename="stations.txt"', 'Content-Type: text/plain'),
+                  self.catalog),
+                 (('Content-Disposition: form-data; name="empty"',), '')]
+        env = post(multipart(boundary, parts),
+                   'multipart/form-data; boundary=%s' % boundary)
+
+        params = parseParameters(env, uploads=('file',))
+        self.assertEqual(params['streams'], ['[["GE","APE","BHZ",""]]'])
+        self.assertEqual(params['empty'], [''])
+
+        upload = params['file'][0]
+        self.assertEqual((upload.filename, upload.content_type),
+                         ('stations.txt', 'text/plain'))
+        self.assertEqual(list(upload), self.catalog.splitlines(True))
+
+        # Without the closing delimiter
+        body = multipart(boundary, parts)[:-len(boundary) - 6]
+        env = post(body, 'multipart/form-data; boundary=%s' % boundary)
+        self.assertRaises(ValueError, parseParameters, env)
+
+    def testOrder(self):
+        "values of the query string merged in the order of cgi.FieldStorage"
+
+        import cgi
+
+        boundary = 'XyZ'
+        for (ctype, body) in (
+                ('application/x-www-form-urlencoded', 'a=body&b=body'),
+                ('multipart/form-data; boundary=%s' % boundary,
+                 multipart(boundary,
+                           [(('Content-Disposition: form-data; name="a"',),
+                             'body'),
+                            (('Content-Disposition: form-data; name="b"',),
+                             'body')]))):
+            params = parseParameters(post(body, ctype, 'a=query'))
+
+            fs = cgi.FieldStorage(fp=StringIO(body),
+                                  environ=post(body, ctype, 'a=query'))
+            self.assertEqual(params['a'], fs.getlist('a'))
+            self.assertEqual(params['b'], fs.getlist('b'))
+
+        self.assertEqual(params['a'], ['query', 'body'])
+        self.assertEqual(parseParameters(post('a=body', query='a=query')),
+                         {'a': ['body', 'query']})
+
+    def testTooLarge(self):
+        "bodies longer than allowed refused before reading them"
+
+        env = post(urllib.urlencode([('input', self.catalog)]))
+        self.assertRaises(BodyTooLarge, parseParameters, env, 100)
+        self.assertEqual(env['wsgi.input'].count, 0)
+
+        # Not more than Content-Length is read
+        env = post('a=1&b=2')
+        env['CONTENT_LENGTH'] = '3'
+        self.assertEqual(parseParameters(env, 100), {'a': ['1']})
+
+    def testGet(self):
+        "only the query string of GET requests"
+
+        env = post('a=1')
+        env['REQUEST_METHOD'] = 'GET'
+        env['QUERY_STRING'] = 'b=2&b=3'
+        self.assertEqual(parseParameters(env, 0), {'b': ['2', '3']})
+        self.assertEqual(env['wsgi.input'].count, 0)
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testFormData [-h] [-p]'
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
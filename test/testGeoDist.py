@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#
+# Run unit tests on the distance/azimuth engine of webinterface.
+#
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import unittest
+from unittestTools import WITestRunner
+
+sys.path.append(os.path.join('..', 'wsgi'))  # for wsgicomm
+
+import geodist
+import seiscomp3.Math
+
+
+class GeoDistTests(unittest.TestCase):
+    """Test the functionality of geodist.py
+
+    """
+
+    def setUp(self):
+        self.lats = range(-90, 91, 15)
+        self.lons = range(-180, 181, 40) + [-350, 400]
+
+        self.points = [(lat, lon) for lat in self.lats for lon in self.lons]
+
+    def testShape(self):
+        "shape of the matrices of distance and azimuth"
+
+        (dist, azi) = geodist.delazi([0, 10, 20], [0, 10, 20], [5, 6], [5, 6])
+        self.assertEqual(len(dist), 3, 'Wrong number of rows.')
+        self.assertEqual(len(azi[0]), 2, 'Wrong number of columns.')
+
+    def testSC3Delazi(self):
+        "distance and azimuth are the same as with Math.delazi"
+
+        lat = [p[0] for p in self.points]
+        lon = [p[1] for p in self.points]
+        (dist, azi) = geodist.delazi(lat, lon, [12.5, -33.3], [-71.2, 151.0])
+
+        for i, (lat0, lon0) in enumerate(self.points):
+            for j, (lat1, lon1) in enumerate(((12.5, -71.2), (-33.3, 151.0))):
+                (d, a, b) = seiscomp3.Math.delazi(lat0, lon0, lat1, lon1)
+                self.assertTrue(abs(dist[i][j] - d) <= geodist.TOLERANCE,
+                                'Wrong distance from %s' % str(self.points[i]))
+
+                # The azimuth is not defined at the poles
+                if abs(lat0) == 90:
+                    continue
+
+                diff = abs(azi[i][j] - a) % 360.0
+                self.assertTrue(min(diff, 360.0 - diff) <= geodist.TOLERANCE,
+                                'Wrong azimuth from %s' % str(self.points[i]))
+
+    def testAntipodes(self):
+        "distance close to 0 and 180 degrees"
+
+        (dist, azi) = geodist.delazi([10, 10], [20, 20], [10, -10], [20, -160])
+        self.assertAlmostEqual(dist[0][0], 0.0)
+        self.assertAlmostEqual(dist[1][1], 180.0)
+
+    def testReached(self):
+        "points within radius and azimuth limits"
+
+        lat = [p[0] for p in self.points]
+        lon = [p[1] for p in self.points]
+        events = ((40.0, 15.0), (-20.0, -175.0))
+
+        for limits in ((None, 30, None, None), (10, 60, 90, 270),
+                       (None, None, 300, None), (0, 1, None, None)):
+            reached = geodist.reached(lat, lon, [e[0] for e in events],
+                                      [e[1] for e in events], *limits)
+
+            (minr, maxr, mina, maxa) = limits
+            for i, (lat0, lon0) in enumerate(self.points):
+                expected = False
+                for (lat1, lon1) in events:
+                    (d, a, b) = seiscomp3.Math.delazi(lat0, lon0, lat1, lon1)
+                    if (minr is None or minr < d) and \
+                       (maxr is None or d < maxr) and \
+                       (mina is None or mina < a) and \
+                       (maxa is None or a < maxa):
+                        expected = True
+
+                self.assertEqual(bool(reached[i]), expected,
+                                 'Wrong selection of %s with limits %s' %
+                                 (str(self.points[i]), str(limits)))
+
+    def testReachedEmpty(self):
+        "no points in one of the sets"
+
+        self.assertEqual(geodist.reached([], [], [1.0], [2.0], 0, 10), [])
+        self.assertEqual(geodist.reached([1.0], [2.0], [], [], 0, 10), [False])
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testGeoDist [-h] [-p]'
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+#
+# Run unit tests on the connections of webinterface to event services,
+# against a local stub server.
+#
+# ----------------------------------------------------------------------
+
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+import urllib2
+import BaseHTTPServer
+import SocketServer
+from unittestTools import WITestRunner
+
+sys.path.append(os.path.join('..', 'wsgi'))  # for wsgicomm
+sys.path.append(os.path.join('..', 'wsgi', 'modules'))
+
+import httpclient
+from httpclient import ConnectionPool, Upstream, ResponseCache
+
+EVENTS = '#EventID|Time|Latitude|Longitude\ngfz2015abcd|2015-01-01|1.0|2.0\n'
+
+# A large response: the sample of ComCat repeated
+COMCAT = open(os.path.join('samples', 'comcat_sample.csv')).read()
+MANY = COMCAT + COMCAT.split('\n', 1)[1] * 9
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """An event service on localhost which counts connections and
+    requests in progress.
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.url = 'http://127.0.0.1:%i' % self.server_address[1]
+        self.lock = threading.Lock()
+        self.sockets = []
+        self.active = 0
+        self.maxactive = 0
+        self.requests = 0
+
+    def drop(self):
+        """Close all connections, as a server does after a while."""
+
+        with self.lock:
+            for sock in self.sockets:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            self.sockets = []
+
+    def handle_error(self, request, client_address):
+        # Clients which gave up waiting
+        pass
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.sockets.append(self.connection)
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for (name, value) in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.active += 1
+            self.server.requests += 1
+            self.server.maxactive = max(self.server.maxactive,
+                                        self.server.active)
+
+        try:
+            path = self.path.split('?')[0]
+            if path == '/events':
+                self.reply(200, EVENTS)
+            elif path == '/many':
+                self.reply(200, MANY)
+            elif path == '/slow':
+                time.sleep(1.0)
+                self.reply(200, EVENTS)
+            elif path == '/moved':
+                self.reply(302, '', (('Location', '/events?moved=1'),))
+            elif path == '/close':
+                self.reply(200, EVENTS, (('Connection', 'close'),))
+            else:
+                self.reply(404, 'Not found')
+
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+
+class HTTPClientTests(unittest.TestCase):
+    """Test the functionality of httpclient.py
+
+    """
+
+    def setUp(self):
+        self.server = StubServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.pool = ConnectionPool()
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testKeepAlive(self):
+        "one connection for consecutive requests"
+
+        for i in xrange(5):
+            response = self.pool.get(self.server.url + '/events?i=%i' % i)
+            self.assertEqual((response.status, response.body), (200, EVENTS))
+
+        stats = self.pool.stats()
+        self.assertEqual((stats['requests'], stats['connections'],
+                          stats['reused'], stats['idle']), (5, 1, 4, 1))
+        self.assertEqual(len(self.server.sockets), 1)
+
+        # Not kept if the server closes it
+        self.pool.get(self.server.url + '/close')
+        self.assertEqual(self.pool.stats()['idle'], 0)
+
+    def testStale(self):
+        "request repeated on a new connection if the idle one was closed"
+
+        self.pool.get(self.server.url + '/events')
+        self.server.drop()
+        time.sleep(0.1)
+
+        response = self.pool.get(self.server.url + '/events')
+        self.assertEqual(response.body, EVENTS)
+        self.assertEqual(self.pool.stats()['connections'], 2)
+
+    def testRedirect(self):
+        "redirections followed"
+
+        response = self.pool.get(self.server.url + '/moved')
+        self.assertEqual(response.body, EVENTS)
+        self.assertEqual(response.url, self.server.url + '/events?moved=1')
+        self.assertEqual(self.pool.stats()['connections'], 1)
+
+    def testErrors(self):
+        "errors reported as urllib2 does"
+
+        with self.assertRaises(urllib2.HTTPError) as cm:
+            self.pool.get(self.server.url + '/nothing')
+        self.assertEqual(cm.exception.code, 404)
+        self.assertEqual(cm.exception.read(), 'Not found')
+
+        start = time.time()
+        self.assertRaises(urllib2.URLError, self.pool.get,
+                          self.server.url + '/slow', None, 1.0, 0.2)
+        self.assertTrue(time.time() - start < 0.9, 'Read timeout ignored')
+
+        self.assertRaises(urllib2.URLError, self.pool.get,
+                          'ftp://127.0.0.1/events')
+
+    def testConcurrency(self):
+        "requests to an upstream limited, the others wait their turn"
+
+        upstream = Upstream(self.pool, connect_timeout=5.0, timeout=5.0,
+                            concurrency=2)
+        results = []
+
+        def query():
+            try:
+                results.append(upstream.get(self.server.url + '/slow').body)
+            except urllib2.URLError, e:
+                results.append(e)
+
+        threads = [threading.Thread(target=query) for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [EVENTS] * 4)
+        self.assertEqual(self.server.maxactive, 2)
+        self.assertEqual(self.pool.stats()['connections'], 2)
+
+        # Too long a wait
+        upstream = Upstream(self.pool, connect_timeout=0.2, timeout=5.0,
+                            concurrency=1)
+        del results[:]
+        threads = [threading.Thread(target=query) for i in xrange(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results[1:], [EVENTS])
+        self.assertTrue(isinstance(results[0], urllib2.URLError))
+
+    def testEventService(self):
+        "event services query through their upstream"
+
+        import event
+        event.upstreamPool = self.pool
+        es = event.EventService('stub', {'defaultLimit': 10, 'timeout': 0.2},
+                                self.server.url + '/events', 'format=text')
+        self.assertEqual(es.upstream.timeout, 0.2)
+        self.assertEqual(es.upstream.connect_timeout,
+                         httpclient.CONNECT_TIMEOUT)
+
+        (rows, url) = es.send_request(['start=2015-01-01'])
+        self.assertEqual(rows, EVENTS)
+        self.assertEqual(url, self.server.url +
+                         '/events?start=2015-01-01&format=text')
+
+        es.service_url = self.server.url + '/slow'
+        self.assertRaises(urllib2.URLError, es.send_request, [])
+
+    def testResponseCache(self):
+        "responses kept for their time, errors not at all"
+
+        cache = ResponseCache(1024)
+        fetch = lambda url: self.pool.get(url).body
+        url = self.server.url + '/events'
+
+        for i in xrange(3):
+            self.assertEqual(cache.get(url, fetch, 60), EVENTS)
+        self.assertEqual(self.server.requests, 1)
+
+        cache.get(url + '?late=1', fetch, 0)
+        cache.get(url + '?late=1', fetch, 0)
+        self.assertEqual(self.server.requests, 3)
+
+        cache.get(url + '?short=1', fetch, 0.1)
+        time.sleep(0.2)
+        cache.get(url + '?short=1', fetch, 0.1)
+        self.assertEqual(self.server.requests, 5)
+
+        for i in xrange(2):
+            self.assertRaises(urllib2.HTTPError, cache.get,
+                              self.server.url + '/nothing', fetch, 60)
+        self.assertEqual(self.server.requests, 7)
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['fetches'], stats['saved']),
+                         (2, 7, 2 * len(EVENTS)))
+
+    def testSingleFlight(self):
+        "concurrent requests of the same URL sent once"
+
+        cache = ResponseCache(1024)
+        fetch = lambda url: self.pool.get(url).body
+        results = []
+
+        def query(path):
+            try:
+                results.append(cache.get(self.server.url + path, fetch, 0))
+            except urllib2.URLError, e:
+                results.append(e)
+
+        for (path, expected) in (('/slow', EVENTS), ('/slow?x', EVENTS)):
+            threads = [threading.Thread(target=query, args=(path,))
+                       for i in xrange(4)]
+            for thread in threads:
+                thread.start()
+                time.sleep(0.05)
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(results, [EVENTS] * 8)
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(cache.stats()['coalesced'], 6)
+
+        # The error of the request shared by the others
+        del results[:]
+        fetch = lambda url: self.pool.get(url, None, 1.0, 0.3).body
+        threads = [threading.Thread(target=query, args=('/slow',))
+                   for i in xrange(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(isinstance(e, urllib2.URLError) for e in results))
+        self.assertEqual(self.server.requests, 3)
+
+    def testStream(self):
+        "bodies read as they are iterated, connection dropped if not to the end"
+
+        response = self.pool.open(self.server.url + '/many')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.body.peek(10), MANY[:10])
+        lines = [response.body.next() for i in xrange(3)]
+        self.assertEqual(lines, MANY.splitlines(True)[:3])
+        self.assertEqual(self.pool.stats()['idle'], 0)
+        response.body.close()
+        self.assertEqual(self.pool.stats()['idle'], 0)
+
+        response = self.pool.open(self.server.url + '/moved')
+        self.assertEqual(''.join(response.body), EVENTS)
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+        upstream = Upstream(self.pool, concurrency=1)
+        body = upstream.open(self.server.url + '/many').body
+        self.assertRaises(urllib2.URLError, upstream.open,
+                          self.server.url + '/events')
+        self.assertEqual(list(body), MANY.splitlines(True))
+        self.assertEqual(upstream.get(self.server.url + '/events').body,
+                         EVENTS)
+        stats = self.pool.stats()
+        self.assertEqual((stats['connections'], stats['idle']), (2, 1))
+
+        self.assertRaises(urllib2.HTTPError, upstream.open,
+                          self.server.url + '/nothing')
+        self.assertEqual(upstream.get(self.server.url + '/events').body,
+                         EVENTS)
+
+    def testResponseCacheStream(self):
+        "responses streamed if not to be kept or too large"
+
+        cache = ResponseCache(1024 * 1024)
+        fetch = lambda url: self.pool.open(url).body
+
+        for i in xrange(2):
+            body = cache.open(self.server.url + '/events', fetch, 60, 1024)
+            self.assertEqual(list(body), EVENTS.splitlines(True))
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(cache.get(self.server.url + '/events', None, 60),
+                         EVENTS)
+
+        for ttl in (0, 60):
+            for i in xrange(2):
+                body = cache.open(self.server.url + '/many', fetch, ttl, 1024)
+                self.assertEqual(body.next(), MANY.splitlines(True)[0])
+                body.close()
+        self.assertEqual(self.server.requests, 5)
+        self.assertEqual(len(cache.cache), 1)
+        self.assertEqual(self.pool.stats()['idle'], 0)
+
+    def testEventServiceStream(self):
+        "events read from the service up to the limit"
+
+        import event
+        event.upstreamPool = self.pool
+        event.upstreamCache = ResponseCache(1024)
+        opts = {'defaultLimit': 10, 'cachettl': 0,
+                'lookupIfEmpty': False, 'lookupIfGiven': False}
+        es = event.ESComcat('comcat', opts)
+        es.service_url = self.server.url + '/many'
+
+        (rows, url) = es.send_request([], None, True)
+        self.assertEqual(self.pool.stats()['idle'], 0)
+        body = ''.join(es.send_response({}, None, '', rows, 5, 'csv'))
+        self.assertEqual(body.splitlines()[-1], '# Lines: 5')
+        self.assertEqual(self.pool.stats()['idle'], 0)
+
+        # Read to the end, the connection is kept
+        es.service_url = self.server.url + '/events'
+        (rows, url) = es.send_request([], None, True)
+        self.assertEqual(list(rows), EVENTS.splitlines(True))
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+    def testEventServiceCache(self):
+        "queries of event services cached longer if they end in the past"
+
+        import event
+        event.upstreamPool = self.pool
+        event.upstreamCache = ResponseCache(1024)
+        es = event.EventService('stub', {'defaultLimit': 10,
+                                         'historicalttl': 3600},
+                                self.server.url + '/events', 'format=text')
+
+        self.assertEqual(es.cache_ttl({'end': ['2015-01-31']}), 3600)
+        self.assertEqual(es.cache_ttl({'end': ['2015-01-31T10:00:00']}), 3600)
+        self.assertEqual(es.cache_ttl({'start': ['2015-01-01']}),
+                         event.CACHE_TTL)
+        self.assertEqual(es.cache_ttl(None), event.CACHE_TTL)
+        self.assertEqual(es.cache_ttl({'end': ['2099-01-01']}),
+                         event.CACHE_TTL)
+
+        for i in xrange(3):
+            (rows, url) = es.send_request(['end=2015-01-31'],
+                                          {'end': ['2015-01-31']})
+            self.assertEqual(rows, EVENTS)
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(event.upstreamCache.stats()['hits'], 2)
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testHTTPClient [-h] [-p]'
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
@@ -8,8 +8,11 @@
 # ----------------------------------------------------------------------
 
 import os
+import re
 import sys
-###import tempfile
+import shutil
+import time
+import tempfile
 import datetime
 import unittest
 from unittestTools import WITestRunner
@@ -18,6 +21,9 @@ sys.path.append(os.path.join('..', 'wsgi'))  # for wsgicomm
 sys.path.append(os.path.join('..', 'wsgi', 'modules'))
 
 import inventorycache
+import invsnapshot
+import invtables
+import seiscomp3.Math
 
 
 class InvCacheTests(unittest.TestCase):
@@ -107,7 +113,7 @@ class InvCacheTests(unittest.TestCase):
 
     def testNetworksType(self):
         "type of networks attribute"
-        self.assertEqual(type(self.__class__.ic.networks), type([]), 'Attribute networks is not a list.')
+        self.assertTrue(isinstance(self.__class__.ic.networks, invtables.Table), 'Attribute networks is not a Table.')
 
 
     def testNetworksCols(self):
@@ -257,7 +263,7 @@ class InvCacheTests(unittest.TestCase):
     def testStationsType(self):
         "type of stations attribute"
 
-        self.assertEqual(type(self.__class__.ic.stations), type([]), 'Attribute stations is not a list.')
+        self.assertTrue(isinstance(self.__class__.ic.stations, invtables.Table), 'Attribute stations is not a Table.')
 
 
     def testStationsCols(self):
@@ -383,7 +389,7 @@ class InvCacheTests(unittest.TestCase):
 
     def testSensorsType(self):
         "type of sensorsLoc attribute"
-        self.assertEqual(type(self.__class__.ic.sensorsLoc), type([]), 'Attribute sensorsLoc is not a list.')
+        self.assertTrue(isinstance(self.__class__.ic.sensorsLoc, invtables.Table), 'Attribute sensorsLoc is not a Table.')
 
 
     def testSensorsCols(self):
@@ -435,7 +441,7 @@ class InvCacheTests(unittest.TestCase):
 
     def testStreamsType(self):
         "type of streams attribute"
-        self.assertEqual(type(self.__class__.ic.streams), type([]), 'Attribute streams is not a list.')
+        self.assertTrue(isinstance(self.__class__.ic.streams, invtables.Table), 'Attribute streams is not a Table.')
 
 
     def testStreamsCols(self):
@@ -511,6 +517,446 @@ class InvCacheTests(unittest.TestCase):
                     errors.add(netw[9] + '.' + netw[0] + '.' + stat[4] + '.' + sens[4] + '.' + stre[1] + '(' + str(stre[6].year) + ')')
         self.assertTrue( len(errors) == 0, 'End dates with anomalous values. Code(s): %s' % sorted(list(errors)))
 
+    def testStreamTimesInEpochs(self):
+        "times stored as seconds since the epoch in streams"
+
+        errors = set()
+        if hasattr(self.__class__.ic, 'streams'):
+            stre = self.__class__.ic.streams
+            for idx in range(len(stre)):
+                if invtables.fromepoch(stre.start[idx]) != stre[idx][6]:
+                    errors.add(idx)
+                if (stre[idx][7] is None) != (stre.end[idx] == invtables.INF):
+                    errors.add(idx)
+        self.assertTrue( len(errors) == 0, 'Epoch columns do not match the rows. Index(es): %s' % sorted(list(errors)))
+
+    def testStreamIndexEpochs(self):
+        "epochs of every stream sorted by start time"
+
+        idx = self.ic.streamidx
+        stre = self.ic.streams
+        for i in xrange(len(idx)):
+            epochs = idx.order[idx.first[i]:idx.last[i]]
+            starts = [stre.start[s] for s in epochs]
+            self.assertEqual(starts, sorted(starts), 'Epochs not sorted: %s' % idx.key[i])
+
+            disjoint = all(stre.end[a] <= stre.start[b] for a, b in zip(epochs, epochs[1:]))
+            self.assertEqual(bool(idx.disjoint[i]), disjoint, 'Wrong flag disjoint: %s' % idx.key[i])
+            self.assertEqual(idx.find(tuple(idx.key[i].split(idx.SEP))), i)
+
+    def testStreamInfoMany(self):
+        "streams found by time window"
+
+        ic = self.ic
+        idx = ic.streamidx
+        stre = ic.streams
+        openend = time.time() + 365 * 86400
+
+        windows = []
+        expected = []
+        for key, epochs in idx.iteritems():
+            for s in epochs:
+                for t in (stre.start[s] - 86400, stre.start[s] + 1, stre.end[s] - 1, stre.end[s]):
+                    if not invtables.isfinite(t):
+                        continue
+
+                    start = invtables.fromepoch(t)
+                    end = start + datetime.timedelta(hours=1)
+                    windows.append((start, end, key))
+
+                    # The first epoch in the table overlapping the window
+                    found = None
+                    for e in sorted(epochs):
+                        e_end = openend if stre.end[e] == invtables.INF else stre.end[e]
+                        if invtables.toepoch(start) < e_end and stre.start[e] < invtables.toepoch(end):
+                            found = e
+                            break
+
+                    expected.append(found)
+
+        windows.append((datetime.datetime(2000, 1, 1), datetime.datetime(2000, 1, 2), ('XX', 'YYY', 'BHZ', '')))
+        expected.append(None)
+
+        result = ic.getStreamInfoMany(windows)
+        self.assertEqual(len(result), len(windows))
+
+        for (start, end, key), info, e in zip(windows, result, expected):
+            if e is None:
+                self.assertEqual(info, None, 'Stream %s found at %s' % (key, start))
+                continue
+
+            self.assertNotEqual(info, None, 'Stream %s not found at %s' % (key, start))
+            station = ic.sensorsLoc.station[stre.sensorLoc[e]]
+            self.assertEqual(info['latitude'], ic.stations.get('latitude', station))
+            self.assertEqual(info, ic.getStreamInfo(start, end, *key))
+
+
+    def testParseTime(self):
+        "fast conversion of inventory times"
+
+        for s in ('1980-01-01T00:00:00.0000Z', '2003-03-14T12:34:56.5000Z',
+                  '2012-02-29T23:59:59.0000Z'):
+            dt = datetime.datetime.strptime(s, '%Y-%m-%dT%H:%M:%S.%fZ')
+            self.assertEqual(invtables.parsetime(s), invtables.toepoch(dt), 'Wrong conversion of %s.' % s)
+
+        for s in ('2003-03-14', '2003-13-14T00:00:00.0000Z', '2003/03/14T00:00:00.0000Z'):
+            self.assertRaises((ValueError, IndexError), invtables.parsetime, s)
+
+
+    def testIndexNetworkKeys(self):
+        "every network can be found by its key"
+
+        nets = self.ic.networks
+        for i in xrange(len(nets)):
+            j = self.ic.index.netkeys[nets.key(i)]
+            self.assertEqual(nets.key(i), nets.key(j),
+                             'Wrong network for key %s' % nets.key(i))
+            self.assertTrue(j <= i, 'Not the first network with key %s' %
+                            nets.key(i))
+
+
+    def testIndexStationsOutside(self):
+        "stations not operating in a period of time"
+
+        st = self.ic.stations
+        for (start, end) in ((0.0, 1e9), (1e9, 1.2e9), (-1e12, 1e12),
+                             (1.4e9, 1.4e9)):
+            expected = set(s for s in xrange(len(st))
+                           if st.end[s] < start or end < st.start[s])
+            self.assertEqual(self.ic.index.outside(start, end), expected,
+                             'Wrong stations outside of %s' %
+                             str((start, end)))
+
+
+    def testIncrementalUpdate(self):
+        "tables after an update with only some networks changed"
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            inventory = os.path.join(tmpdir, 'Arclink-inventory.xml')
+            with open('../data/Arclink-inventory.xml') as inv:
+                text = inv.read()
+
+            with open(inventory, 'w') as inv:
+                inv.write(text)
+
+            ic = inventorycache.InventoryCache(inventory)
+
+            # Change the description of the first network and add a copy
+            # of the last one with another code
+            start = text.index('<ns0:network ')
+            end = text.index('>', start)
+            text = text[:start] + text[start:end].replace(
+                'description="', 'description="New ') + text[end:]
+
+            start = text.rindex('<ns0:network ')
+            end = text.rindex('</ns0:network>') + len('</ns0:network>')
+            text = text[:end] + re.sub('code="[^"]*"', 'code="ZZ"',
+                                       text[start:end], 1) + text[end:]
+
+            with open(inventory, 'w') as inv:
+                inv.write(text)
+
+            ic.lastUpdated = datetime.datetime(2000, 1, 1)
+            ic.update()
+
+            os.remove(ic.cachefile)
+            full = inventorycache.InventoryCache(inventory)
+
+            for name, cls in ic.TABLES:
+                for col, kind in cls.layout:
+                    self.assertEqual(repr(list(getattr(getattr(ic, name), col))),
+                                     repr(list(getattr(getattr(full, name), col))),
+                                     'Wrong column %s of %s' % (col, name))
+
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testVirtualAuxStations(self):
+        "stations with only auxStreams skipped by virtual networks"
+
+        inventory = """<?xml version="1.0" encoding="UTF-8"?>
+<ns0:inventory xmlns:ns0="http://geofon.gfz-potsdam.de/ns/Inventory/1.0/">
+<ns0:sensor publicID="Sensor/1" type="BB"/>
+<ns0:network code="AA" start="2000-01-01T00:00:00Z" description="A">
+ <ns0:station publicID="Station/AA/X1" code="X1" start="2000-01-01T00:00:00Z" latitude="1" longitude="2" elevation="0">
+  <ns0:sensorLocation code="">
+   <ns0:auxStream code="BHZ" start="2000-01-01T00:00:00Z"/>
+  </ns0:sensorLocation>
+ </ns0:station>
+ <ns0:station publicID="Station/AA/X2" code="X2" start="2000-01-01T00:00:00Z" latitude="3" longitude="4" elevation="0">
+  <ns0:sensorLocation code="">
+   <ns0:stream code="BHZ" start="2000-01-01T00:00:00Z" sampleRateNumerator="20" sampleRateDenominator="1" sensor="Sensor/1"/>
+  </ns0:sensorLocation>
+ </ns0:station>
+</ns0:network>
+<ns0:network code="BB" start="2000-01-01T00:00:00Z" description="B">
+ <ns0:station publicID="Station/BB/Y1" code="Y1" start="2000-01-01T00:00:00Z" latitude="5" longitude="6" elevation="0">
+  <ns0:sensorLocation code="">
+   <ns0:stream code="BHZ" start="2000-01-01T00:00:00Z" sampleRateNumerator="20" sampleRateDenominator="1" sensor="Sensor/1"/>
+  </ns0:sensorLocation>
+ </ns0:station>
+</ns0:network>
+<ns0:stationGroup code="VV" start="2000-01-01T00:00:00Z" description="V">
+ <ns0:stationReference stationID="Station/AA/X1"/>
+ <ns0:stationReference stationID="Station/AA/X2"/>
+ <ns0:stationReference stationID="Station/BB/Y1"/>
+</ns0:stationGroup>
+</ns0:inventory>
+"""
+
+        def members(ic):
+            return [ic.stations.code[st] for st in ic.networks.children(0)]
+
+        tmpdir = tempfile.mkdtemp()
+        warnings = []
+        warning = inventorycache.logs.warning
+        try:
+            path = os.path.join(tmpdir, 'Arclink-inventory.xml')
+            with open(path, 'w') as inv:
+                inv.write(inventory)
+
+            ic = inventorycache.InventoryCache(path)
+            self.assertEqual(members(ic), ['X2', 'Y1'])
+
+            # Only the network BB changes, AA is copied
+            with open(path, 'w') as inv:
+                inv.write(inventory.replace('description="B"',
+                                            'description="New B"'))
+
+            inventorycache.logs.warning = warnings.append
+            ic.lastUpdated = datetime.datetime(2000, 1, 1)
+            ic.update()
+
+            self.assertEqual(warnings, [])
+            self.assertEqual(members(ic), ['X2', 'Y1'])
+            self.assertEqual(ic.networks.description[2], 'New B')
+
+        finally:
+            inventorycache.logs.warning = warning
+            shutil.rmtree(tmpdir)
+
+    def testBackgroundReload(self):
+        "requests keep the version in use while a new one is loaded"
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            inventory = os.path.join(tmpdir, 'Arclink-inventory.xml')
+            shutil.copy('../data/Arclink-inventory.xml', inventory)
+
+            ic = inventorycache.InventoryCache(inventory)
+            before = ic.current
+            menu = ic.getNetworks({})
+
+            # Check what requests get while the file is being parsed
+            inUse = []
+            parseXML = ic.parseXML
+
+            def parse(previous=None):
+                inUse.append((ic.current is before, ic.getNetworks({})))
+                return parseXML(previous)
+
+            ic.parseXML = parse
+            with open(inventory, 'a') as inv:
+                inv.write('\n')
+            ic.lastUpdated = datetime.datetime(2000, 1, 1)
+
+            # The reload is started by the request but does not delay it
+            self.assertEqual(ic.getNetworks({}), menu)
+            self.assertNotEqual(ic.reloader, None, 'Reload not started')
+            ic.reloader.join()
+
+            self.assertEqual(inUse, [(True, menu)],
+                             'Version changed before the reload finished')
+            self.assertTrue(ic.current is not before, 'New version not in use')
+            self.assertEqual(ic.getNetworks({}), menu)
+
+            status = ic.status()
+            self.assertFalse(status['reloading'])
+            self.assertTrue(0 <= status['age'] < 60, 'Wrong age')
+            self.assertEqual(status['networks'], len(before.networks))
+
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testSnapshotHeader(self):
+        "header of the snapshot"
+
+        inventory = os.path.join('..', 'data', 'Arclink-inventory.xml')
+        snapshot = invsnapshot.Snapshot(self.ic.cachefile)
+        snapshot.verify()
+
+        self.assertEqual(snapshot.source, invsnapshot.fingerprint(inventory))
+        self.assertEqual(snapshot.source, self.ic.current.source)
+        self.assertEqual(snapshot.source[0], os.path.getsize(inventory))
+        self.assertTrue(snapshot.built <= time.time(), 'Wrong build time')
+
+    def testFingerprintRecord(self):
+        "XML file read again only when its size or time changed"
+
+        tmpdir = tempfile.mkdtemp()
+        fingerprint = invsnapshot.fingerprint
+        try:
+            path = os.path.join(tmpdir, 'Arclink-inventory.xml')
+            record = os.path.join(tmpdir, 'webinterface-cache.bin.source')
+            with open(path, 'w') as inv:
+                inv.write('<inventory/>')
+
+            source = fingerprint(path)
+            self.assertEqual(invsnapshot.recorded_fingerprint(path, record),
+                             source)
+            self.assertTrue(os.path.exists(record), 'Fingerprint not kept')
+
+            read = []
+            invsnapshot.fingerprint = lambda p: read.append(p) or \
+                fingerprint(p)
+
+            self.assertEqual(invsnapshot.recorded_fingerprint(path, record),
+                             source)
+            self.assertEqual(read, [])
+
+            with open(path, 'a') as inv:
+                inv.write('\n')
+            os.utime(path, (0, 0))
+
+            self.assertEqual(invsnapshot.recorded_fingerprint(path, record),
+                             fingerprint(path))
+            self.assertEqual(read, [path])
+
+        finally:
+            invsnapshot.fingerprint = fingerprint
+            shutil.rmtree(tmpdir)
+
+    def testSnapshotVerifiedOnce(self):
+        "checksum of a snapshot verified only by the first process"
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'webinterface-cache.bin')
+            record = path + '.verified'
+            invsnapshot.write(path, [('networks', invtables.NetworkTable())])
+
+            invsnapshot.Snapshot(path).verifyOnce(record)
+            self.assertTrue(os.path.exists(record), 'Verification not kept')
+
+            # Change a blank of the directory (still valid JSON)
+            with open(path, 'r+b') as fileobj:
+                fileobj.seek(fileobj.read().rindex(', ') + 1)
+                fileobj.write('\t')
+
+            invsnapshot.Snapshot(path).verifyOnce(record)
+
+            os.remove(record)
+            self.assertRaises(invsnapshot.SnapshotError,
+                              invsnapshot.Snapshot(path).verifyOnce, record)
+
+            # Data after the directory
+            with open(path, 'ab') as fileobj:
+                fileobj.write('\0')
+
+            self.assertRaises(invsnapshot.SnapshotError,
+                              invsnapshot.Snapshot, path)
+
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testSnapshotRejected(self):
+        "corrupted and outdated snapshots are not used"
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            inventory = os.path.join(tmpdir, 'Arclink-inventory.xml')
+            shutil.copy('../data/Arclink-inventory.xml', inventory)
+
+            ic = inventorycache.InventoryCache(inventory)
+            size = os.path.getsize(ic.cachefile)
+
+            # Change one byte in the middle of the file
+            with open(ic.cachefile, 'r+b') as fileobj:
+                fileobj.seek(size // 2)
+                byte = fileobj.read(1)
+                fileobj.seek(size // 2)
+                fileobj.write(chr(ord(byte) ^ 0xff))
+
+            self.assertRaises(invsnapshot.SnapshotError,
+                              invsnapshot.Snapshot(ic.cachefile).verify)
+
+            # Another version of the format
+            with open(ic.cachefile, 'r+b') as fileobj:
+                fileobj.seek(8)
+                fileobj.write('\xff\0\0\0')
+
+            self.assertRaises(invsnapshot.SnapshotError,
+                              invsnapshot.Snapshot, ic.cachefile)
+
+            # The inventory is parsed again and the snapshot replaced
+            other = inventorycache.InventoryCache(inventory)
+            self.assertEqual(len(other.networks), len(ic.networks))
+            invsnapshot.Snapshot(other.cachefile).verify()
+
+            # A snapshot of another XML file is not mapped
+            with open(inventory, 'a') as inv:
+                inv.write('\n')
+
+            self.assertNotEqual(invsnapshot.Snapshot(ic.cachefile).source,
+                                invsnapshot.fingerprint(inventory))
+            other = inventorycache.InventoryCache(inventory)
+            self.assertEqual(other.current.source,
+                             invsnapshot.fingerprint(inventory))
+            self.assertEqual(invsnapshot.Snapshot(ic.cachefile).source,
+                             other.current.source)
+
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testGridBox(self):
+        "stations selected by the spatial index in a box"
+
+        st = self.ic.stations
+        for (latmin, latmax, lonmin, lonmax) in ((-90, 90, -180, 180),
+                                                 (30, 60, -10, 40),
+                                                 (-40, 40, 150, -150),
+                                                 (-90, 90, 179.9, -179.9)):
+            expected = set()
+            for i in xrange(len(st)):
+                lat = st.latitude[i]
+                lon = st.longitude[i]
+                if not (latmin <= lat <= latmax):
+                    continue
+                if (lonmin <= lon <= lonmax) if lonmin <= lonmax else \
+                   (lon >= lonmin or lon <= lonmax):
+                    expected.add(i)
+
+            self.assertEqual(self.ic.grid.box(latmin, latmax, lonmin, lonmax),
+                             expected, 'Wrong stations in box %s' %
+                             str((latmin, latmax, lonmin, lonmax)))
+
+
+    def testGridCandidates(self):
+        "stations close to a point are candidates of the spatial index"
+
+        st = self.ic.stations
+        for (lat, lon, radius) in ((45, 10, 10), (0, 179.5, 15),
+                                   (85, -30, 20), (-60, -70, 40)):
+            cand = set(self.ic.grid.candidates(lat, lon, radius))
+            for i in xrange(len(st)):
+                if i in cand:
+                    continue
+
+                dist = seiscomp3.Math.delazi(lat, lon, st.latitude[i],
+                                             st.longitude[i])[0]
+                self.assertFalse(dist < radius, 'Station %s missing around %s'
+                                 % (st.code[i], str((lat, lon, radius))))
+
+
+    def testSharedCodes(self):
+        "sharing of code strings among rows"
+
+        codes = {}
+        if hasattr(self.__class__.ic, 'streams'):
+            for code in self.__class__.ic.streams.code:
+                self.assertTrue(codes.setdefault(code, code) is code, 'Stream code %s is stored more than once.' % code)
+
     def testStreamDatesInStat(self):
         "timespan inclusion of stream w.r.t. station metadata"
 
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#
+# Run unit tests on the streamed JSON responses of webinterface.
+#
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import json
+import unittest
+from unittestTools import WITestRunner
+
+sys.path.append(os.path.join('..', 'wsgi'))  # for wsgicomm
+
+from wsgicomm import JSONStream
+
+
+class JSONStreamTests(unittest.TestCase):
+    """Test the JSONStream of wsgicomm.py
+
+    """
+
+    def setUp(self):
+        self.rows = [['GE', 'APE', 37.07, 25.53, None, True,
+                      {'streams': ['BH', 'HH']}, []]
+                     for i in xrange(50)]
+
+    def testSameAsDumps(self):
+        "same text as json.dumps in every format"
+
+        for kwargs in ({}, {'indent': 4}, {'separators': (',', ':')}):
+            for rows in ([], self.rows[:1], self.rows):
+                text = ''.join(JSONStream(iter(rows), chunksize=100,
+                                          **kwargs))
+                self.assertEqual(text, json.dumps(rows, **kwargs),
+                                 'Wrong text with %s' % str(kwargs))
+
+    def testChunks(self):
+        "text produced in chunks while rows are consumed"
+
+        consumed = []
+
+        def rows():
+            for row in self.rows:
+                consumed.append(row)
+                yield row
+
+        chunks = iter(JSONStream(rows(), chunksize=200))
+        chunks.next()
+        self.assertTrue(0 < len(consumed) < len(self.rows),
+                        'All rows consumed for the first chunk')
+
+    def testComplete(self):
+        "whole text passed to complete if short enough"
+
+        texts = []
+        stream = JSONStream(self.rows, chunksize=100, complete=texts.append,
+                            keep=1000000)
+        self.assertEqual(texts, [])
+        text = ''.join(stream)
+        self.assertEqual(texts, [text])
+
+        texts = []
+        ''.join(JSONStream(self.rows, chunksize=100, complete=texts.append,
+                           keep=1000))
+        self.assertEqual(texts, [])
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testJSONStream [-h] [-p]'
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# Run unit tests on the cache of responses of webinterface.
+#
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import time
+import unittest
+from unittestTools import WITestRunner
+
+sys.path.append(os.path.join('..', 'wsgi'))  # for wsgicomm
+
+from lrucache import LRUCache
+
+
+class LRUCacheTests(unittest.TestCase):
+    """Test the functionality of lrucache.py
+
+    """
+
+    def testHitsAndMisses(self):
+        "values stored and counters of hits and misses"
+
+        cache = LRUCache(100, 60)
+        self.assertEqual(cache.get('a'), None)
+        cache.put('a', 'x' * 10)
+        self.assertEqual(cache.get('a'), 'x' * 10)
+        self.assertEqual(cache.get('b'), None)
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+        self.assertEqual((stats['entries'], stats['size']), (1, 10))
+
+    def testLeastRecentlyUsed(self):
+        "least recently used entries dropped when full"
+
+        cache = LRUCache(30, 60)
+        for key in 'abc':
+            cache.put(key, key * 10)
+
+        # "a" is now the most recently used
+        cache.get('a')
+        cache.put('d', 'd' * 10)
+
+        self.assertEqual(cache.get('b'), None, 'Wrong entry dropped')
+        for key in 'acd':
+            self.assertEqual(cache.get(key), key * 10)
+
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['size'], 30)
+
+    def testReplace(self):
+        "value replaced under the same key"
+
+        cache = LRUCache(30, 60)
+        cache.put('a', 'x' * 20)
+        cache.put('a', 'y' * 25)
+        self.assertEqual(cache.get('a'), 'y' * 25)
+        self.assertEqual(cache.stats()['size'], 25)
+
+    def testTooLarge(self):
+        "values larger than the cache are not stored"
+
+        cache = LRUCache(10, 60)
+        cache.put('a', 'x' * 5)
+        cache.put('b', 'x' * 11)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'x' * 5)
+
+        disabled = LRUCache(0, 60)
+        disabled.put('a', 'x')
+        self.assertEqual(len(disabled), 0)
+
+    def testExpiry(self):
+        "entries expire after ttl seconds"
+
+        cache = LRUCache(100, 0.05)
+        cache.put('a', 'x')
+        self.assertEqual(cache.get('a'), 'x')
+        time.sleep(0.1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def testSizeof(self):
+        "size of values measured by a function"
+
+        cache = LRUCache(2, None, lambda value: 1)
+        for key in 'abc':
+            cache.put(key, {'P': 1.0})
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('c'), {'P': 1.0})
+        self.assertEqual(cache.stats()['size'], 2)
+
+    def testNoExpiry(self):
+        "entries kept while there is room if ttl is None"
+
+        cache = LRUCache(100, None)
+        cache.put('a', 'x')
+        time.sleep(0.05)
+        self.assertEqual(cache.get('a'), 'x')
+
+    def testEntryTTL(self):
+        "expiry given for every entry"
+
+        cache = LRUCache(100, 0.05)
+        cache.put('a', 'x', None)
+        cache.put('b', 'y', 60)
+        cache.put('c', 'z')
+        time.sleep(0.1)
+        self.assertEqual([cache.get(k) for k in 'abc'], ['x', 'y', None])
+
+    def testClear(self):
+        "all entries dropped"
+
+        cache = LRUCache(100, 60)
+        cache.put('a', 'x')
+        cache.put('b', 'y')
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get('a'), None)
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testLRUCache [-h] [-p]'
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
@@ -146,7 +146,7 @@ class TestMetadataTimewindows(unittest.TestCase):
         qs = urllib.urlencode(params)
         env = {'PATH_INFO': 'metadata/timewindows', 'QUERY_STRING': qs}
 
-        response = mod.timewindows(env, params)
+        response = ''.join(mod.timewindows(env, params))
         if test_verbosity:
             print "QS:", qs
             print "params:", params
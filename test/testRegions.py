@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# Run unit tests on the region names of events of webinterface.
+#
+# ----------------------------------------------------------------------
+
+import math
+import os
+import sys
+import unittest
+from unittestTools import WITestRunner
+
+sys.path.append(os.path.join('..', 'wsgi'))  # for wsgicomm
+
+from regions import RegionResolver
+
+
+class Regions(object):
+    """Regions of whole degrees, as Flinn-Engdahl, which count the objects
+    created and the points looked up.
+
+    """
+
+    created = 0
+
+    def __init__(self):
+        Regions.created += 1
+        self.lookups = []
+
+    def getRegionName(self, lat, lon):
+        self.lookups.append((lat, lon))
+        return '%i/%i' % (math.floor(lat), math.floor(lon))
+
+
+class RegionsTests(unittest.TestCase):
+    """Test the functionality of regions.py
+
+    """
+
+    def setUp(self):
+        Regions.created = 0
+        self.resolver = RegionResolver(Regions)
+
+    def testCells(self):
+        "points of a cell looked up once, with the name of their region"
+
+        points = [(37.0701, 25.5301), (37.0709, 25.5309), (37.07, 25.53),
+                  (-0.004, -0.004), (-0.001, -0.009), (0.0, 0.0),
+                  (89.999, 179.999), (90, 180), (-90, -180),
+                  (10.99, -10.01), (10.999999, -10.000001)]
+        for (lat, lon) in points:
+            self.assertEqual(self.resolver.name(lat, lon),
+                             '%i/%i' % (math.floor(lat), math.floor(lon)),
+                             'Wrong region of %s %s' % (lat, lon))
+
+        self.assertEqual(Regions.created, 1)
+        stats = self.resolver.stats()
+        self.assertEqual((stats['lookups'], stats['hits']), (7, 4))
+
+        # Strings, as in the rows of the event services
+        self.assertEqual(self.resolver.name('37.0705', '25.5305'), '37/25')
+        self.assertEqual(self.resolver.stats()['lookups'], 7)
+
+        self.assertEqual(self.resolver.name('', '25.53'), None)
+        self.assertEqual(self.resolver.name(None, 25.53), None)
+
+    def testNames(self):
+        "many points resolved at once"
+
+        lats = [10.001 * (i % 7) for i in xrange(800)]
+        lons = [-20.001 * (i % 5) for i in xrange(800)]
+        lats[3] = 'x'
+
+        names = self.resolver.names(lats, lons)
+        self.assertEqual(len(names), 800)
+        self.assertEqual(names[3], None)
+        self.assertEqual(names[:3] + names[4:],
+                         [self.resolver.name(lat, lon)
+                          for (lat, lon) in zip(lats, lons)
+                          if lat != 'x'])
+
+        # 7 * 5 cells, one lookup each
+        self.assertEqual(self.resolver.stats()['lookups'], 35)
+        self.assertEqual(self.resolver.names([], []), [])
+
+    def testExact(self):
+        "every point looked up at its own coordinates without cells"
+
+        resolver = RegionResolver(Regions, step=0)
+        for (lat, lon) in ((37.0701, 25.5301), (37.0709, 25.5309),
+                           (37.0701, 25.5301)):
+            self.assertEqual(resolver.name(lat, lon), '37/25')
+
+        self.assertEqual(resolver.names(['37.0709', 'x'], ['25.5309', '0']),
+                         ['37/25', None])
+        self.assertEqual(resolver.stats()['lookups'], 2)
+        self.assertEqual(resolver._RegionResolver__regions.lookups,
+                         [(37.0701, 25.5301), (37.0709, 25.5309)])
+
+    def testEviction(self):
+        "least recently used cells dropped"
+
+        resolver = RegionResolver(Regions, maxsize=2)
+        for lat in (1, 2, 1, 3, 2):
+            resolver.name(lat, 0)
+
+        stats = resolver.stats()
+        self.assertEqual((stats['entries'], stats['lookups'],
+                          stats['evictions']), (2, 4, 2))
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testRegions [-h] [-p]'
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#
+# Run unit tests on the dispatch of requests of webinterface.
+#
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import unittest
+from unittestTools import WITestRunner
+
+sys.path.append(os.path.join('..', 'wsgi'))  # for wsgicomm
+
+from router import Router, Request
+from formdata import parseParameters
+
+
+class RouterTests(unittest.TestCase):
+    """Test the functionality of router.py
+
+    """
+
+    def setUp(self):
+        self.router = Router()
+        for route in ('/metadata/networks', '/event/catalogs',
+                      '/event/{service}', '/event/{service}/{id}/detail',
+                      '/{module}/status'):
+            self.router.add(route)
+
+    def testFixed(self):
+        "fixed paths before templates"
+
+        self.assertEqual(self.router.match('/metadata/networks'),
+                         ('/metadata/networks', {}))
+        self.assertEqual(self.router.match('/event/catalogs'),
+                         ('/event/catalogs', {}))
+
+    def testTemplates(self):
+        "parameters taken from the path"
+
+        self.assertEqual(self.router.match('/event/geofon'),
+                         ('/event/{service}', {'service': 'geofon'}))
+        self.assertEqual(self.router.match('/event/emsc/1234/detail'),
+                         ('/event/{service}/{id}/detail',
+                          {'service': 'emsc', 'id': '1234'}))
+        self.assertEqual(self.router.match('/metadata/status'),
+                         ('/{module}/status', {'module': 'metadata'}))
+
+    def testNoMatch(self):
+        "paths without a route"
+
+        for path in ('', '/', '/favicon.ico', '/event', '/event/',
+                     '/event/geofon/extra', '/event/emsc/1234/summary',
+                     '/metadata/networks/'):
+            self.assertEqual(self.router.match(path), None, path)
+
+        self.assertRaises(ValueError, self.router.add, '/event/{service')
+
+    def testRequest(self):
+        "parameters parsed once, single or multiple values"
+
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/event/geofon',
+                   'QUERY_STRING': 'start=2015-01-01&net=GE&net=II&x='}
+        query = parseParameters(environ)
+        self.assertEqual(query, {'start': ['2015-01-01'],
+                                 'net': ['GE', 'II']})
+
+        request = Request(environ, '/event/{service}', {'service': 'geofon'},
+                          query, set(['net']))
+        self.assertEqual(request, {'start': '2015-01-01',
+                                   'net': ['GE', 'II']})
+        self.assertEqual(request.args['service'], 'geofon')
+        self.assertTrue(request.query is query)
+        self.assertEqual((request.method, request.path),
+                         ('GET', '/event/geofon'))
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testRouter [-h] [-p]'
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# Run unit tests on the interpolated travel times of webinterface.
+#
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import math
+import unittest
+from unittestTools import WITestRunner
+
+sys.path.append(os.path.join('..', 'wsgi'))  # for wsgicomm
+
+import geodist
+import traveltimes
+import seiscomp3.Seismology
+
+
+class Arrival(object):
+    def __init__(self, phase, time):
+        self.phase = phase
+        self.time = time
+
+
+class FakeTravelTimeTable(object):
+    """Smooth, nonlinear arrivals of a few phases. No PKP closer than 110
+    degrees.
+
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    def compute(self, lat1, lon1, dep1, lat2, lon2, alt2):
+        self.calls += 1
+        d = geodist.delazi([lat1], [lon1], [lat2], [lon2])[0][0][0]
+
+        ttlist = [Arrival('Pn', 60 * math.sqrt(d + 1) + dep1 / 7.0),
+                  Arrival('pP', 60 * math.sqrt(d + 1) + dep1 / 3.0),
+                  Arrival('Sn', 110 * math.sqrt(d + 1) + dep1 / 4.0)]
+        if d >= 110:
+            ttlist.append(Arrival('PKPdf', 1100 + d - dep1 / 8.0))
+
+        return sorted(ttlist, key=lambda tt: tt.time)
+
+
+class TravelTimesTests(unittest.TestCase):
+    """Test the functionality of traveltimes.py
+
+    """
+
+    def setUp(self):
+        self.ttt = FakeTravelTimeTable()
+        self.grid = traveltimes.TravelTimeGrid(self.ttt, 2.0,
+                                               (0, 10, 50, 200, 700))
+
+    def testFirstArrivals(self):
+        "first arrival of every family of phases"
+
+        ttlist = [Arrival('pP', 10.0), Arrival('Pn', 11.0),
+                  Arrival('P', 12.0), Arrival('SKSac', 20.0),
+                  Arrival('S', 21.0), Arrival('PKiKP', 30.0)]
+
+        self.assertEqual(traveltimes.firstArrivals(ttlist),
+                         {'OT': 0, 'P': 11.0, 'S': 20.0, 'PKP': 30.0})
+        self.assertEqual(traveltimes.firstArrivals([]), {})
+
+    def testNodes(self):
+        "exact arrivals at the nodes of the grid"
+
+        for (d, z) in ((0, 0), (2, 10), (90, 50), (112, 200), (180, 700)):
+            exact = traveltimes.firstArrivals(self.ttt.compute(0, 0, z, 0, d,
+                                                               0))
+            for fam in traveltimes.FAMILIES:
+                t = self.grid.lookup(fam, [d], [z])[0]
+                if fam in exact:
+                    self.assertAlmostEqual(t, exact[fam], 6)
+                else:
+                    self.assertEqual(t, None, 'Arrival of %s where it does '
+                                     'not exist' % fam)
+
+    def testBilinear(self):
+        "interpolation between the four nodes around a point"
+
+        corners = self.grid.lookup('S', [40, 42, 40, 42], [10, 10, 50, 50])
+        t = self.grid.lookup('S', [41.5], [20])[0]
+
+        (u, v) = (0.25, 0.75)
+        expected = (1 - u) * ((1 - v) * corners[0] + v * corners[1]) + \
+            u * ((1 - v) * corners[2] + v * corners[3])
+        self.assertAlmostEqual(t, expected, 6)
+
+    def testOutside(self):
+        "no arrivals outside the grid or next to missing nodes"
+
+        self.assertEqual(self.grid.lookup('P', [-1, 181, 10, 10],
+                                          [10, 10, -5, 701]),
+                         [None] * 4)
+
+        # Node at 110 degrees has PKP, the one at 108 does not
+        self.assertEqual(self.grid.lookup('PKP', [109], [0]), [None])
+        self.assertNotEqual(self.grid.lookup('PKP', [111], [0]), [None])
+
+    def testPurePython(self):
+        "same arrivals with and without NumPy"
+
+        deltas = [0.3 * i for i in xrange(601)]
+        depths = [(7.7 * i) % 700 for i in xrange(601)]
+        expected = dict((fam, self.grid.lookup(fam, deltas, depths))
+                        for fam in traveltimes.FAMILIES)
+
+        saved = traveltimes.numpy
+        traveltimes.numpy = None
+        try:
+            grid = traveltimes.TravelTimeGrid(self.ttt, 2.0,
+                                              (0, 10, 50, 200, 700))
+            for fam in traveltimes.FAMILIES:
+                got = grid.lookup(fam, deltas, depths)
+                for t1, t2 in zip(got, expected[fam]):
+                    if t2 is None:
+                        self.assertEqual(t1, None)
+                    else:
+                        self.assertAlmostEqual(t1, t2, 6)
+        finally:
+            traveltimes.numpy = saved
+
+    def testValidate(self):
+        "interpolated arrivals close to those of compute()"
+
+        ttt = seiscomp3.Seismology.TravelTimeTable()
+        grid = traveltimes.TravelTimeGrid(ttt)
+
+        points = []
+        for ev_dep in (3.0, 33.0, 97.5, 410.0):
+            for st_lon in (0.5, 17.3, 44.4, 89.9, 101.1, 133.7, 170.2):
+                (lat, lon) = (-4.2, 12.1)
+                delta = geodist.delazi([lat], [lon], [lat], [lon + st_lon])
+                points.append((lat, lon, ev_dep, lat, lon + st_lon, 0.0,
+                               delta[0][0][0]))
+
+        errors = grid.validate(ttt, points)
+        for fam in ('P', 'S'):
+            (count, maxdiff) = errors[fam]
+            self.assertTrue(count > 0, 'No %s arrivals compared' % fam)
+            self.assertTrue(maxdiff < 1.0, 'Interpolated %s arrivals off by '
+                            '%.2f s' % (fam, maxdiff))
+
+
+# ----------------------------------------------------------------------
+def usage():
+    print 'testTravelTimes [-h] [-p]'
+
+
+if __name__ == '__main__':
+
+    # 0=Plain mode (good for printing); 1=Colourful mode
+    mode = 1
+
+    for ind, arg in enumerate(sys.argv):
+        if arg in ('-p', '--plain'):
+            del sys.argv[ind]
+            mode = 0
+        elif arg in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+
+    unittest.main(testRunner=WITestRunner(mode=mode))
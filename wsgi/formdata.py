@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+#
+# Parameters of the requests of the web interface
+#
+# ----------------------------------------------------------------------
+
+
+"""Parameters of the requests of the web interface
+
+Copyright (C) 2016 GEOFON team, Helmholtz-Zentrum Potsdam - Deutsches GeoForschungsZentrum GFZ
+
+parseParameters() gives the parameters of a request as a dictionary
+name -> list of values. GET requests only have the query string. The
+bodies of other requests (application/x-www-form-urlencoded or
+multipart/form-data) are read in blocks and parsed as they arrive, never
+reading more than the size allowed for the action: a request announcing a
+longer body is refused before reading it, and BodyTooLarge is raised.
+
+Fields which may be large, e.g. an uploaded list of stations, are named by
+the action. Their values are Upload objects, kept in a temporary file once
+they exceed SPOOL_SIZE, which give their lines when iterated. All other
+values are strings. A malformed body raises ValueError.
+
+
+This program is free software; you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 2, or (at your option) any later
+version. For more information, see http://www.gnu.org/
+
+"""
+
+import cgi
+import tempfile
+import urllib
+
+# Bytes read from the client at a time
+BLOCK_SIZE = 65536
+
+# Uploads larger than this are kept in a temporary file
+SPOOL_SIZE = 1024 * 1024
+
+# Longest header block of a part of a multipart body
+MAX_HEADERS = 16384
+
+
+class BodyTooLarge(ValueError):
+    def __init__(self, maxsize):
+        ValueError.__init__(self, "Maximum content length exceeded")
+        self.maxsize = maxsize
+
+
+class Upload(object):
+    """Value of a field which may be large.
+
+    Iterating gives its lines, including the line ends, as a file does;
+    read() and str() give all of it. filename and content_type are those
+    of the part of a multipart body, or None.
+
+    """
+
+    def __init__(self, filename=None, content_type=None):
+        self.filename = filename
+        self.content_type = content_type
+        self.size = 0
+        self.__file = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+
+    def write(self, data):
+        self.__file.write(data)
+        self.size += len(data)
+
+    def read(self):
+        self.__file.seek(0)
+        return self.__file.read()
+
+    def __iter__(self):
+        self.__file.seek(0)
+        return iter(self.__file)
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return self.read()
+
+    def close(self):
+        self.__file.close()
+
+
+def _blocks(environ, maxsize):
+    """Blocks of the body of a request, at most maxsize bytes in total."""
+
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        raise ValueError('Invalid Content-Length')
+
+    if maxsize is not None and length > maxsize:
+        raise BodyTooLarge(maxsize)
+
+    stream = environ['wsgi.input']
+    while length > 0:
+        block = stream.read(min(length, BLOCK_SIZE))
+        if not block:
+            break
+
+        length -= len(block)
+        yield block
+
+
+class _Field(object):
+    """Value of a field while it is parsed."""
+
+    def __init__(self, name, upload):
+        self.name = name
+        self.upload = upload
+        self.parts = []
+
+    def write(self, data):
+        if self.upload is not None:
+            self.upload.write(data)
+        elif data:
+            self.parts.append(data)
+
+    def value(self):
+        if self.upload is not None:
+            return self.upload
+
+        return ''.join(self.parts)
+
+
+def _parseURLEncoded(blocks, uploads, result):
+    """Fields of an application/x-www-form-urlencoded body, as
+    cgi.parse_qs() without keep_blank_values.
+
+    """
+
+    def finish(field):
+        value = field.value()
+        if len(value):
+            result.setdefault(field.name, []).append(value)
+
+    field = None
+    buf = ''
+    for block in blocks:
+        buf += block
+
+        while buf:
+            if field is None:
+                i = min(buf.find(c) if c in buf else len(buf) for c in '=&;')
+                if i == len(buf):
+                    # Name not complete yet
+                    break
+
+                if buf[i] == '=':
+                    name = urllib.unquote_plus(buf[:i])
+                    field = _Field(name, Upload() if name in uploads else None)
+
+                # A name without "=" is ignored
+                buf = buf[i + 1:]
+                continue
+
+            i = min(buf.find(c) if c in buf else len(buf) for c in '&;')
+            if i == len(buf):
+                # Decode what has arrived, except an incomplete escape
+                cut = buf.find('%', len(buf) - 2)
+                if cut < 0:
+                    cut = len(buf)
+                field.write(urllib.unquote_plus(buf[:cut]))
+                buf = buf[cut:]
+                break
+
+            field.write(urllib.unquote_plus(buf[:i]))
+            finish(field)
+            field = None
+            buf = buf[i + 1:]
+
+    if field is not None:
+        field.write(urllib.unquote_plus(buf))
+        finish(field)
+
+
+def _parseMultipart(blocks, boundary, uploads, result):
+    """Fields of a multipart/form-data body."""
+
+    delimiter = '\r\n--' + boundary
+    keep = len(delimiter) - 1
+
+    # The first delimiter may be at the very beginning
+    buf = '\r\n'
+    field = None
+    state = 'preamble'
+
+    blocks = iter(blocks)
+    eof = False
+    while True:
+        if state in ('preamble', 'content'):
+            i = buf.find(delimiter)
+            if i >= 0:
+                if field is not None:
+                    field.write(buf[:i])
+                    result.setdefault(field.name, []).append(field.value())
+                    field = None
+
+                buf = buf[i + len(delimiter):]
+                state = 'delimiter'
+                continue
+
+            # Keep what may be the beginning of a delimiter
+            if len(buf) > keep:
+                if field is not None:
+                    field.write(buf[:-keep])
+                buf = buf[-keep:]
+
+        elif state == 'delimiter':
+            if buf.startswith('--'):
+                # Close delimiter, the rest is the epilogue
+                return
+
+            i = buf.find('\r\n')
+            if i >= 0:
+                buf = buf[i + 2:]
+                state = 'headers'
+                continue
+
+        elif state == 'headers':
+            i = buf.find('\r\n\r\n')
+            if i >= 0 or buf.startswith('\r\n'):
+                if buf.startswith('\r\n'):
+                    (headers, buf) = ('', buf[2:])
+                else:
+                    (headers, buf) = (buf[:i], buf[i + 4:])
+
+                field = _newField(headers, uploads)
+                state = 'content'
+                continue
+
+            if len(buf) > MAX_HEADERS:
+                raise ValueError('Headers of multipart body too long')
+
+        if eof:
+            raise ValueError('Incomplete multipart body')
+
+        try:
+            buf += blocks.next()
+        except StopIteration:
+            eof = True
+
+
+def _newField(headers, uploads):
+    params = {}
+    content_type = None
+    for line in headers.split('\r\n'):
+        (name, sep, value) = line.partition(':')
+        name = name.strip().lower()
+        if name == 'content-disposition':
+            params = cgi.parse_header(value.strip())[1]
+        elif name == 'content-type':
+            content_type = value.strip()
+
+    if 'name' not in params:
+        raise ValueError('Part of multipart body without a name')
+
+    name = params['name']
+    if name in uploads:
+        return _Field(name, Upload(params.get('filename'), content_type))
+
+    return _Field(name, None)
+
+
+def parseParameters(environ, maxsize=None, uploads=()):
+    """Parameters of a request, as a dictionary name -> list of values.
+
+    The body of the request may not be longer than maxsize bytes (None
+    for no limit). The values of the fields named in uploads are Upload
+    objects. Values of the query string come after those of a
+    form-encoded body and before those of a multipart body, as with
+    cgi.FieldStorage. Bodies of other content types are not read.
+
+    """
+
+    qs = environ.get('QUERY_STRING')
+    query = cgi.parse_qs(qs) if qs else {}
+
+    if environ.get('REQUEST_METHOD', 'GET') in ('GET', 'HEAD'):
+        return query
+
+    (ctype, params) = cgi.parse_header(environ.get('CONTENT_TYPE', ''))
+    if ctype == 'application/x-www-form-urlencoded':
+        result = {}
+        _parseURLEncoded(_blocks(environ, maxsize), uploads, result)
+        for (name, values) in query.iteritems():
+            result.setdefault(name, []).extend(values)
+
+        return result
+
+    elif ctype == 'multipart/form-data':
+        if not params.get('boundary'):
+            raise ValueError('Multipart body without boundary')
+
+        _parseMultipart(_blocks(environ, maxsize), params['boundary'],
+                        uploads, query)
+
+    return query
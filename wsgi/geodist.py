@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#
+# Distances and azimuths between many points at once
+#
+# ----------------------------------------------------------------------
+
+
+"""Distances and azimuths between many points at once
+
+Copyright (C) 2016 GEOFON team, Helmholtz-Zentrum Potsdam - Deutsches GeoForschungsZentrum GFZ
+
+seiscomp3.Math.delazi works on one pair of points per call, which is slow
+when the stations around many events have to be found. delazi() in this
+module takes two sets of points, given as sequences of latitudes and
+longitudes, and computes the matrices of distances and azimuths between
+every point of the first set and every point of the second one.
+
+If NumPy is available the matrices are computed with array operations.
+Otherwise the same formulas are evaluated in pure Python and the matrices
+are lists of lists.
+
+The Earth is a sphere, as in seiscomp3.Math.delazi. Distances are computed
+with the arctangent formula (accurate also close to 0 and 180 degrees).
+Distances and azimuths agree with those of Math.delazi within TOLERANCE
+degrees, so only pairs lying just at a limit of a filter can be selected
+differently.
+
+
+This program is free software; you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 2, or (at your option) any later
+version. For more information, see http://www.gnu.org/
+
+"""
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Maximum difference (in degrees) with seiscomp3.Math.delazi
+TOLERANCE = 1e-6
+
+# Maximum number of pairs computed at once by reached()
+CHUNK = 1 << 18
+
+
+def delazi(lat1, lon1, lat2, lon2):
+    """Distances and azimuths from every point of the first set to every
+    point of the second set.
+
+    Returns (DIST, AZI), two matrices with one row per point of the first
+    set and one column per point of the second set. DIST[i][j] and
+    AZI[i][j] are the great-circle distance between points i and j and the
+    azimuth of point j seen from point i, both in degrees, as
+    Math.delazi(lat1[i], lon1[i], lat2[j], lon2[j])[:2].
+
+    """
+
+    if numpy is not None:
+        return _delazi_numpy(lat1, lon1, lat2, lon2)
+
+    return _delazi_python(lat1, lon1, lat2, lon2)
+
+
+def _delazi_numpy(lat1, lon1, lat2, lon2):
+    p1 = numpy.radians(numpy.asarray(lat1, dtype=float))[:, numpy.newaxis]
+    l1 = numpy.radians(numpy.asarray(lon1, dtype=float))[:, numpy.newaxis]
+    p2 = numpy.radians(numpy.asarray(lat2, dtype=float))[numpy.newaxis, :]
+    l2 = numpy.radians(numpy.asarray(lon2, dtype=float))[numpy.newaxis, :]
+
+    sin1 = numpy.sin(p1)
+    cos1 = numpy.cos(p1)
+    sin2 = numpy.sin(p2)
+    cos2 = numpy.cos(p2)
+
+    dl = l2 - l1
+    sindl = numpy.sin(dl)
+    cosdl = numpy.cos(dl)
+
+    # East and north components of the direction to the second point
+    x = sindl * cos2
+    y = cos1 * sin2 - sin1 * cos2 * cosdl
+
+    dist = numpy.degrees(numpy.arctan2(numpy.hypot(x, y),
+                                       sin1 * sin2 + cos1 * cos2 * cosdl))
+    azi = numpy.degrees(numpy.arctan2(x, y)) % 360.0
+
+    return (dist, azi)
+
+
+def _delazi_python(lat1, lon1, lat2, lon2):
+    sin = math.sin
+    cos = math.cos
+    atan2 = math.atan2
+    hypot = math.hypot
+    degrees = math.degrees
+
+    p2 = [math.radians(lat) for lat in lat2]
+    l2 = [math.radians(lon) for lon in lon2]
+    sin2 = [sin(p) for p in p2]
+    cos2 = [cos(p) for p in p2]
+
+    dist = []
+    azi = []
+    for lat, lon in zip(lat1, lon1):
+        p1 = math.radians(lat)
+        l1 = math.radians(lon)
+        sin1 = sin(p1)
+        cos1 = cos(p1)
+
+        rowdist = []
+        rowazi = []
+        for j in xrange(len(p2)):
+            dl = l2[j] - l1
+            cosdl = cos(dl)
+            x = sin(dl) * cos2[j]
+            y = cos1 * sin2[j] - sin1 * cos2[j] * cosdl
+
+            rowdist.append(degrees(atan2(hypot(x, y),
+                                         sin1 * sin2[j] +
+                                         cos1 * cos2[j] * cosdl)))
+            rowazi.append(degrees(atan2(x, y)) % 360.0)
+
+        dist.append(rowdist)
+        azi.append(rowazi)
+
+    return (dist, azi)
+
+
+def reached(lat1, lon1, lat2, lon2, minradius=None, maxradius=None,
+            minazimuth=None, maxazimuth=None):
+    """Tell which points of the first set have at least one point of the
+    second set within the given limits.
+
+    A point j of the second set is within the limits of point i of the
+    first set if their distance is between minradius and maxradius and the
+    azimuth of j seen from i is between minazimuth and maxazimuth. Limits
+    are excluded and a limit which is None is not checked.
+
+    Returns a list of booleans, one per point of the first set. Points
+    without coordinates (NaN) are never reached. Large sets are processed
+    by blocks of the second set, so that the matrices stay small.
+
+    """
+
+    n = len(lat1)
+    result = [False] * n
+    if not n or not len(lat2):
+        return result
+
+    step = max(1, CHUNK // n)
+    for first in xrange(0, len(lat2), step):
+        (dist, azi) = delazi(lat1, lon1, lat2[first:first + step],
+                             lon2[first:first + step])
+
+        if numpy is not None:
+            ok = numpy.ones(dist.shape, dtype=bool)
+            if minradius is not None:
+                ok &= dist > minradius
+            if maxradius is not None:
+                ok &= dist < maxradius
+            if minazimuth is not None:
+                ok &= azi > minazimuth
+            if maxazimuth is not None:
+                ok &= azi < maxazimuth
+
+            for i in numpy.flatnonzero(ok.any(axis=1)):
+                result[i] = True
+
+            continue
+
+        for i in xrange(n):
+            if result[i]:
+                continue
+
+            for d, a in zip(dist[i], azi[i]):
+                if (minradius is None or minradius < d) and \
+                   (maxradius is None or d < maxradius) and \
+                   (minazimuth is None or minazimuth < a) and \
+                   (maxazimuth is None or a < maxazimuth):
+                    result[i] = True
+                    break
+
+    return result
@@ -0,0 +1,639 @@
+#!/usr/bin/env python
+#
+# Persistent HTTP connections to the services queried by the web interface
+#
+# ----------------------------------------------------------------------
+
+
+"""Persistent HTTP connections to the services queried by the web interface
+
+Copyright (C) 2016 GEOFON team, Helmholtz-Zentrum Potsdam - Deutsches GeoForschungsZentrum GFZ
+
+A ConnectionPool keeps the connections to every server open after a
+request (HTTP keep-alive) and reuses them for the next ones, saving the
+TCP and TLS setup. It is shared by all the threads of a process: a
+connection is used by one request at a time, and at most maxidle idle
+connections are kept per server. A request on a connection which the
+server has closed meanwhile is repeated once on a new one. Redirections
+are followed and the proxies of the environment (http_proxy, ...) are
+used, as urllib2 does.
+
+An Upstream is a server queried through the pool, with its own timeouts
+(to connect and to wait for data) and a limit on the number of requests
+sent to it at the same time. Errors are reported as urllib2 does: an
+urllib2.HTTPError for an HTTP status of 400 or more, an urllib2.URLError
+if there is no answer.
+
+The body of a response opened with open() instead of get() is a Body,
+read from its connection only as its lines are iterated over: the
+connection goes back to the pool when the body was read to the end, and
+is closed if the Body is closed before, so that a large response is not
+read only to be dropped.
+
+A ResponseCache keeps the bodies of responses under their URL, each for
+its own number of seconds, and lets concurrent requests of the same URL
+share a single one to the server. Its open() streams the responses
+which are not kept, those not to be cached and those above a size.
+
+
+This program is free software; you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 2, or (at your option) any later
+version. For more information, see http://www.gnu.org/
+
+"""
+
+import httplib
+import socket
+import sys
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+from StringIO import StringIO
+
+from lrucache import LRUCache
+
+# Defaults of an Upstream: seconds to connect, seconds to wait for data
+# and number of requests at the same time
+CONNECT_TIMEOUT = 10
+TIMEOUT = 60
+CONCURRENCY = 4
+
+MAX_REDIRECTS = 5
+USER_AGENT = 'Python-urllib/%i.%i (webdc3)' % sys.version_info[0:2]
+
+# Bytes read from the connection at a time by a Body
+BLOCK_SIZE = 65536
+
+
+class Response(object):
+    """Status, headers (an httplib.HTTPMessage) and body of a response, and
+    the URL it came from after redirections.
+
+    """
+
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+
+class Body(object):
+    """Lines of the body of a response, read from its connection as they
+    are iterated over, after those of prefix.
+
+    close() calls done(complete) once, complete being whether the body
+    was read to the end; this happens by itself at the end of the body.
+    A Body without a response has only the lines of prefix.
+
+    """
+
+    def __init__(self, prefix='', response=None, done=None):
+        self.__buffer = prefix
+        self.__pos = 0
+        self.__response = response
+        self.__done = done
+
+    def __fill(self):
+        """Read more of the body into the buffer; False at its end."""
+
+        if self.__response is None:
+            return False
+
+        try:
+            data = self.__response.read(BLOCK_SIZE)
+
+        except (socket.error, httplib.HTTPException), e:
+            self.close()
+            if isinstance(e, socket.timeout):
+                raise urllib2.URLError('timed out')
+
+            raise urllib2.URLError(e)
+
+        if not data:
+            self.close()
+            return False
+
+        self.__buffer = self.__buffer[self.__pos:] + data
+        self.__pos = 0
+        return True
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while True:
+            end = self.__buffer.find('\n', self.__pos) + 1
+            if end or not self.__fill():
+                break
+
+        if not end:
+            end = len(self.__buffer)
+            if end == self.__pos:
+                raise StopIteration
+
+        line = self.__buffer[self.__pos:end]
+        self.__pos = end
+        return line
+
+    def peek(self, size):
+        """Up to size bytes at the start of what is left of the body,
+        which are still read by the iteration. Fewer bytes are returned
+        only at the end of the body.
+
+        """
+
+        while len(self.__buffer) - self.__pos < size and self.__fill():
+            pass
+
+        return self.__buffer[self.__pos:self.__pos + size]
+
+    def close(self):
+        if self.__response is None:
+            return
+
+        response = self.__response
+        self.__response = None
+        if self.__done is not None:
+            self.__done(response.isclosed())
+
+
+class ConnectionPool(object):
+    """Idle connections to HTTP servers, reused by later requests."""
+
+    def __init__(self, maxidle=4):
+        self.maxidle = maxidle
+
+        # (scheme, host, port, proxy) -> list of idle connections
+        self.__idle = {}
+        self.__lock = threading.Lock()
+
+        self.__requests = 0
+        self.__connections = 0
+        self.__reused = 0
+        self.__errors = 0
+
+    def __route(self, url):
+        """Key of the connections for url and the target of the request."""
+
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ('http', 'https'):
+            raise urllib2.URLError('unknown url type: %s' % scheme)
+
+        host = parts.hostname
+        if not host:
+            raise urllib2.URLError('no host given: %s' % url)
+
+        port = parts.port or (443 if scheme == 'https' else 80)
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query,
+                                    ''))
+
+        proxy = urllib.getproxies().get(scheme)
+        if proxy and not urllib.proxy_bypass(host):
+            proxy = urlparse.urlsplit(proxy).netloc or proxy
+            if scheme == 'http':
+                # The proxy takes the whole URL
+                path = urlparse.urlunsplit(('http', '%s:%i' % (host, port),
+                                            parts.path or '/', parts.query,
+                                            ''))
+        else:
+            proxy = None
+
+        return ((scheme, host, port, proxy), path)
+
+    def __connect(self, key, connect_timeout, timeout):
+        (scheme, host, port, proxy) = key
+
+        if scheme == 'https':
+            cls = httplib.HTTPSConnection
+        else:
+            cls = httplib.HTTPConnection
+
+        if proxy:
+            conn = cls(proxy, timeout=connect_timeout)
+            if scheme == 'https':
+                conn.set_tunnel(host, port)
+        else:
+            conn = cls(host, port, timeout=connect_timeout)
+
+        conn.connect()
+        conn.sock.settimeout(timeout)
+
+        with self.__lock:
+            self.__connections += 1
+
+        return conn
+
+    def __take(self, key):
+        with self.__lock:
+            idle = self.__idle.get(key)
+            if idle:
+                self.__reused += 1
+                return idle.pop()
+
+        return None
+
+    def __give(self, key, conn):
+        with self.__lock:
+            idle = self.__idle.setdefault(key, [])
+            if len(idle) < self.maxidle:
+                idle.append(conn)
+                return
+
+        conn.close()
+
+    def __finish(self, key, conn, response, complete):
+        """Give conn back after response, unless it was not read to the
+        end or the server closes it.
+
+        """
+
+        if complete and not response.will_close:
+            self.__give(key, conn)
+        else:
+            conn.close()
+
+    def __send(self, key, path, headers, connect_timeout, timeout,
+               stream=False):
+        """(connection, response, body) of a request; the body is None
+        and the response left to be read if stream, otherwise the
+        connection is already given back.
+
+        """
+
+        conn = self.__take(key)
+        reused = conn is not None
+
+        try:
+            if conn is None:
+                conn = self.__connect(key, connect_timeout, timeout)
+            else:
+                conn.sock.settimeout(timeout)
+
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            body = None if stream else response.read()
+
+        except (socket.error, httplib.HTTPException), e:
+            if conn is not None:
+                conn.close()
+
+            # Closed by the server while it was idle
+            if reused and not isinstance(e, socket.timeout):
+                return self.__send(key, path, headers, connect_timeout,
+                                   timeout, stream)
+
+            with self.__lock:
+                self.__errors += 1
+
+            if isinstance(e, socket.timeout):
+                raise urllib2.URLError('timed out')
+
+            raise urllib2.URLError(e)
+
+        if not stream:
+            self.__finish(key, conn, response, True)
+
+        return (conn, response, body)
+
+    def get(self, url, headers=None, connect_timeout=CONNECT_TIMEOUT,
+            timeout=TIMEOUT):
+        """GET url and return a Response.
+
+        Raises urllib2.HTTPError if the status is 400 or more and
+        urllib2.URLError if there is no valid response.
+
+        """
+
+        return self.__request(url, headers, connect_timeout, timeout)
+
+    def open(self, url, headers=None, connect_timeout=CONNECT_TIMEOUT,
+             timeout=TIMEOUT, release=None):
+        """GET url and return a Response whose body is a Body, as get().
+
+        The Body must be closed once done with, unless read to the end;
+        release(), if given, is called then.
+
+        """
+
+        return self.__request(url, headers, connect_timeout, timeout, True,
+                              release)
+
+    def __request(self, url, headers, connect_timeout, timeout,
+                  stream=False, release=None):
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', USER_AGENT)
+
+        with self.__lock:
+            self.__requests += 1
+
+        for redirect in xrange(MAX_REDIRECTS + 1):
+            (key, path) = self.__route(url)
+            (conn, response, body) = self.__send(key, path, headers,
+                                                 connect_timeout, timeout,
+                                                 stream)
+
+            location = response.getheader('location')
+            redirected = (response.status in (301, 302, 303, 307, 308) and
+                          location)
+
+            if stream and (redirected or response.status >= 400):
+                # Short bodies, read to keep the connection
+                try:
+                    body = response.read()
+                except (socket.error, httplib.HTTPException), e:
+                    conn.close()
+                    raise urllib2.URLError(e)
+
+                self.__finish(key, conn, response, True)
+
+            elif stream:
+                def done(complete, key=key, conn=conn, response=response):
+                    try:
+                        self.__finish(key, conn, response, complete)
+                    finally:
+                        if release is not None:
+                            release()
+
+                body = Body('', response, done)
+
+            if redirected:
+                url = urlparse.urljoin(url, location)
+                continue
+
+            if response.status >= 400:
+                raise urllib2.HTTPError(url, response.status, response.reason,
+                                        response.msg, StringIO(body))
+
+            return Response(url, response.status, response.reason,
+                            response.msg, body)
+
+        raise urllib2.URLError('too many redirections: %s' % url)
+
+    def clear(self):
+        """Close all idle connections."""
+
+        with self.__lock:
+            idle = self.__idle
+            self.__idle = {}
+
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+    def stats(self):
+        with self.__lock:
+            return {'requests': self.__requests,
+                    'connections': self.__connections,
+                    'reused': self.__reused,
+                    'errors': self.__errors,
+                    'idle': sum(len(c) for c in self.__idle.itervalues())}
+
+
+class Upstream(object):
+    """A server queried through a ConnectionPool.
+
+    At most concurrency requests are sent at the same time; the others
+    wait up to connect_timeout seconds for their turn and then fail as if
+    the server did not answer.
+
+    """
+
+    def __init__(self, pool, connect_timeout=CONNECT_TIMEOUT,
+                 timeout=TIMEOUT, concurrency=CONCURRENCY):
+        self.pool = pool
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.concurrency = concurrency
+
+        self.__active = 0
+        self.__cond = threading.Condition()
+
+    def __acquire(self):
+        deadline = time.time() + self.connect_timeout
+        with self.__cond:
+            while self.__active >= self.concurrency:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.__cond.wait(remaining)
+
+            self.__active += 1
+            return True
+
+    def __release(self):
+        with self.__cond:
+            self.__active -= 1
+            self.__cond.notify()
+
+    def get(self, url, headers=None):
+        """GET url through the pool and return a Response."""
+
+        if not self.__acquire():
+            raise urllib2.URLError('too many requests in progress')
+
+        try:
+            return self.pool.get(url, headers, self.connect_timeout,
+                                 self.timeout)
+
+        finally:
+            self.__release()
+
+    def open(self, url, headers=None):
+        """Open url through the pool and return a Response with a Body,
+        see ConnectionPool.open(). It counts as a request in progress
+        until the Body is closed or read to the end.
+
+        """
+
+        if not self.__acquire():
+            raise urllib2.URLError('too many requests in progress')
+
+        try:
+            return self.pool.open(url, headers, self.connect_timeout,
+                                  self.timeout, self.__release)
+
+        except Exception:
+            self.__release()
+            raise
+
+
+class _Flight(object):
+    """A request in progress and, when done, its body or error."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.body = None
+        self.error = None
+
+
+class ResponseCache(object):
+    """Bodies of responses kept under their URL, up to maxsize bytes.
+
+    Shared by all the threads of a process. Concurrent calls of get() for
+    the same URL share a single request ("single flight"): the first one
+    fetches it and the others wait for its body or its error.
+
+    """
+
+    def __init__(self, maxsize):
+        self.cache = LRUCache(maxsize, None)
+
+        # url -> _Flight
+        self.__flights = {}
+        self.__lock = threading.Lock()
+
+        self.__fetches = 0
+        self.__coalesced = 0
+        self.__saved = 0
+
+    def __join(self, url, ttl):
+        """(body, flight, leader): the body kept for url, or else the
+        flight fetching it, and whether this thread is to fetch it.
+
+        """
+
+        with self.__lock:
+            body = self.cache.get(url) if ttl != 0 else None
+            if body is not None:
+                self.__saved += len(body)
+                return (body, None, False)
+
+            flight = self.__flights.get(url)
+            if flight is None:
+                flight = self.__flights[url] = _Flight()
+                return (None, flight, True)
+
+        return (None, flight, False)
+
+    def __wait(self, flight):
+        """Body fetched by the leader of flight, None if it streamed it."""
+
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+
+        if flight.body is not None:
+            with self.__lock:
+                self.__coalesced += 1
+                self.__saved += len(flight.body)
+
+        return flight.body
+
+    def __land(self, url, flight):
+        with self.__lock:
+            self.__fetches += 1
+            del self.__flights[url]
+
+        flight.done.set()
+
+    def get(self, url, fetch, ttl):
+        """Body of the response for url.
+
+        fetch(url) gets it from the server if it is neither cached nor
+        being fetched. It is then kept for ttl seconds (0: not at all,
+        None: until it is dropped to make room for others). Errors of
+        fetch() are raised and not kept.
+
+        """
+
+        (body, flight, leader) = self.__join(url, ttl)
+        if flight is None:
+            return body
+
+        if not leader:
+            body = self.__wait(flight)
+            if body is not None:
+                return body
+
+            # Streamed by an open() of the same URL
+            with self.__lock:
+                self.__fetches += 1
+
+            return fetch(url)
+
+        try:
+            flight.body = fetch(url)
+            if ttl != 0:
+                self.cache.put(url, flight.body, ttl)
+
+            return flight.body
+
+        except Exception, e:
+            flight.error = e
+            raise
+
+        finally:
+            self.__land(url, flight)
+
+    def open(self, url, fetch, ttl, maxbody):
+        """Body of the response for url, as get(), but as a Body.
+
+        fetch(url) opens the response on the server and returns its Body.
+        A body of at most maxbody bytes is read at once and kept as by
+        get(). A larger one, or any if ttl is 0, is read from the server
+        only while it is iterated over; it is neither kept nor shared
+        with the concurrent calls, and it must be closed once done with.
+
+        """
+
+        if ttl != 0:
+            (body, flight, leader) = self.__join(url, ttl)
+            if flight is None:
+                return Body(body)
+
+            if not leader:
+                body = self.__wait(flight)
+                if body is not None:
+                    return Body(body)
+
+            else:
+                try:
+                    stream = fetch(url)
+                    body = stream.peek(maxbody + 1)
+                    if len(body) > maxbody:
+                        return stream
+
+                    stream.close()
+                    flight.body = body
+                    self.cache.put(url, body, ttl)
+                    return Body(body)
+
+                except Exception, e:
+                    flight.error = e
+                    raise
+
+                finally:
+                    self.__land(url, flight)
+
+        with self.__lock:
+            self.__fetches += 1
+
+        return fetch(url)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        """Counters of the cache, as LRUCache.stats(), and requests sent
+        (fetches), shared (coalesced) and bytes not fetched (saved). The
+        hit ratio counts the shared requests as hits.
+
+        """
+
+        stats = self.cache.stats()
+        with self.__lock:
+            served = stats['hits'] + self.__coalesced
+            stats.update({'fetches': self.__fetches,
+                          'coalesced': self.__coalesced,
+                          'saved': self.__saved,
+                          'hitratio': round(float(served) /
+                                            (served + self.__fetches), 4)
+                          if served + self.__fetches else None})
+
+        return stats
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Networks of an Arclink XML inventory, identified by their content
+#
+# ----------------------------------------------------------------------
+
+
+"""Networks of an Arclink XML inventory, identified by their content
+
+Copyright (C) 2016 GEOFON team, Helmholtz-Zentrum Potsdam - Deutsches GeoForschungsZentrum GFZ
+
+When the inventory is updated usually only a few networks change. To find
+them without parsing the XML, the file is scanned for the elements
+"network" and the MD5 digest of the text of every one is computed. The
+InventoryCache keeps these digests in its table of networks and copies the
+networks with a known digest from the previous tables, instead of parsing
+them again.
+
+The parser only needs the rest of the file (sensors, dataloggers, station
+groups) and the networks which changed. document() builds such a text,
+in which every network to reuse is replaced by an empty element.
+
+
+This program is free software; you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 2, or (at your option) any later
+version. For more information, see http://www.gnu.org/
+
+"""
+
+import hashlib
+import mmap
+import re
+
+# Start of an element network, with an optional namespace prefix
+_NETWORK = re.compile(r'<((?:[A-Za-z_][\w.-]*:)?)network[\s/>]')
+
+
+class Block(object):
+    """Position and digest of an element network in the XML file."""
+
+    __slots__ = ('start', 'end', 'prefix', 'digest')
+
+    def __init__(self, start, end, prefix, digest):
+        self.start = start
+        self.end = end
+        self.prefix = prefix
+        self.digest = digest
+
+
+def scan(path):
+    """Return a Block for every element network in the file, in the order
+    in which they appear.
+
+    """
+
+    blocks = []
+
+    with open(path, 'rb') as fileobj:
+        try:
+            mm = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # An empty file can not be mapped
+            return blocks
+
+        try:
+            pos = 0
+            while True:
+                match = _NETWORK.search(mm, pos)
+                if match is None:
+                    break
+
+                start = match.start()
+                prefix = match.group(1)
+
+                tagend = mm.find('>', match.end() - 1)
+                if tagend < 0:
+                    raise ValueError('Unterminated network element')
+
+                if mm[tagend - 1] == '/':
+                    end = tagend + 1
+                else:
+                    closing = '</%snetwork>' % prefix
+                    end = mm.find(closing, tagend)
+                    if end < 0:
+                        raise ValueError('Unterminated network element')
+
+                    end += len(closing)
+
+                blocks.append(Block(start, end, prefix,
+                                    hashlib.md5(mm[start:end]).hexdigest()))
+                pos = end
+
+        finally:
+            mm.close()
+
+    return blocks
+
+
+def document(path, blocks, reuse):
+    """Text of the file in which every network with a true value in reuse
+    (one value per block) is replaced by an empty network element.
+
+    """
+
+    pieces = []
+
+    with open(path, 'rb') as fileobj:
+        pos = 0
+        for block, skip in zip(blocks, reuse):
+            if not skip:
+                continue
+
+            pieces.append(fileobj.read(block.start - pos))
+            pieces.append('<%snetwork/>' % block.prefix)
+            fileobj.seek(block.end)
+            pos = block.end
+
+        pieces.append(fileobj.read())
+
+    return ''.join(pieces)
@@ -30,22 +30,69 @@ version. For more information, see http://www.gnu.org/
 ##################################################################
 
 
+import array
 import datetime
 import os
 ###import tempfile
+import StringIO
 import math
-import cPickle as pickle
+import time
+import threading
+import fcntl
 import xml.etree.cElementTree as ET
 import json
 from collections import defaultdict
 
 import wsgicomm
+import invsnapshot
+import invdiff
+import geodist
+from invspatial import StationGrid
+from invindex import InventoryIndex
+from invtables import NetworkTable, StationTable, SensorLocTable, StreamTable
+from invtables import StreamIndex, INF, indexStreams, reindexStreams
+from invtables import parsetime, toepoch
+from invtables import gmyear
 from seiscomp import logs
-import seiscomp3.Math as Math
 
 ###tempdir = tempfile.gettempdir()
 
 
+class InventoryVersion(object):
+    """Tables of one version of the inventory and their indexes.
+
+    A version is never modified once built. When the inventory changes a
+    new version is built apart and replaces the old one in the
+    InventoryCache with a single assignment, so a request which took a
+    version always works with complete and consistent tables.
+
+    built is the time at which the tables were built (in seconds since the
+    epoch) and source the fingerprint of the XML file they come from (see
+    invsnapshot.fingerprint).
+
+    """
+
+    def __init__(self, tables, nettypes, built=None, source=None):
+        (self.networks, self.stations, self.sensorsLoc, self.streams,
+         self.streamidx) = tables
+
+        # The indexes are not part of the snapshot, as they are cheap to
+        # build
+        self.grid = StationGrid(self.stations)
+        self.index = InventoryIndex(self.networks, self.stations, nettypes)
+
+        self.loaded = time.time()
+        self.built = self.loaded if built is None else built
+        self.source = source
+
+
+def _current(name):
+    """Property returning an attribute of the version in use."""
+
+    return property(lambda self: getattr(self.current, name),
+                    doc='%s of the version in use' % name)
+
+
 class InventoryCache(object):
     """Encapsulate and manage the information of networks,
     stations, locations and streams read from an Arclink XML file inventory.
@@ -54,12 +101,27 @@ class InventoryCache(object):
 
     """
 
+    # Tables of the cache, as they are stored in the snapshot
+    TABLES = (('networks', NetworkTable),
+              ('stations', StationTable),
+              ('sensorsLoc', SensorLocTable),
+              ('streams', StreamTable),
+              ('streamidx', StreamIndex))
+
+    networks = _current('networks')
+    stations = _current('stations')
+    sensorsLoc = _current('sensorsLoc')
+    streams = _current('streams')
+    streamidx = _current('streamidx')
+    grid = _current('grid')
+    index = _current('index')
+
     def __init__(self, inventory):
         # Arclink inventory file in XML format
         self.inventory = inventory
 
-        # Temporary file to store the internal representation of the cache
-        # in pickle format
+        # File to store the internal representation of the cache as a
+        # snapshot that can be mapped in memory
         ###self.cachefile = os.path.join(tempdir, 'webinterface-cache.bin')
         self.cachefile = os.path.join(os.path.dirname(inventory),
                                       'webinterface-cache.bin')
@@ -67,6 +129,10 @@ class InventoryCache(object):
         # Set how often the cache should be updated (in seconds)
         self.time2refresh = 3600.0
 
+        # Copy the networks which did not change from the previous version
+        # of the inventory instead of parsing them again (see parseXML)
+        self.incremental = True
+
         # Fake date to force an update the first time
         self.lastUpdated = datetime.datetime(2000, 1, 1)
 
@@ -98,44 +164,123 @@ class InventoryCache(object):
                        ('P', 'P/Pdiff'),
                        ('S', 'S/Sdiff')]
 
+        # Version of the inventory in use (see refresh)
+        self.current = InventoryVersion((NetworkTable(), StationTable(),
+                                         SensorLocTable(), StreamTable(),
+                                         StreamIndex()), self.nettypes)
+
+        # Held while a new version is being loaded and the thread loading
+        # it in background, if any
+        self.__loading = threading.Lock()
+        self.reloader = None
+
         # Create/load the cache the first time that we start
         self.update()
 
-    def __indexStreams(self):
-        self.streamidx = {}
+    def update(self):
+        """Read the inventory file in XML format and store it in memory.
+
+        All the information of the inventory is read into tables of
+        networks, stations, sensor locations and streams (see invtables).
+        Only the necessary attributes are stored. This relies on the idea
+        that some other agent should update the inventory file at
+        a regular period of time.
+        If the XML file have been already processed by other instance of
+        this class, the snapshot it left (see invsnapshot) is mapped in
+        memory, avoiding the time invested in the construction and
+        sharing the memory with the other instances.
+
+        The new tables are put in use only when they are complete (see
+        InventoryVersion). This method waits for a reload running in
+        background to finish; requests use refresh() instead.
+
+        """
+
+        with self.__loading:
+            self.__update()
+
+    def refresh(self):
+        """Return the version of the inventory in use.
 
-        for stream in self.streams:
-            sensorLoc = self.sensorsLoc[stream[0]]
-            station = self.stations[sensorLoc[0]]
-            network = self.networks[station[0]]
+        If it is time to look for a new version, it is loaded by a thread
+        in background. The current version is returned in any case, so
+        requests never wait for the reload.
 
-            # (net,sta,cha,loc)
-            key = (network[0], station[4], stream[1], sensorLoc[4])
+        """
 
+        if (self.lastUpdated + datetime.timedelta(seconds=self.time2refresh) <
+           datetime.datetime.now()) and self.__loading.acquire(False):
             try:
-                obj = self.streamidx[key]
+                self.reloader = threading.Thread(target=self.__reload,
+                                                 name='InventoryCache')
+                self.reloader.daemon = True
+                self.reloader.start()
+            except:
+                self.__loading.release()
+                raise
 
-            except KeyError:
-                obj = []
-                self.streamidx[key] = obj
+        return self.current
 
-            obj.append(stream)
+    def follow(self, source):
+        """Put in use the version of the inventory built from the XML file
+        with fingerprint source (see invsnapshot.fingerprint), if it is not
+        in use already, by mapping its snapshot.
 
-    def update(self):
-        """Read the inventory file in XML format and store it in memory.
+        This is for processes which do not reload the inventory themselves,
+        but must use the same version as another one (e.g. the workers of
+        the pool of the metadata module). Returns False if there is no
+        snapshot of that version.
 
-        All the information of the inventory is read into lists of
-        networks, stations, sensor locations and streams. Only the
-        necessary attributes are stored. This relies on the idea
-        that some other agent should update the inventory file at
-        a regular period of time.
-        If the XML file have been already processed by other instance of
-        this class, we could look for a temporary file containing a memory
-        dump of the generated structures, avoiding the time invested in
-        the construction.
+        """
+
+        if self.current.source == source:
+            return True
+
+        snapshot = self.__map(source)
+        if snapshot is None:
+            return False
+
+        self.__use(self.__version(snapshot))
+        return True
+
+    def __reload(self):
+        """Body of the thread started by refresh()."""
+
+        try:
+            self.__update()
+        except Exception, e:
+            logs.error('Error while reloading the inventory: %s' % e)
+        finally:
+            self.__loading.release()
+
+    def status(self):
+        """Information about the version of the inventory in use.
+
+        age is the number of seconds since its tables were built.
 
         """
 
+        inv = self.current
+        now = time.time()
+
+        def isoformat(t):
+            return datetime.datetime.utcfromtimestamp(t).isoformat() + 'Z' \
+                if t is not None else None
+
+        return {'built': isoformat(inv.built),
+                'loaded': isoformat(inv.loaded),
+                'source': {'size': inv.source[0],
+                           'md5': inv.source[1].encode('hex')}
+                if inv.source is not None else None,
+                'age': round(now - inv.built, 3),
+                'reloading': self.__loading.locked(),
+                'networks': len(inv.networks),
+                'stations': len(inv.stations),
+                'streams': len(inv.streams)}
+
+    def __update(self):
+        """Body of update(). The caller must hold self.__loading."""
+
         # Calculate when the next update should take place
         nextUpdate = self.lastUpdated + datetime.timedelta(
             seconds=self.time2refresh)
@@ -144,392 +289,593 @@ class InventoryCache(object):
         if nextUpdate > datetime.datetime.now():
             return
 
-        # Initialize lists
-        self.networks = []
-        self.stations = []
-        self.sensorsLoc = []
-        self.streams = []
         self.lastUpdated = datetime.datetime.now()
 
-        # Just to shorten notation
-        ptNets = self.networks
-        ptStats = self.stations
-        ptSens = self.sensorsLoc
-        ptStre = self.streams
-
-        start_time = datetime.datetime.now()
-
-        # Look how old the two versions of inventory are.
-        # First version: XML file
-
+        # Identify the XML file by its size and digest. The snapshot keeps
+        # the ones of the file from which it was built. The digest is only
+        # computed again if the size or time of modification changed.
         try:
-            xml_time = os.path.getmtime(self.inventory)
-        except OSError as e:
+            source = invsnapshot.recorded_fingerprint(
+                self.inventory, self.cachefile + '.source')
+        except (IOError, OSError) as e:
+            # The version in use is kept
             logs.error('No inventory file! Bye.')
             return  ### NOT SURE WHAT WE SHOULD DO HERE.
 
+        if source == self.current.source:
+            return
+
+        snapshot = self.__map(source)
+        if snapshot is not None:
+            self.__use(self.__version(snapshot))
+            logs.info('Inventory mapped from snapshot')
+            return
 
-        # Second version: A pickle dump of the processed structures in memory
+        # Only one process builds the snapshot. The others wait for it and
+        # map it, instead of parsing the XML file as well.
+        lock = self.__lock()
         try:
-            pic_time = os.path.getmtime(self.cachefile)
-        except:
-            pic_time = 0
+            snapshot = self.__map(source)
+            if snapshot is not None:
+                self.__use(self.__version(snapshot))
+                logs.info('Inventory mapped from snapshot')
+                return
 
-        lockfile = self.cachefile + '.lock'
+            # Tables in use. The networks which did not change are copied
+            # from them when the inventory is parsed again.
+            previous = self.__tables(self.current)
+
+            if not len(previous[0]):
+                # Snapshot of a former version of the inventory, if any
+                snapshot = self.__map()
+                previous = self.__mapped(snapshot) \
+                    if snapshot is not None else None
+
+            tables = self.parseXML(previous if self.incremental else None)
+            snapshot = None
 
-        if pic_time > xml_time:
             try:
-                if os.path.exists(lockfile):
-                    # Go to the whole processing of the XML file because the
-                    # pickle version is still being built.
-                    raise Exception
+                invsnapshot.write(self.cachefile,
+                                  [(name, table) for (name, cls), table
+                                   in zip(self.TABLES, tables)], source)
 
-                with open(self.cachefile) as cache:
-                    (self.networks, self.stations, self.sensorsLoc,
-                     self.streams, self.streamidx) = pickle.load(cache)
-                    logs.info('Inventory loaded from pickle version')
-                    return
-            except:
+                # Use the snapshot also here, so that the memory is
+                # shared with all the other processes
+                snapshot = self.__map(source)
+
+            except Exception, e:
+                logs.error('Error while writing the snapshot (%s): %s' %
+                           (self.cachefile, e))
+
+            if snapshot is not None:
+                self.__use(self.__version(snapshot))
+            else:
+                self.__use(InventoryVersion(tables, self.nettypes,
+                                            source=source))
+
+        finally:
+            if lock is not None:
+                lock.close()
+
+    def __lock(self):
+        """Open and lock (exclusively) the lockfile of the snapshot.
+
+        Waits until no other process holds the lock. The lock is released
+        by closing the returned file, also if the process dies. Returns
+        None if the lock can not be taken.
+
+        """
+
+        lockfile = self.cachefile + '.lock'
+
+        try:
+            lck = open(lockfile, 'a')
+        except Exception, e:
+            logs.warning(('Error while attempting to create a lockfile' +
+                          ' (%s): %s. Every process will parse the' +
+                          ' inventory on its own.') % (lockfile, e))
+            return None
+
+        try:
+            try:
+                os.chmod(lockfile, 0664)
+            except OSError:
+                # The file belongs to another user
                 pass
 
-        logs.info('Processing XML: %s' % start_time)
+            fcntl.flock(lck, fcntl.LOCK_EX)
+            return lck
 
-        sensors = {}
-        dataloggers = {}
-        stationsDict = {}
+        except Exception, e:
+            logs.warning('Error while locking %s: %s' % (lockfile, e))
+            lck.close()
+            return None
+
+    def __tables(self, inv):
+        """Tables of a version of the inventory, in the order of TABLES."""
+
+        return tuple(getattr(inv, name) for name, cls in self.TABLES)
+
+    def __map(self, source=None):
+        """Map the snapshot in self.cachefile.
+
+        If source is given, the snapshot must have been built from an XML
+        file with that fingerprint. None is returned if there is no valid
+        snapshot. The checksum of a snapshot is only verified by the first
+        process which maps it (see Snapshot.verifyOnce).
+
+        """
 
-        # Parse the inventory file.
-        # There are two steps in parsing. In the first, a dictionary of
-        # sensors and dataloggers is constructed. In the second step, the
-        # networks/stations/sensors/streams tree structure is built.
         try:
-            invfile = open(self.inventory)
+            snapshot = invsnapshot.Snapshot(self.cachefile)
+            if source is not None and snapshot.source != source:
+                return None
+
+            snapshot.verifyOnce(self.cachefile + '.verified')
+            return snapshot
+
         except IOError:
-            msg = 'Error: could not open the inventory file ' + self.inventory
-            logs.error(msg)
-            raise wsgicomm.WIInternalError, msg
+            return None
+        except Exception, e:
+            logs.warning('Snapshot %s discarded: %s' % (self.cachefile, e))
+            return None
+
+    def __mapped(self, snapshot):
+        """Tables of a snapshot, in the order of TABLES."""
+
+        return tuple(snapshot.table(name, cls) for name, cls in self.TABLES)
+
+    def __version(self, snapshot):
+        """Version of the inventory with the tables of a snapshot."""
+
+        return InventoryVersion(self.__mapped(snapshot), self.nettypes,
+                                snapshot.built, snapshot.source)
+
+    def __use(self, inv):
+        """Put a version of the inventory in use."""
+
+        # A single assignment: requests see either the old version or the
+        # new one, never a mix of both
+        self.current = inv
+
+        logs.info('Inventory built at %s in use (%d networks, %d stations)' %
+                  (datetime.datetime.utcfromtimestamp(inv.built),
+                   len(inv.networks), len(inv.stations)))
+
+    def parseXML(self, previous=None):
+        """Parse the inventory file and return new tables of networks,
+        stations, sensor locations and streams and the index of streams.
+
+        The file is read in a single pass. Streams refer to sensors and
+        dataloggers which can be defined anywhere in the file, and virtual
+        networks refer to stations, so these references are kept while
+        parsing and resolved at the end.
+
+        previous are the tables of a former version of the inventory, in
+        the same order. The networks whose XML did not change (see invdiff)
+        are copied from them instead of parsed, and the index of streams is
+        updated instead of built again. If anything goes wrong with them,
+        the whole file is parsed.
+
+        """
 
-        for parsetype in ['SENSDAT', 'NET_STA']:
+        try:
+            blocks = invdiff.scan(self.inventory)
+        except Exception, e:
+            logs.warning('Error while scanning the inventory: %s' % e)
+            blocks = None
 
-            # Traverse through the networks
-            # get an iterable
+        reuse = None
+        if blocks is not None and previous is not None:
             try:
-                invfile.seek(0)
-                context = ET.iterparse(invfile, events=("start", "end"))
-            except IOError:
-                msg = 'Error: could not parse the inventory file ' + self.inventory
-                logs.error(msg)
-                raise wsgicomm.WIInternalError, msg
-
-            # turn it into an iterator
-            context = iter(context)
-
-            # get the root element
-            event, root = context.next()
-
-            # Check that it is really an inventory
-            if root.tag[-len('inventory'):] != 'inventory':
-                msg = 'The file parsed seems not to be an inventory (XML).'
-                logs.error(msg)
-                raise wsgicomm.WIInternalError, msg
-
-            # Extract the namespace from the root node
-            namesp = root.tag[:-len('inventory')]
-
-            for event, netw in context:
-                # The tag of this node could actually be "network" or
-                # "stationGroup". Now it is not being checked because
-                # we need all the data, but if we need to filter, this
-                # is the place.
-                #
-                if event == "end":
-                    if parsetype == 'NET_STA' and \
-                       netw.tag == namesp + 'network':
-
-                        # Extract the year from start
-                        try:
-                            start_year = netw.get('start')
-                            start_year = int(start_year[:4])
-                        except:
-                            start_year = None
-
-                        # Extract the year from end
-                        try:
-                            end_year = netw.get('end')
-                            end_year = int(end_year[:4])
-                        except:
-                            end_year = None
-
-                        # Cast the attribute restricted
-                        try:
-                            if netw.get('restricted').lower() == 'true':
-                                restricted = 1
-                            elif netw.get('restricted').lower() == 'false':
-                                restricted = 2
-                            else:
-                                restricted = None
-                        except:
-                            restricted = None
-
-                        # Append the network to the list of networks
-                        ptNets.append([netw.get('code'), len(ptStats), None,
-                                       None, start_year, end_year,
-                                       netw.get('description'), restricted,
-                                       netw.get('netClass'),
-                                       netw.get('archive'),
-                                       netw.get('institutions')])
-
-                        last_child_station = len(ptStats)
-
-                        # Traverse through the stations
-                        for stat in netw.findall(namesp + 'station'):
-                            # Extract the year from start
-                            try:
-                                stat_start_string = stat.get('start')
-                                stat_start_date = datetime.datetime.strptime(
-                                    stat_start_string, '%Y-%m-%dT%H:%M:%S.%fZ')
-                            except:
-                                stat_start_date = None
+                reuse = self.__reusable(blocks, previous[0])
+            except Exception, e:
+                logs.warning('Previous tables can not be reused: %s' % e)
 
-                            # Extract the year from end
-                            try:
-                                stat_end_string = stat.get('end')
-                                stat_end_date = datetime.datetime.strptime(
-                                    stat_end_string, '%Y-%m-%dT%H:%M:%S.%fZ')
-                            except:
-                                stat_end_date = None
+        if reuse is not None and any(j >= 0 for j in reuse):
+            try:
+                return self.__parse(blocks, reuse, previous)
+            except Exception, e:
+                logs.warning('Error while applying the changes of the ' +
+                             'inventory (%s). Parsing the whole file.' % e)
 
-                            # Extract latitude
-                            try:
-                                lat = float(stat.get('latitude'))
-                            except:
-                                lat = None
+        return self.__parse(blocks)
 
-                            # Extract longitude
-                            try:
-                                lon = float(stat.get('longitude'))
-                            except:
-                                lon = None
+    @staticmethod
+    def __reusable(blocks, networks):
+        """For every block, the network with the same digest in the table
+        networks, or -1.
 
-                            # Extract elevation
-                            try:
-                                elevation = float(stat.get('elevation'))
-                            except:
-                                elevation = None
+        """
 
-                            stationsDict[stat.get('publicID')] = len(ptStats)
+        known = {}
+        for j in xrange(len(networks)):
+            digest = networks.digest[j]
+            if digest is not None:
+                known.setdefault(digest, j)
 
-                            # Cast the attribute restricted
-                            try:
-                                if stat.get('restricted').lower() == 'true':
-                                    restricted = 1
-                                elif stat.get('restricted').lower() == 'false':
-                                    restricted = 2
-                                else:
-                                    restricted = None
-                            except:
-                                restricted = None
-
-                            # Only store a reference to the network in the
-                            # first column
-                            ptStats.append([len(ptNets) - 1, len(ptSens), None,
-                                            None, stat.get('code'), lat, lon,
-                                            stat.get('description'),
-                                            stat_start_date, stat_end_date,
-                                            elevation, restricted])
-                            last_child_station += 1
-
-                            last_child_sensor = len(ptSens)
-                            sensXml = namesp + 'sensorLocation'
-                            for sensor in stat.findall(sensXml):
-                                # A reference to the containing station is
-                                # in the first column
-                                ptSens.append([len(ptStats) - 1, len(ptStre),
-                                               None, None, sensor.get('code')])
-                                last_child_sensor += 1
-
-                                last_child_stream = len(ptStre)
-                                streXml = namesp + 'stream'
-                                for stream in sensor.findall(streXml):
-                                    sens_type = sensors.get(
-                                        stream.get('sensor'))
-
-                                    try:
-                                        d = stream.get('sampleRateDenominator')
-                                        n = stream.get('sampleRateNumerator')
-                                        denom = float(d)
-                                        numer = float(n)
-                                    except:
-                                        denom = None
-                                        numer = None
-
-                                    try:
-                                        startString = stream.get('start')
-                                        startDate = datetime.datetime.strptime(
-                                            startString,
-                                            '%Y-%m-%dT%H:%M:%S.%fZ')
-                                    except:
-                                        startDate = None
-
-                                    try:
-                                        endString = stream.get('end')
-                                        endDate = datetime.datetime.strptime(
-                                            endString, '%Y-%m-%dT%H:%M:%S.%fZ')
-                                    except:
-                                        endDate = None
-
-                                    # Cast the attribute restricted
-                                    try:
-                                        if stream.get('restricted').lower() \
-                                           == 'true':
-                                            restricted = 1
-                                        elif stream.get('restricted').lower() \
-                                                == 'false':
-                                            restricted = 2
-                                        else:
-                                            restricted = None
-                                    except:
-                                        restricted = None
-
-                                    auxCode = stream.get('code')
-                                    auxDatLog = stream.get('datalogger')
-                                    ptStre.append((len(ptSens) - 1,
-                                                   auxCode, sens_type, denom,
-                                                   numer,
-                                                   dataloggers.get(auxDatLog),
-                                                   startDate, endDate,
-                                                   restricted))
-                                    last_child_stream += 1
-                                    stream.clear()
-
-                                ptSens[-1][2] = last_child_stream
-                                sensor.clear()
-
-                                # Check if there is at least one stream.
-                                # Otherwise remove sensor. This case can happen
-                                # when there are only auxStreams instead of
-                                # streams
-                                if ptSens[-1][1] == ptSens[-1][2]:
-                                    del ptSens[-1]
-                                    last_child_sensor -= 1
-
-                            self.stations[-1][2] = last_child_sensor
-                            stat.clear()
-
-                            # Check if there is at least one sensor. Otherwise
-                            # remove station. This case can happen when there
-                            # are only auxStreams instead of streams
-                            if ptStats[-1][1] == ptStats[-1][2]:
-                                del ptStats[-1]
-                                last_child_station -= 1
-
-                        ptNets[-1][2] = last_child_station
-                        netw.clear()
-
-                    if((parsetype == 'SENSDAT') and (netw.tag == namesp +
-                                                     'sensor')):
-                        pubId = netw.get('publicID')
-                        sensors[pubId] = netw.get('type')
-                        netw.clear()
-
-                    if((parsetype == 'SENSDAT') and (netw.tag == namesp +
-                                                     'datalogger')):
-                        pubId = netw.get('publicID')
-                        dataloggers[pubId] = netw.get('description')
-                        netw.clear()
-
-                    if((parsetype == 'SENSDAT') and (netw.tag == namesp +
-                                                     'stationGroup')):
-                        # Extract the year from start
-                        try:
-                            start_year = netw.get('start')
-                            start_year = int(start_year[:4])
-                        except:
-                            # March 2016: Quick workaround for virtual network with no start date; seems to break getStations()
-                            start_year = 1900 # None
-
-                        # Extract the year from end
-                        try:
-                            end_year = netw.get('end')
-                            end_year = int(end_year[:4])
-                        except:
-                            end_year = None
-
-                        # Fill a list with station ID's. To be replaced later
-                        # with the index in self.stations
-                        virtualStations = []
-                        statRefXml = namesp + 'stationReference'
-                        for statRef in netw.findall(statRefXml):
-                            virtualStations.append(statRef.get('stationID'))
-
-                        # Virtual networks are always permanent,
-                        # and have no archive DCID, since that just leads
-                        # to turf battles and much crying.
-                        netArchive = ''
-                        netInstitutes = netArchive  # not used?
-                        ptNets.append([netw.get('code'), None, None,
-                                       virtualStations, start_year, end_year,
-                                       netw.get('description'), False, 'p',
-                                       netArchive, netInstitutes])
-
-                        netw.clear()
-
-                    root.clear()
+        return [known.get(block.digest, -1) for block in blocks]
 
-        invfile.close()
+    def __parse(self, blocks, reuse=None, previous=None):
+        """Parse the inventory file (see parseXML).
+
+        blocks are the networks found by invdiff.scan, or None. reuse tells
+        for every block the network in the previous tables to copy, or -1
+        to parse it.
 
-        # Resolving station references in virtual networks
-        for netw in self.networks:
-            if((netw[1] is None) and (netw[2] is None)):
-                idxs = []
-                for stat in netw[3]:
-                    idxs.append(stationsDict[stat])
+        """
+
+        # New tables
+        ptNets = NetworkTable()
+        ptStats = StationTable()
+        ptSens = SensorLocTable()
+        ptStre = StreamTable()
+
+        # Virtual networks are kept apart and placed before the real ones
+        ptVirt = NetworkTable()
+
+        start_time = time.time()
+
+        logs.info('Processing XML: %s' % datetime.datetime.now())
+
+        sensors = {}
+        dataloggers = {}
+        stationsDict = {}
+        virtualRefs = []
 
-                netw[3] = idxs
+        # All the strings are taken from this pool, so that repeated values
+        # (codes, descriptions, sensor types) are stored only once
+        pool = {}
 
-        end_time = datetime.datetime.now()
-        logs.info('Done with XML:  %s' % (end_time))  # Python 2.7: (end_time - start_time).total_seconds())
+        def shared(s):
+            return None if s is None else pool.setdefault(s, s)
 
-        self.__indexStreams()
+        # Times already converted. Most epochs start and end at the same
+        # few instants.
+        times = {}
 
-        if not os.path.exists(lockfile):
+        def epoch(s, default):
             try:
-                lck = open(lockfile, 'w')
-                os.chmod(lockfile, 0664)
-                lck.close()
+                return times[s]
+            except KeyError:
+                pass
+
+            try:
+                value = parsetime(s)
             except:
-                logs.warning(('Error while attempting to create a lockfile' +
-                              ' (%s). Check whether the inventory is parsed' +
-                              ' every %d seconds. This could potentialy' +
-                              ' make some requests slower.') %
-                             (lockfile, self.time2refresh))
-                return
+                value = default
+
+            times[s] = value
+            return value
+
+        # Cast the attribute restricted
+        def restricted(elem):
+            value = elem.get('restricted')
+            if value is None:
+                return None
 
-            with open(self.cachefile, 'wb') as cache:
-                os.chmod(self.cachefile, 0664)
-                pickle.dump((ptNets, ptStats, ptSens, ptStre, self.streamidx),
-                            cache)
+            value = value.lower()
+            if value == 'true':
+                return 1
+            elif value == 'false':
+                return 2
 
+            return None
+
+        # Extract the year from start/end
+        def year(elem, attr, default=None):
+            try:
+                return int(elem.get(attr)[:4])
+            except:
+                return default
+
+        def floatattr(elem, attr):
             try:
-                os.remove(lockfile)
+                return float(elem.get(attr))
             except:
-                logs.error(('Error while removing lockfile (%s). Remove it' +
-                            ' manually or the pickle version will be always' +
-                            ' skipped.') % lockfile)
+                return None
+
+        # Streams copied from the previous tables, as
+        # (FIRST, LAST, NEW INDEX OF FIRST)
+        copied = []
+
+        # Copy the networks j0 to j1 (excluded) of the previous tables with
+        # all their children. Their children are contiguous, so every table
+        # is copied at once.
+        def copyNetworks(j0, j1):
+            (oldNets, oldStats, oldSens, oldStre) = previous[:4]
+
+            s0 = oldNets.first[j0]
+            s1 = oldNets.last[j1 - 1]
+            l0 = l1 = t0 = t1 = 0
+            if s0 < s1:
+                l0 = oldStats.first[s0]
+                l1 = oldStats.last[s1 - 1]
+                t0 = oldSens.first[l0]
+                t1 = oldSens.last[l1 - 1]
+
+            for s, publicID in enumerate(oldStats.publicID[s0:s1]):
+                stationsDict[publicID] = len(ptStats) + s
+
+            copied.append((t0, t1, len(ptStre)))
+
+            ptNets.copyrows(oldNets, j0, j1,
+                            {'first': len(ptStats) - s0,
+                             'last': len(ptStats) - s0})
+            ptStats.copyrows(oldStats, s0, s1,
+                             {'network': len(ptNets) - j1,
+                              'first': len(ptSens) - l0,
+                              'last': len(ptSens) - l0})
+            ptSens.copyrows(oldSens, l0, l1,
+                            {'station': len(ptStats) - s1,
+                             'first': len(ptStre) - t0,
+                             'last': len(ptStre) - t0})
+            ptStre.copyrows(oldStre, t0, t1,
+                            {'sensorLoc': len(ptSens) - l1})
+
+        # Run of consecutive networks of the previous tables still to be
+        # copied, as [FIRST, LAST)
+        run = [0, 0]
+
+        def flush():
+            if run[0] < run[1]:
+                copyNetworks(run[0], run[1])
+                run[0] = run[1] = 0
+
+        try:
+            if reuse is None:
+                invfile = open(self.inventory)
+            else:
+                invfile = StringIO.StringIO(invdiff.document(
+                    self.inventory, blocks, [j >= 0 for j in reuse]))
+        except IOError:
+            msg = 'Error: could not open the inventory file ' + self.inventory
+            logs.error(msg)
+            raise wsgicomm.WIInternalError, msg
+
+        # Traverse through the networks
+        # get an iterable
+        try:
+            context = ET.iterparse(invfile, events=("start", "end"))
+        except IOError:
+            msg = 'Error: could not parse the inventory file ' + self.inventory
+            logs.error(msg)
+            raise wsgicomm.WIInternalError, msg
+
+        # turn it into an iterator
+        context = iter(context)
+
+        # get the root element
+        event, root = context.next()
+
+        # Check that it is really an inventory
+        if root.tag[-len('inventory'):] != 'inventory':
+            msg = 'The file parsed seems not to be an inventory (XML).'
+            logs.error(msg)
+            raise wsgicomm.WIInternalError, msg
+
+        # Extract the namespace from the root node
+        namesp = root.tag[:-len('inventory')]
+
+        netXml = namesp + 'network'
+        statXml = namesp + 'station'
+        sensXml = namesp + 'sensorLocation'
+        streXml = namesp + 'stream'
+        sensorXml = namesp + 'sensor'
+        datalogXml = namesp + 'datalogger'
+        groupXml = namesp + 'stationGroup'
+        statRefXml = namesp + 'stationReference'
+
+        # Number of networks found
+        position = 0
+
+        for event, netw in context:
+            # The tag of this node could actually be "network" or
+            # "stationGroup". Now it is not being checked because
+            # we need all the data, but if we need to filter, this
+            # is the place.
+            #
+            if event != "end":
+                continue
+
+            tag = netw.tag
+
+            if tag == netXml:
+                # Position of the network in the list of blocks
+                k = position
+                position += 1
+                digest = blocks[k].digest if blocks is not None and \
+                    k < len(blocks) else None
+
+                if reuse is not None and reuse[k] >= 0:
+                    j = reuse[k]
+                    if run[0] < run[1] and run[1] == j:
+                        run[1] += 1
+                    else:
+                        flush()
+                        run[:] = [j, j + 1]
+
+                    netw.clear()
+                    continue
+
+                flush()
+
+                # Append the network to the table of networks
+                ptNets.append(shared(netw.get('code')), len(ptStats),
+                              None, None, None, year(netw, 'start'),
+                              year(netw, 'end'),
+                              shared(netw.get('description')),
+                              restricted(netw),
+                              shared(netw.get('netClass')),
+                              shared(netw.get('archive')),
+                              shared(netw.get('institutions')), digest)
+
+                # Traverse through the stations
+                for stat in netw.findall(statXml):
+                    # Only store a reference to the network in the
+                    # first column
+                    ptStats.append(len(ptNets) - 1, len(ptSens), None,
+                                   shared(stat.get('code')),
+                                   floatattr(stat, 'latitude'),
+                                   floatattr(stat, 'longitude'),
+                                   shared(stat.get('description')),
+                                   epoch(stat.get('start'), -INF),
+                                   epoch(stat.get('end'), INF),
+                                   floatattr(stat, 'elevation'),
+                                   restricted(stat),
+                                   stat.get('publicID'))
+
+                    for sensor in stat.findall(sensXml):
+                        # A reference to the containing station is
+                        # in the first column
+                        ptSens.append(len(ptStats) - 1, len(ptStre),
+                                      None, shared(sensor.get('code')))
+
+                        for stream in sensor.findall(streXml):
+                            try:
+                                d = stream.get('sampleRateDenominator')
+                                n = stream.get('sampleRateNumerator')
+                                denom = float(d)
+                                numer = float(n)
+                            except:
+                                denom = None
+                                numer = None
+
+                            # Sensor type and datalogger are filled in
+                            # once the whole file has been read
+                            ptStre.append(len(ptSens) - 1,
+                                          shared(stream.get('code')), None,
+                                          denom, numer, None,
+                                          epoch(stream.get('start'), -INF),
+                                          epoch(stream.get('end'), INF),
+                                          restricted(stream),
+                                          shared(stream.get('sensor')),
+                                          shared(stream.get('datalogger')))
+
+                        ptSens.last[-1] = len(ptStre)
+
+                        # Check if there is at least one stream.
+                        # Otherwise remove sensor. This case can happen
+                        # when there are only auxStreams instead of
+                        # streams
+                        if ptSens.first[-1] == ptSens.last[-1]:
+                            ptSens.pop()
+
+                    ptStats.last[-1] = len(ptSens)
+
+                    # Check if there is at least one sensor. Otherwise
+                    # remove station. This case can happen when there
+                    # are only auxStreams instead of streams
+                    if ptStats.first[-1] == ptStats.last[-1]:
+                        ptStats.pop()
+                    else:
+                        stationsDict[stat.get('publicID')] = \
+                            len(ptStats) - 1
+
+                ptNets.last[-1] = len(ptStats)
+                netw.clear()
+
+            elif tag == sensorXml:
+                sensors[netw.get('publicID')] = shared(netw.get('type'))
+                netw.clear()
+
+            elif tag == datalogXml:
+                dataloggers[netw.get('publicID')] = \
+                    shared(netw.get('description'))
+                netw.clear()
+
+            elif tag == groupXml:
+                # Fill a list with station ID's. To be replaced later
+                # with the index in self.stations
+                virtualRefs.append([statRef.get('stationID') for statRef
+                                    in netw.findall(statRefXml)])
+
+                # Virtual networks are always permanent,
+                # and have no archive DCID, since that just leads
+                # to turf battles and much crying.
+                # March 2016: Quick workaround for virtual network with no
+                # start date; seems to break getStations()
+                netArchive = ''
+                netInstitutes = netArchive  # not used?
+                ptVirt.append(shared(netw.get('code')), None, None, None,
+                              None, year(netw, 'start', 1900),
+                              year(netw, 'end'),
+                              shared(netw.get('description')), None, 'p',
+                              netArchive, netInstitutes, None)
+
+                netw.clear()
+
+            root.clear()
+
+        invfile.close()
+        flush()
+
+        # The digests are only valid if every network was found by the scan
+        if blocks is not None and len(blocks) != position:
+            if reuse is not None:
+                raise Exception('%d networks expected, %d found' %
+                                (len(blocks), position))
+
+            logs.warning('Networks of the inventory not identified')
+            ptNets.digest = [None] * len(ptNets)
+
+        # Resolving sensor and datalogger references in streams
+        ptStre.sensortype = [sensors.get(ref) for ref in ptStre.sensorref]
+        ptStre.datalogger = [dataloggers.get(ref)
+                             for ref in ptStre.dataloggerref]
+
+        # Resolving station references in virtual networks. Stations
+        # which were not kept (e.g. with only auxStreams) are skipped.
+        for i, refs in enumerate(virtualRefs):
+            ptVirt.vfirst[i] = len(ptVirt.refs)
+            ptVirt.refs.extend([stationsDict[stat] for stat in refs
+                                if stat in stationsDict])
+            ptVirt.vlast[i] = len(ptVirt.refs)
+
+        # Virtual networks go first, so the references from the stations to
+        # their network must be shifted
+        if len(ptVirt):
+            ptVirt.extend(ptNets)
+            ptNets = ptVirt
+            ptStats.network = array.array('i', [i + len(virtualRefs) for i
+                                                in ptStats.network])
+
+        if reuse is None:
+            ptIdx = indexStreams(ptNets, ptStats, ptSens, ptStre)
+        else:
+            # New position of every stream of the previous tables
+            remap = array.array('i', [-1]) * len(previous[3])
+            for (first, last, new) in copied:
+                remap[first:last] = array.array('i', xrange(new, new + last -
+                                                            first))
+
+            ptIdx = reindexStreams(previous[4], remap, ptNets, ptStats,
+                                   ptSens, ptStre)
+
+        elapsed = time.time() - start_time
+        size = os.path.getsize(self.inventory) / 1048576.0
+        if reuse is None:
+            logs.info('Done with XML:  %s (%.1f MB in %.2f s, %.1f MB/s)' %
+                      (datetime.datetime.now(), size, elapsed,
+                       size / elapsed if elapsed else 0.0))
+        else:
+            logs.info('Done with XML:  %s (%.1f MB in %.2f s, %d of %d '
+                      'networks changed)' %
+                      (datetime.datetime.now(), size, elapsed,
+                       reuse.count(-1), len(reuse)))
+
+        return (ptNets, ptStats, ptSens, ptStre, ptIdx)
 
     # Method to select networks from the parameters passed
-    def __selectNetworks(self, params):
+    def __selectNetworks(self, inv, params):
         """Select networks filtered by the input parameters.
 
         A list of indices is returned. These indices indicate the networks
-        that satisfy the constraints indicated by the input parameters.
+        of the version inv that satisfy the constraints indicated by the
+        input parameters.
 
         """
 
-        if (self.lastUpdated + datetime.timedelta(seconds=self.time2refresh) <
-           datetime.datetime.now()):
-            self.update()
-
         # Check parameters
         # Start year of the period in which the network should contain data
         if 'start' in params:
@@ -571,16 +917,12 @@ class InventoryCache(object):
 
             for nettype in self.nettypes:
                 if networktype == nettype[0]:
-                    permanent = nettype[2]
-                    restricted = nettype[3]
                     break
             else:
                 return set()
 
         except:
             networktype = None
-            permanent = None
-            restricted = None
 
         # Select only one network
         try:
@@ -590,61 +932,46 @@ class InventoryCache(object):
         except:
             network = None
 
-        # Filter and save indexes of networks in netsOK
-        netsOK = set()
-        for i, netw in enumerate(self.networks):
-            # If there is a network selected look only at the codes
-            if network:
-                try:
-                    # Extract the three parts of the network parameter
-                    (netcode, netstart, netend) = network.split('-')
-                    netstart = int(netstart)
-                    if netend == 'None':
-                        netend = None
-                    else:
-                        netend = int(netend)
-
-                    # If any of the three parts does not coincide with the
-                    # current network, skip it
-                    if((netcode != netw[0]) or (netstart != netw[4]) or
-                       (netend != netw[5])):
-                        continue
-                    else:
-                        # Once I found the code, insert it in the lists and
-                        # leave the loop
-                        netsOK.add(i)
-                        break
+        # Just to make notation shorter
+        ptNets = inv.networks
 
-                except:
-                    continue
+        # If there is a network selected look only at its key
+        if network:
+            try:
+                # Extract the three parts of the network parameter
+                (netcode, netstart, netend) = network.split('-')
+                netstart = int(netstart)
+                if netend == 'None':
+                    netend = None
+                else:
+                    netend = int(netend)
 
-            # Discard if start is after the end of the network operation
-            if start and netw[5]:
-                if netw[5] < start:
-                    continue
+            except:
+                return set()
 
-            # Discard if end is before the start of the network operation
-            if end and netw[4]:
-                if end < netw[4]:
-                    continue
+            i = inv.index.netkeys.get('%s-%s-%s' % (netcode, netstart,
+                                                    netend))
 
-            # Discard if the restricted attribute is not the same
-            if restricted is not None:
-                if netw[7] != restricted:
-                    continue
+            return set() if i is None else set([i])
 
-            # Discard if the netClass/permanent attribute is not the same
-            if permanent is not None:
-                if permanent and (netw[8] == 't'):
-                    continue
+        # Networks with the restricted and netClass/permanent attributes of
+        # the network type
+        if networktype is None:
+            candidates = xrange(len(ptNets))
+        else:
+            candidates = inv.index.nettypes[networktype]
 
-                if (not permanent) and (netw[8] == 'p'):
+        # Filter and save indexes of networks in netsOK
+        netsOK = set()
+        for i in candidates:
+            # Discard if start is after the end of the network operation
+            if start and ptNets.end[i]:
+                if ptNets.end[i] < start:
                     continue
 
-            # Virtual networks have no pointers to first child (1) and last
-            # child (2). They have a list of childs (3)
-            if networktype == 'virt':
-                if ((netw[1] is not None) or (netw[2] is not None)):
+            # Discard if end is before the start of the network operation
+            if end and ptNets.start[i]:
+                if end < ptNets.start[i]:
                     continue
 
             # All checks have been done, so add the network index to the list
@@ -652,40 +979,38 @@ class InventoryCache(object):
 
         return netsOK
 
-    def __selectStations(self, params):
+    def __selectStations(self, inv, params):
         """Select stations filtered by the input parameters.
 
         Returns a set of indexes. These indexes indicate the
-        stations that satisfy the constraints indicated by the
-        input parameters.
+        stations of the version inv that satisfy the constraints
+        indicated by the input parameters.
 
         """
 
-        if (self.lastUpdated + datetime.timedelta(seconds=self.time2refresh) <
-           datetime.datetime.now()):
-            self.update()
-
         # Check parameters
         # Start year of the period in which the network should contain data
         try:
-            start = datetime.datetime(int(params.get('start')), 1, 1, 0, 0, 0)
+            start = toepoch(datetime.datetime(int(params.get('start')), 1, 1,
+                                              0, 0, 0))
         except:
             start = None
 
         # Last year of the period in which the network should contain data
         try:
-            end = datetime.datetime(int(params.get('end')), 12, 31, 23, 59, 59)
+            end = toepoch(datetime.datetime(int(params.get('end')), 12, 31,
+                                            23, 59, 59))
         except:
             end = None
 
         # With any of these parameters I need to filter on time range
-        if start or end:
+        if start is not None or end is not None:
             # Default values in case they are not provided
             if start is None:
-                start = datetime.datetime(1900, 1, 1, 0, 0, 0)
+                start = toepoch(datetime.datetime(1900, 1, 1, 0, 0, 0))
 
             if end is None:
-                end = datetime.datetime.now()
+                end = time.time()
 
             # Swap values if they are in the wrong order
             if start > end:
@@ -703,70 +1028,68 @@ class InventoryCache(object):
             stations = None
 
         # Filter and save indexes of networks in netsOK
-        netsOK = self.__selectNetworks(params)
+        netsOK = self.__selectNetworks(inv, params)
         # codesOK = set()
 
-        statcodesOK = set()
         statsOK = set()
 
         # Just to make notation shorter
-        ptNets = self.networks
-        ptStats = self.stations
+        ptNets = inv.networks
+        ptStats = inv.stations
+        index = inv.index
 
-        for i in netsOK:
-            # A normal network has pointers to first and last child
-            if ((ptNets[i][1] is not None) and (ptNets[i][2] is not None)):
-                list_of_children = range(ptNets[i][1], ptNets[i][2])
-            # A virtual network has a list of children
-            else:
-                list_of_children = ptNets[i][3]
+        # Stations not operating in the period of time
+        if start is not None:
+            outside = index.outside(start, end)
+        else:
+            outside = ()
 
-            # Filter and add stations
-            for s in list_of_children:
+        # If there are stations selected look only at their codes
+        if stations:
+            for key in stations:
+                for s in index.stationkeys.get(key, ()):
+                    if s in outside:
+                        continue
 
-                # Take the real network in which the station is
-                # That means, no virtual networks
-                realParent = self.stations[s][0]
+                    # The station must be in one of the selected networks,
+                    # the real one in which it is or a virtual one
+                    if ptStats.network[s] in netsOK or \
+                       not netsOK.isdisjoint(index.virtual.get(s, ())):
+                        statsOK.add(s)
 
-                # Discard if start is after the end of the network operation
-                if start and ptStats[s][9]:
-                    if ptStats[s][9] < start:
-                        continue
+            return statsOK
 
-                # Discard if end is previous than the start of the network
-                # operation
-                if end and ptStats[s][8]:
-                    if end < ptStats[s][8]:
-                        continue
+        # Pairs (network code, station code) already selected
+        statcodesOK = set()
 
-                # If there is a station selected look only at the codes
-                if stations:
-                    key = '%s-%s-%s-%s' % (ptNets[realParent][0],
-                                           ptNets[realParent][4],
-                                           ptNets[realParent][5],
-                                           ptStats[s][4])
-                    if key not in stations:
-                        continue
-                    else:
-                        # Once I found the code, insert it in the lists and
-                        # leave the loop
-                        statsOK.add(s)
+        netcode = index.netcode
+        stacode = index.stacode
 
-                # Filter duplicated stations
-                if (ptNets[realParent][0], ptStats[s][4]) in statcodesOK:
+        for i in netsOK:
+            # A normal network has pointers to first and last child.
+            # A virtual network has a list of children.
+            # Filter and add stations
+            for s in ptNets.children(i):
+                if s in outside:
+                    continue
+
+                # Filter duplicated stations. Take the real network in which
+                # the station is. That means, no virtual networks
+                if (netcode[ptStats.network[s]], stacode[s]) in statcodesOK:
                     continue
 
-                statcodesOK.add((ptNets[i][0], ptStats[s][4]))
+                statcodesOK.add((netcode[i], stacode[s]))
                 statsOK.add(s)
 
         return statsOK
 
-    def __buildStreamsList(self, statidx, streamFilter, sensortype=None,
+    def __buildStreamsList(self, inv, statidx, streamFilter, sensortype=None,
                            preferredsps=None, start=None, end=None):
         """Build a list of streams based on a station index
 
         Inputs:
-          statidx: Station index on self.stations
+          inv:     Version of the inventory
+          statidx: Station index on inv.stations
           streamFilter: a list of tuples with two
                         components. The first one is the location code, while
                         the second one is the two first letters of the
@@ -774,56 +1097,54 @@ class InventoryCache(object):
           sensortype:   as received in parameters
           preferredsps: the preferred sample rate. At least one stream is
                         selected from each station.
-          start:        start year in datetime format from parameters sent by
-                        the web client
-          end:          end year in datetime format from parameters sent by
-                        the web client
+          start:        start year in seconds since the epoch from
+                        parameters sent by the web client
+          end:          end year in seconds since the epoch from parameters
+                        sent by the web client
 
         """
 
         if sensortype is not None:
             sensortype = sensortype.strip().split(' ')
 
-        first_child_sensor = self.stations[statidx][1]
-        last_child_sensor = self.stations[statidx][2]
+        first_child_sensor = inv.stations.first[statidx]
+        last_child_sensor = inv.stations.last[statidx]
 
         # Just to make notation shorter
-        ptSens = self.sensorsLoc
-        ptStre = self.streams
+        ptSens = inv.sensorsLoc
+        ptStre = inv.streams
 
         loc_ch = []
         spslist = []
         restr = []
-        for loc in range(first_child_sensor, last_child_sensor):
-            first_child_stream = ptSens[loc][1]
-            last_child_stream = ptSens[loc][2]
+        for loc in xrange(first_child_sensor, last_child_sensor):
+            first_child_stream = ptSens.first[loc]
+            last_child_stream = ptSens.last[loc]
 
-            for ch in range(first_child_stream, last_child_stream):
+            for ch in xrange(first_child_stream, last_child_stream):
 
                 if streamFilter is not None:
-                    if ptStre[ch][1][:2] not in streamFilter:
+                    if ptStre.code[ch][:2] not in streamFilter:
                         continue
 
                 if sensortype is not None:
-                    if (ptStre[ch][2] not in sensortype):
+                    if (ptStre.sensortype[ch] not in sensortype):
                         continue
 
-                if (ptStre[ch][7] is not None) and (start is not None):
-                    if (ptStre[ch][7] < start):
+                # Open epochs are stored as -inf/+inf
+                if start is not None:
+                    if (ptStre.end[ch] < start):
                         continue
 
-                if (ptStre[ch][6] is not None) and (end is not None):
-                    if (end < ptStre[ch][6]):
+                if end is not None:
+                    if (end < ptStre.start[ch]):
                         continue
 
-                loc_ch.append('%s.%s' % (ptSens[loc][4], ptStre[ch][1]))
+                loc_ch.append('%s.%s' % (ptSens.code[loc], ptStre.code[ch]))
                 # Calculate sps for the stream
-                try:
-                    spslist.append(float(ptStre[ch][4] / ptStre[ch][3]))
-                except:
-                    spslist.append(None)
+                spslist.append(ptStre.sps(ch))
 
-                restr.append(self.streams[ch][8])
+                restr.append(ptStre.restricted[ch] or None)
 
         # Extra processing to select only one stream per station if there is a
         # preferred sampling rate
@@ -866,20 +1187,21 @@ class InventoryCache(object):
 
         """
 
-        netsOK = self.__selectNetworks(params)
+        inv = self.refresh()
+        netsOK = self.__selectNetworks(inv, params)
 
         # Just to make notation shorter
-        ptNets = self.networks
+        ptNets = inv.networks
 
         netList = []
         for i in netsOK:
-            netList.append(('%s-%s-%s' % (ptNets[i][0], ptNets[i][4],
-                                          ptNets[i][5]),
+            netList.append((ptNets.key(i),
                             '%s%s%s (%s) - %s [%s]' %
-                            (ptNets[i][0],
-                             '*' if ptNets[i][8] == 't' else ' ',
-                             '+' if ptNets[i][7] == 1 else ' ',
-                             ptNets[i][4], ptNets[i][6], ptNets[i][9])))
+                            (ptNets.code[i],
+                             '*' if ptNets.netclass[i] == 't' else ' ',
+                             '+' if ptNets.restricted[i] == 1 else ' ',
+                             ptNets.start[i] or None, ptNets.description[i],
+                             ptNets.archive[i])))
 
         netList.sort()
         netList.insert(0, ('all', 'All Networks'))
@@ -895,20 +1217,21 @@ class InventoryCache(object):
 
         """
 
-        statsOK = self.__selectStations(params)
+        inv = self.refresh()
+        statsOK = self.__selectStations(inv, params)
 
         # Just to make notation shorter
-        ptNets = self.networks
-        ptStats = self.stations
+        ptNets = inv.networks
+        ptStats = inv.stations
 
         statsList = []
         for i in statsOK:
-            stat = ptStats[i]
-            netw = ptNets[stat[0]]
-            statsList.append(('%s-%s-%s-%s' % (netw[0], netw[4], netw[5],
-                                               stat[4]),
+            netw = ptStats.network[i]
+            statsList.append(('%s-%s' % (ptNets.key(netw), ptStats.code[i]),
                               '%-5s %s %s (%d)' %
-                              (stat[4], netw[0], stat[7], stat[8].year)))
+                              (ptStats.code[i], ptNets.code[netw],
+                               ptStats.description[i],
+                               gmyear(ptStats.start[i]))))
 
         statsList.sort()
         statsList.insert(0, ('all', 'All Stations'))
@@ -925,26 +1248,32 @@ class InventoryCache(object):
         """
 
         # Filter and save indexes of stations in statsOK
-        statsOK = self.__selectStations(params)
+        inv = self.refresh()
+        statsOK = self.__selectStations(inv, params)
 
         # The default dictionary is used to be able to count
         # how many times the keys have been included.
         streamDict = defaultdict(int)
 
+        # Just to make notation shorter
+        ptStats = inv.stations
+        ptSens = inv.sensorsLoc
+        ptStre = inv.streams
+
         # Browse the selected stations
         for statidx in statsOK:
-            first_child_sensor = self.stations[statidx][1]
-            last_child_sensor = self.stations[statidx][2]
+            first_child_sensor = ptStats.first[statidx]
+            last_child_sensor = ptStats.last[statidx]
 
             # Browse the children (sensors) of the current station
-            for senLocidx in range(first_child_sensor, last_child_sensor):
-                first_child_stream = self.sensorsLoc[senLocidx][1]
-                last_child_stream = self.sensorsLoc[senLocidx][2]
+            for senLocidx in xrange(first_child_sensor, last_child_sensor):
+                first_child_stream = ptSens.first[senLocidx]
+                last_child_stream = ptSens.last[senLocidx]
 
                 # Browse the children (streams) of the current sensor
-                for stridx in range(first_child_stream, last_child_stream):
+                for stridx in xrange(first_child_stream, last_child_stream):
                     # FIXME: Streams need to be filtered further with params
-                    streamDict[self.streams[stridx][1][:2]] += 1
+                    streamDict[ptStre.code[stridx][:2]] += 1
 
         streamList = []
         for w in sorted(streamDict, key=streamDict.get, reverse=True):
@@ -961,6 +1290,10 @@ class InventoryCache(object):
         columns, as it is the list to show in the construction of
         the request package.
 
+        The parameters are checked and the stations selected at once, but
+        the list is returned as an iterator: the header and then the rows,
+        built one at a time while they are taken (see __queryRows).
+
         """
 
         try:
@@ -968,7 +1301,7 @@ class InventoryCache(object):
         except (TypeError, ValueError):
             raise wsgicomm.WIClientError, 'Error! Start year is invalid.'
 
-        start_date = datetime.datetime(start_year, 1, 1, 0, 0, 0)
+        start_date = toepoch(datetime.datetime(start_year, 1, 1, 0, 0, 0))
 
         # Build the end date in datetime format
         # Only year-wide windows are allowed here.
@@ -977,7 +1310,7 @@ class InventoryCache(object):
         except:
             raise wsgicomm.WIClientError, 'Error! End year is invalid.'
 
-        end_date = datetime.datetime(end_year, 12, 31, 23, 59, 59)
+        end_date = toepoch(datetime.datetime(end_year, 12, 31, 23, 59, 59))
 
         # Get the network
         # network = params.get('network')
@@ -1107,179 +1440,219 @@ class InventoryCache(object):
                 'incompatible.'
             raise wsgicomm.WIClientError, msg
 
-        # These are the two lists to return
-        stats = []
+        # Stations selected, each with the restriction to show (see
+        # __stationKey)
+        chosen = []
 
         # Filter and save indexes of stations in statsOK
-        statsOK = self.__selectStations(params)
+        inv = self.refresh()
+        statsOK = self.__selectStations(inv, params)
 
         # Just to make notation shorter
-        ptNets = self.networks
-        ptStats = self.stations
+        ptStats = inv.stations
 
         if ('station' in params):
             # Builds a list from the selected stations
             for st in statsOK:
-                parent_net = ptStats[st][0]
-
-                (loc_ch, restricted) = self.__buildStreamsList(st, streams,
-                                                               sensortype,
-                                                               preferredsps,
-                                                               start_date,
-                                                               end_date)
-
-                if len(loc_ch):
-                    stats.append(('%s-%s-%s-%s%s%s' % (ptNets[parent_net][0],
-                                  ptNets[parent_net][4], ptStats[st][4],
-                                  ptStats[st][8].year, ptStats[st][8].month,
-                                  ptStats[st][8].day),  ptNets[parent_net][0],
-                                  ptStats[st][4], ptStats[st][5],
-                                  ptStats[st][6], ptNets[parent_net][7],
-                                  ptNets[parent_net][8], ptNets[parent_net][9],
-                                  ptNets[parent_net][10], loc_ch, restricted))
+                chosen.append((st, False))
 
         elif (latmin is not None and latmax is not None and lonmin is not None
               and lonmax is not None):
 
-            # statsOK is a set and therefore, there will be no repetitions
-            for st in statsOK:
-                # Pointer to the parent network
-                parent_net = ptStats[st][0]
-
-                # Filter by latitude
-                if(ptStats[st][5] < latmin) or (ptStats[st][5] > latmax):
+            # Only the stations in the cells touched by the box are checked
+            for st in inv.grid.box(latmin, latmax, lonmin, lonmax):
+                if st not in statsOK:
                     continue
 
-                # Filter by longitude
-                if(lonmin <= lonmax):
-                    if (ptStats[st][6] < lonmin) or (ptStats[st][6] > lonmax):
-                        continue
-                else:
-                    if (ptStats[st][6] < lonmin) and (ptStats[st][6] > lonmax):
-                        continue
-
-                (loc_ch, restricted) = self.__buildStreamsList(st, streams,
-                                                               sensortype,
-                                                               preferredsps,
-                                                               start_date,
-                                                               end_date)
-
-                if len(loc_ch):
-                    stats.append(('%s-%s-%s-%s%s%s' %
-                                  (ptNets[parent_net][0],
-                                   ptNets[parent_net][4], ptStats[st][4],
-                                   ptStats[st][8].year, ptStats[st][8].month,
-                                   ptStats[st][8].day),
-                                  ptNets[parent_net][0],
-                                  ptStats[st][4], ptStats[st][5],
-                                  ptStats[st][6], ptNets[parent_net][7],
-                                  ptNets[parent_net][8], ptNets[parent_net][9],
-                                  ptNets[parent_net][10], loc_ch, restricted))
+                chosen.append((st, False))
 
         elif events is not None:
 
             events = json.loads(events)
 
-            for st in statsOK:
-                # Pointer to the parent network
-                parent_net = ptStats[st][0]
-
-                # Retrieve latitude and longitude of station
-                slat = ptStats[st][5]
-                slon = ptStats[st][6]
-
-                for evt in events:
-                    # Retrieve latitude and longitude of event
-                    lat = evt[0]
-                    lon = evt[1]
-
-                    # Calculate radial distance and azimuth
-                    (dist, azi, other) = Math.delazi(slat, slon, lat, lon)
-
-                    if (minradius < dist) and (dist < maxradius) and \
-                       (minazimuth < azi) and (azi < maxazimuth):
-                        (loc_ch, restricted) = \
-                            self.__buildStreamsList(st, streams, sensortype,
-                                                    preferredsps, start_date,
-                                                    end_date)
-
-                        if len(loc_ch):
-                            stats.append(('%s-%s-%s-%s%s%s' %
-                                          (ptNets[parent_net][0],
-                                           ptNets[parent_net][4],
-                                           ptStats[st][4],
-                                           ptStats[st][8].year,
-                                           ptStats[st][8].month,
-                                           ptStats[st][8].day),
-                                          ptNets[parent_net][0],
-                                          ptStats[st][4], ptStats[st][5],
-                                          ptStats[st][6],
-                                          ptStats[st][11],
-                                          ptNets[parent_net][8],
-                                          ptNets[parent_net][9],
-                                          ptNets[parent_net][10], loc_ch,
-                                          restricted))
-
-                        # Stop the loop through events and go for the
-                        # next station
-                        break
+            # Stations close enough to at least one event
+            selected = set()
+
+            # As before, stations are never selected without maxradius or
+            # maxazimuth
+            if maxradius is None or maxazimuth is None:
+                events = []
+
+            for evt in events:
+                # Retrieve latitude and longitude of event
+                lat = evt[0]
+                lon = evt[1]
+
+                # Only the stations around the event are checked
+                cand = [st for st in inv.grid.candidates(lat, lon, maxradius)
+                        if st in statsOK and st not in selected]
+
+                # Radial distance and azimuth from every station
+                reached = geodist.reached([ptStats.latitude[st] for st in cand],
+                                          [ptStats.longitude[st]
+                                           for st in cand],
+                                          [lat], [lon], minradius, maxradius,
+                                          minazimuth, maxazimuth)
+
+                selected.update(st for st, ok in zip(cand, reached) if ok)
+
+            for st in selected:
+                chosen.append((st, ptStats.restricted[st] or None))
 
         else:
             msg = 'Error: not enough parameters have been given.'
             raise wsgicomm.WIClientError, msg
 
-        stats.sort()
+        # Sorted by the columns of the station, before the streams
+        chosen.sort(key=lambda (st, statRestricted):
+                    self.__stationKey(inv, st, statRestricted))
 
-        stats.insert(0, ('key', 'netcode', 'statcode', 'latitude', 'longitude',
-                         'restricted', 'netclass', 'archive', 'netoperator',
-                         'streams', 'streams_restricted'))
+        return self.__queryRows(inv, chosen, streams, sensortype,
+                                preferredsps, start_date, end_date)
 
-        return stats
+    def __queryRows(self, inv, chosen, streams, sensortype, preferredsps,
+                    start_date, end_date):
+        """Header and rows of getQuery, for the stations chosen with
+        streams matching the parameters. The streams of a station are only
+        looked for when its row is taken.
+
+        """
+
+        yield ('key', 'netcode', 'statcode', 'latitude', 'longitude',
+               'restricted', 'netclass', 'archive', 'netoperator',
+               'streams', 'streams_restricted')
+
+        for st, statRestricted in chosen:
+            (loc_ch, restricted) = self.__buildStreamsList(inv, st, streams,
+                                                           sensortype,
+                                                           preferredsps,
+                                                           start_date,
+                                                           end_date)
+
+            if len(loc_ch):
+                yield self.__stationKey(inv, st, statRestricted) + \
+                    (loc_ch, restricted)
+
+    def __stationKey(self, inv, st, statRestricted=False):
+        """Build the columns of a station in the result of getQuery, all
+        but its streams.
+
+        The restriction shown is the one of the parent network, unless
+        statRestricted is given.
+
+        """
+
+        ptNets = inv.networks
+        ptStats = inv.stations
+
+        # Pointer to the parent network
+        parent_net = ptStats.network[st]
+        start = time.gmtime(ptStats.start[st])
+
+        if statRestricted is False:
+            statRestricted = ptNets.restricted[parent_net] or None
+
+        return ('%s-%s-%s-%s%s%s' % (ptNets.code[parent_net],
+                                     ptNets.start[parent_net] or None,
+                                     ptStats.code[st], start.tm_year,
+                                     start.tm_mon, start.tm_mday),
+                ptNets.code[parent_net], ptStats.code[st],
+                ptStats.get('latitude', st), ptStats.get('longitude', st),
+                statRestricted, ptNets.netclass[parent_net],
+                ptNets.archive[parent_net], ptNets.institutions[parent_net])
 
     def getStreamInfo(self, start_time, end_time, net, sta, cha, loc):
-        try:
-            stream_epochs = self.streamidx[(net, sta, cha, loc)]
-        except KeyError:
-            logs.error("%s,%s,%s,%s not found" % (net, sta, cha, loc))
-            return None
+        """Coordinates of a stream and estimated size of its data in a time
+        window (see getStreamInfoMany), or None.
+
+        """
+
+        return self.getStreamInfoMany([(start_time, end_time,
+                                        (net, sta, cha, loc))])[0]
+
+    def getStreamInfoMany(self, windows):
+        """Look up many streams at once.
+
+        windows is a sequence of (START_TIME, END_TIME, (NET, STA, CHA,
+        LOC)), with times as datetime. For every one, the result contains
+        a dictionary with the latitude, longitude and elevation of the
+        stream and the estimated size of its data in the time window, or
+        None if the stream does not exist or has no epoch overlapping the
+        window.
 
-        for stream in stream_epochs:
+        """
+
+        inv = self.current
+
+        # Just to make notation shorter
+        ptStats = inv.stations
+        ptSens = inv.sensorsLoc
+        ptStre = inv.streams
+        index = inv.streamidx
+
+        # Epochs without end are taken as ending one year from now
+        openend = time.time() + 365 * 86400
+
+        # Position of every key in the index and times in seconds since the
+        # epoch, as the same ones are usually looked up many times in a
+        # request. They are only kept for the request, as the keys come
+        # from the client.
+        keys = {}
+        epochs = {}
+
+        def epoch(t):
             try:
-                station = self.stations[self.sensorsLoc[stream[0]][0]]
+                return epochs[t]
+            except KeyError:
+                value = epochs[t] = toepoch(t)
+                return value
 
-            except IndexError:
-                logs.error("cache inconsistency")
-                return None
+        result = []
+        for (start_time, end_time, key) in windows:
+            try:
+                i = keys[key]
+            except KeyError:
+                i = keys[key] = index.find(key)
+                if i < 0:
+                    logs.error("%s,%s,%s,%s not found" % key)
+
+            if i < 0:
+                result.append(None)
+                continue
+
+            stream = index.overlapping(i, ptStre, epoch(start_time),
+                                       epoch(end_time), openend)
+            if stream < 0:
+                result.append(None)
+                continue
 
-            # stream_start = datetime.datetime(station[8], 1, 1)
-            # stream_end = datetime.datetime(station[9], 1, 1) if station[9] \
-            #         else datetime.datetime(2030, 1, 1)
-            stream_start = stream[6]
-            stream_end = stream[7] if stream[7] is not None \
-                else (datetime.datetime.now() + datetime.timedelta(days=365))
+            try:
+                station = ptSens.station[ptStre.sensorLoc[stream]]
 
-            if start_time >= stream_end or end_time <= stream_start:
+            except IndexError:
+                logs.error("cache inconsistency")
+                result.append(None)
                 continue
 
-            result = {'latitude': station[5],
-                      'longitude': station[6],
-                      'elevation': station[10]}
+            info = {'latitude': ptStats.get('latitude', station),
+                    'longitude': ptStats.get('longitude', station),
+                    'elevation': ptStats.get('elevation', station)}
 
-            if stream[3] != 0:
+            samp = ptStre.sps(stream)
+            if samp is not None:
                 tdiff = end_time - start_time
                 tdiff = tdiff.days * 86400 + tdiff.seconds
-                samp = float(stream[4]) / float(stream[3])
 
                 # assuming approximately 1 byte per sample (compressed),
                 # 512 bytes record size
                 bytesper = 1
                 recsize = 512
-                result['size'] = int(recsize * math.ceil(
-                                     float(tdiff * samp * bytesper) / recsize))
+                info['size'] = int(recsize * math.ceil(
+                                   float(tdiff * samp * bytesper) / recsize))
 
             else:
-                result['size'] = 0
+                info['size'] = 0
 
-            return result
+            result.append(info)
 
-        return None
+        return result
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# Inverted indexes over the networks and stations of the InventoryCache
+#
+# ----------------------------------------------------------------------
+
+
+"""Inverted indexes over the networks and stations of the InventoryCache
+
+Copyright (C) 2016 GEOFON team, Helmholtz-Zentrum Potsdam - Deutsches GeoForschungsZentrum GFZ
+
+The menus of the web interface select networks by key, type and years and
+stations by key and time. Instead of looking at every network and station
+for every request, the InventoryIndex keeps, for one version of the tables:
+
+  - the index of every network key (CODE-START-END)
+  - the networks of every network type
+  - the stations with every station key (NETWORK KEY-CODE) and the
+    virtual networks including every station
+  - the stations sorted by start and by end of their epoch, so that the
+    stations not operating in a time window are found by binary search
+
+The index is built every time that the inventory is refreshed.
+
+
+This program is free software; you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 2, or (at your option) any later
+version. For more information, see http://www.gnu.org/
+
+"""
+
+import array
+import bisect
+
+
+class InventoryIndex(object):
+    """Indexes of a NetworkTable and a StationTable.
+
+    nettypes are the types of network as defined in the InventoryCache:
+    (CODE, DESCRIPTION, PERMANENT, RESTRICTED).
+
+    """
+
+    def __init__(self, networks, stations, nettypes):
+        # Network key -> first network with that key
+        self.netkeys = {}
+        for i in xrange(len(networks)):
+            self.netkeys.setdefault(networks.key(i), i)
+
+        # Network type -> networks of that type, in ascending order
+        self.nettypes = {}
+        for (code, desc, permanent, restricted) in nettypes:
+            nets = array.array('i')
+            for i in xrange(len(networks)):
+                if restricted is not None and \
+                   networks.restricted[i] != restricted:
+                    continue
+
+                if permanent is not None:
+                    if permanent and (networks.netclass[i] == 't'):
+                        continue
+
+                    if (not permanent) and (networks.netclass[i] == 'p'):
+                        continue
+
+                if code == 'virt' and not networks.isvirtual(i):
+                    continue
+
+                nets.append(i)
+
+            self.nettypes.setdefault(code, nets)
+
+        # Codes of networks and stations as small integers, to compare
+        # (network code, station code) pairs cheaply
+        ids = {}
+        self.netcode = array.array('i', [ids.setdefault(networks.code[i],
+                                                        len(ids))
+                                         for i in xrange(len(networks))])
+        self.stacode = array.array('i', [ids.setdefault(stations.code[s],
+                                                        len(ids))
+                                         for s in xrange(len(stations))])
+
+        # Station key (NETWORK KEY-CODE, as used by the web client) ->
+        # stations with that key
+        self.stationkeys = {}
+        for s in xrange(len(stations)):
+            key = '%s-%s' % (networks.key(stations.network[s]),
+                             stations.code[s])
+            self.stationkeys.setdefault(key, []).append(s)
+
+        # Station -> virtual networks including it
+        self.virtual = {}
+        for i in xrange(len(networks)):
+            if networks.isvirtual(i):
+                for s in networks.children(i):
+                    self.virtual.setdefault(s, []).append(i)
+
+        # Stations sorted by start and by end of their epoch
+        self.bystart = array.array('i', sorted(xrange(len(stations)),
+                                               key=stations.start.__getitem__))
+        self.starts = array.array('d', [stations.start[s]
+                                        for s in self.bystart])
+
+        self.byend = array.array('i', sorted(xrange(len(stations)),
+                                             key=stations.end.__getitem__))
+        self.ends = array.array('d', [stations.end[s] for s in self.byend])
+
+    def outside(self, start, end):
+        """Set of the stations which stopped before start or started after
+        end (times in seconds since the epoch).
+
+        """
+
+        result = set(self.byend[:bisect.bisect_left(self.ends, start)])
+        result.update(self.bystart[bisect.bisect_right(self.starts, end):])
+        return result
@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+#
+# Memory-mapped snapshot of the InventoryCache of the Arclink web interface
+#
+# ----------------------------------------------------------------------
+
+
+"""Memory-mapped snapshot of the InventoryCache
+
+Copyright (C) 2016 GEOFON team, Helmholtz-Zentrum Potsdam - Deutsches GeoForschungsZentrum GFZ
+
+The tables of the InventoryCache (see invtables) are written to a binary
+file, one fixed-width array per column, plus a heap with all the distinct
+strings. Every process of the web interface maps this file in memory
+instead of parsing the XML inventory or loading a private copy of it.
+Attaching to a snapshot takes a few milliseconds and all the processes
+share the same pages through the page cache of the OS.
+
+Layout of the file:
+  HEADER     magic, schema version, checksum, build time, size and MD5
+             digest of the XML file it comes from, offset and length of
+             the directory (little-endian)
+  ARRAYS     column and extra arrays, 8-byte aligned, native byte order
+  STRINGS    offsets (n + 1 integers) and heap with the strings in UTF-8
+  DIRECTORY  JSON document describing where everything is
+
+The checksum is the CRC-32 of everything after the header followed by the
+header with a null checksum. Computing it touches every page of the file,
+so it is only verified by the first process which maps a snapshot; the
+others only check the header and the size of the file (see verifyOnce). Nothing in the file is executed when it is
+loaded: the directory is plain JSON and the rest is raw data.
+
+To tell whether the XML file changed, recorded_fingerprint keeps its
+fingerprint next to the snapshot, with its size and time of modification,
+so that it is only read again when these change.
+
+VERSION must be increased whenever the layout of the file or of the tables
+changes. Snapshots of another version are rejected and the inventory is
+parsed again.
+
+The mapping is private (copy-on-write) only because ctypes needs a
+writable buffer; nothing is ever written to it, so the pages are never
+copied.
+
+
+This program is free software; you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 2, or (at your option) any later
+version. For more information, see http://www.gnu.org/
+
+"""
+
+import array
+import ctypes
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import tempfile
+import hashlib
+import zlib
+
+from invtables import KINDS
+
+MAGIC = 'WIINVSNP'
+
+# Schema version
+VERSION = 3
+
+# MAGIC, VERSION, CHECKSUM, BUILT, SOURCE SIZE, SOURCE DIGEST,
+# DIRECTORY OFFSET, DIRECTORY LENGTH
+_HEADER = struct.Struct('<8sIIdQ16sQQ')
+
+# Bytes read at once to compute digests and checksums
+_BLOCK = 1 << 20
+
+_ALIGN = 8
+
+_CTYPES = {'b': ctypes.c_byte,
+           'h': ctypes.c_short,
+           'i': ctypes.c_int,
+           'd': ctypes.c_double}
+
+
+class SnapshotError(Exception):
+    """The file is not a valid snapshot for this host."""
+
+
+def fingerprint(path):
+    """Size and MD5 digest of a file, to identify the XML inventory from
+    which a snapshot was built.
+
+    """
+
+    digest = hashlib.md5()
+    size = 0
+
+    with open(path, 'rb') as fileobj:
+        while True:
+            data = fileobj.read(_BLOCK)
+            if not data:
+                break
+
+            digest.update(data)
+            size += len(data)
+
+    return (size, digest.digest())
+
+
+def recorded_fingerprint(path, record):
+    """fingerprint(path), without reading the file if it has the same size
+    and time of modification as when the fingerprint was last computed.
+
+    The fingerprint is kept with these in the file record (next to the
+    snapshot, in JSON), so that every process can check the XML file
+    cheaply. Failing to write it only means that it is computed again.
+
+    """
+
+    st = os.stat(path)
+    stamp = [st.st_size, st.st_mtime]
+
+    try:
+        with open(record) as fileobj:
+            known = json.load(fileobj)
+
+        if known['stamp'] == stamp:
+            return (known['size'], known['md5'].decode('hex'))
+
+    except Exception:
+        pass
+
+    source = fingerprint(path)
+
+    # The file may have changed while it was read
+    st = os.stat(path)
+    if [st.st_size, st.st_mtime] != stamp:
+        return source
+
+    try:
+        fd, tmpname = tempfile.mkstemp(prefix='.webinterface-',
+                                       dir=os.path.dirname(record) or '.')
+        with os.fdopen(fd, 'w') as fileobj:
+            json.dump({'stamp': stamp, 'size': source[0],
+                       'md5': source[1].encode('hex')}, fileobj)
+
+        os.chmod(tmpname, 0664)
+        os.rename(tmpname, record)
+
+    except (IOError, OSError):
+        pass
+
+    return source
+
+
+def _crc(data, start, end, value=0):
+    """CRC-32 of data[start:end], continuing from value."""
+
+    for pos in xrange(start, end, _BLOCK):
+        value = zlib.crc32(buffer(data, pos, min(_BLOCK, end - pos)), value)
+
+    return value
+
+
+class StringHeap(object):
+    """Strings of a snapshot, decoded only when they are used.
+
+    Decoded strings are kept, so that every distinct string exists only
+    once in the memory of a process. Pure ASCII strings are returned as str
+    and any other as unicode, as ElementTree does.
+
+    """
+
+    def __init__(self, mm, offsets, base):
+        self.mm = mm
+        self.offsets = offsets
+        self.base = base
+        self.cache = {}
+
+    def __getitem__(self, i):
+        if i < 0:
+            return None
+
+        try:
+            return self.cache[i]
+
+        except KeyError:
+            s = self.mm[self.base + self.offsets[i]:
+                        self.base + self.offsets[i + 1]]
+            try:
+                s.decode('ascii')
+            except UnicodeDecodeError:
+                s = s.decode('utf-8')
+
+            self.cache[i] = s
+            return s
+
+
+class StringColumn(object):
+    """Column of strings stored as indexes into a StringHeap."""
+
+    def __init__(self, ids, strings):
+        self.ids = ids
+        self.strings = strings
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            # Most strings are already decoded
+            cache = self.strings.cache
+            strings = self.strings
+            return [cache[j] if j in cache else strings[j]
+                    for j in self.ids[i]]
+
+        return self.strings[self.ids[i]]
+
+    def __iter__(self):
+        strings = self.strings
+        for j in self.ids:
+            yield strings[j]
+
+
+class _Writer(object):
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.strings = {}
+        self.directory = {'byteorder': sys.byteorder, 'tables': {}}
+
+        # CRC-32 of everything written after the header
+        self.crc = 0
+
+        self.fileobj.write('\0' * _HEADER.size)
+        self.pos = _HEADER.size
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.crc = zlib.crc32(data, self.crc)
+        self.pos += len(data)
+
+    def array(self, arr):
+        """Write an array and return its description."""
+
+        self.write('\0' * (-self.pos % _ALIGN))
+        offset = self.pos
+        self.write(arr.tostring())
+        return (arr.typecode, offset, len(arr))
+
+    def stringid(self, s):
+        if s is None:
+            return -1
+
+        return self.strings.setdefault(s, len(self.strings))
+
+    def table(self, name, table):
+        columns = {}
+        for col, kind in table.layout:
+            values = getattr(table, col)
+            if kind == 'str':
+                values = array.array('i', [self.stringid(s) for s in values])
+
+            columns[col] = self.array(values)
+
+        arrays = {}
+        for col in table.arrays:
+            arrays[col] = self.array(getattr(table, col))
+
+        self.directory['tables'][name] = {'columns': columns,
+                                          'arrays': arrays}
+
+    def close(self, source, built):
+        heap = [None] * len(self.strings)
+        for s, i in self.strings.iteritems():
+            heap[i] = s.encode('utf-8') if isinstance(s, unicode) else s
+
+        offsets = array.array('i', [0])
+        for s in heap:
+            offsets.append(offsets[-1] + len(s))
+
+        self.directory['strings'] = {'offsets': self.array(offsets),
+                                     'heap': self.pos}
+        self.write(''.join(heap))
+
+        directory = json.dumps(self.directory)
+        self.write('\0' * (-self.pos % _ALIGN))
+        offset = self.pos
+        self.write(directory)
+
+        (size, digest) = source
+        fields = [MAGIC, VERSION, 0, built, size, digest, offset,
+                  len(directory)]
+        fields[2] = zlib.crc32(_HEADER.pack(*fields), self.crc) & 0xffffffff
+
+        self.fileobj.seek(0)
+        self.fileobj.write(_HEADER.pack(*fields))
+
+
+def write(path, tables, source=(0, '')):
+    """Write a snapshot with the given (NAME, TABLE) pairs.
+
+    source is the fingerprint of the XML file from which the tables were
+    built (see fingerprint).
+
+    The snapshot is written to a temporary file which then replaces path,
+    so that processes still using a previous snapshot keep a valid mapping
+    and no process ever maps an incomplete file.
+
+    """
+
+    fd, tmpname = tempfile.mkstemp(prefix='.webinterface-',
+                                   dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as fileobj:
+            writer = _Writer(fileobj)
+            for name, table in tables:
+                writer.table(name, table)
+            writer.close(source, time.time())
+
+        os.chmod(tmpname, 0664)
+        os.rename(tmpname, path)
+
+    except:
+        os.remove(tmpname)
+        raise
+
+
+class Snapshot(object):
+    """A snapshot mapped in memory.
+
+    Only the header and the directory are checked when the file is mapped;
+    verify() checks the whole file against its checksum. built is the time
+    at which the file was written (in seconds since the epoch) and source
+    the fingerprint of the XML file.
+
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as fileobj:
+            self.mm = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        if len(self.mm) < _HEADER.size:
+            raise SnapshotError('%s is too short' % path)
+
+        (magic, version, self.checksum, self.built, size, digest, offset,
+         length) = _HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise SnapshotError('%s is not an inventory snapshot' % path)
+
+        if version != VERSION:
+            raise SnapshotError('%s has version %d instead of %d' %
+                                (path, version, VERSION))
+
+        # The directory is written last
+        if offset + length > len(self.mm):
+            raise SnapshotError('%s is truncated' % path)
+
+        if offset + length < len(self.mm):
+            raise SnapshotError('%s has trailing data' % path)
+
+        self.path = path
+        self.source = (size, digest)
+
+        self.directory = json.loads(self.mm[offset:offset + length])
+
+        if self.directory['byteorder'] != sys.byteorder:
+            raise SnapshotError('%s was written on a %s-endian host' %
+                                (path, self.directory['byteorder']))
+
+        strings = self.directory['strings']
+        self.strings = StringHeap(self.mm, self.array(strings['offsets']),
+                                  strings['heap'])
+
+    def verify(self):
+        """Raise SnapshotError if the file does not match its checksum."""
+
+        header = _HEADER.unpack_from(self.mm, 0)
+        header = _HEADER.pack(*(header[:2] + (0,) + header[3:]))
+
+        crc = _crc(self.mm, _HEADER.size, len(self.mm))
+        if zlib.crc32(header, crc) & 0xffffffff != self.checksum:
+            raise SnapshotError('%s is corrupted' % self.path)
+
+    def verifyOnce(self, record):
+        """verify() the file, unless the file record (next to the snapshot)
+        tells that it was already done for this snapshot, by this or by
+        another process. The verification is noted there otherwise; failing
+        to write it only means that the next process verifies it again.
+
+        """
+
+        stamp = [self.checksum, self.built]
+
+        try:
+            with open(record) as fileobj:
+                if json.load(fileobj) == stamp:
+                    return
+
+        except Exception:
+            pass
+
+        self.verify()
+
+        try:
+            fd, tmpname = tempfile.mkstemp(prefix='.webinterface-',
+                                           dir=os.path.dirname(record) or '.')
+            with os.fdopen(fd, 'w') as fileobj:
+                json.dump(stamp, fileobj)
+
+            os.chmod(tmpname, 0664)
+            os.rename(tmpname, record)
+
+        except (IOError, OSError):
+            pass
+
+    def array(self, desc):
+        """Map an array described in the directory."""
+
+        typecode, offset, length = desc
+        return (_CTYPES[typecode] * length).from_buffer(self.mm, offset)
+
+    def table(self, name, cls):
+        """Return the table "name" as an instance of cls (a Table class)
+        backed by the snapshot.
+
+        """
+
+        desc = self.directory['tables'][name]
+
+        table = cls.__new__(cls)
+        table.kinds = dict(cls.layout)
+
+        for col, kind in cls.layout:
+            values = self.array(desc['columns'][col])
+            if KINDS[kind][0] is None:
+                values = StringColumn(values, self.strings)
+
+            setattr(table, col, values)
+
+        for col in cls.arrays:
+            setattr(table, col, self.array(desc['arrays'][col]))
+
+        return table
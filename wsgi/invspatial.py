@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+#
+# Spatial index over the stations of the InventoryCache
+#
+# ----------------------------------------------------------------------
+
+
+"""Spatial index over the stations of the InventoryCache
+
+Copyright (C) 2016 GEOFON team, Helmholtz-Zentrum Potsdam - Deutsches GeoForschungsZentrum GFZ
+
+The stations are distributed in a regular grid of latitude/longitude cells.
+The indexes of the stations are sorted by cell, so that the stations of a
+run of consecutive cells in the same row are a single slice of one array.
+Rectangles (also crossing the dateline) and circles around a point are
+answered by looking only at the cells that they touch.
+
+The grid is built from the table of stations every time that the inventory
+is refreshed. It takes a few milliseconds also for large inventories.
+
+
+This program is free software; you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 2, or (at your option) any later
+version. For more information, see http://www.gnu.org/
+
+"""
+
+import array
+import math
+
+
+class StationGrid(object):
+    """Grid of cells of "size" degrees with the stations of a StationTable.
+
+    Stations with coordinates out of the usual ranges are not placed in any
+    cell and are always returned as candidates. Stations without
+    coordinates (NaN) are left out, as they can never be selected.
+
+    """
+
+    # Extra distance (in degrees) added to the radius when looking for
+    # candidates, so that the cells cover the whole circle even if the
+    # distances are later computed on an ellipsoid and not on a sphere.
+    MARGIN = 0.5
+
+    def __init__(self, stations, size=2.0):
+        self.size = float(size)
+        self.nrows = int(math.ceil(180.0 / self.size))
+        self.ncols = int(math.ceil(360.0 / self.size))
+
+        self.latitude = stations.latitude
+        self.longitude = stations.longitude
+
+        # Stations which are not in any cell
+        self.outside = array.array('i')
+
+        cells = []
+        for st in xrange(len(stations)):
+            lat = self.latitude[st]
+            lon = self.longitude[st]
+
+            if lat != lat or lon != lon:
+                continue
+
+            if -90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0:
+                cells.append((self.__row(lat) * self.ncols + self.__col(lon),
+                              st))
+            else:
+                self.outside.append(st)
+
+        cells.sort()
+
+        # The stations of cell c are order[start[c]:start[c + 1]]
+        self.order = array.array('i', [st for c, st in cells])
+        self.start = array.array('i', [0] * (self.nrows * self.ncols + 1))
+
+        for c, st in cells:
+            self.start[c + 1] += 1
+
+        for c in xrange(len(self.start) - 1):
+            self.start[c + 1] += self.start[c]
+
+    def __len__(self):
+        return len(self.order) + len(self.outside)
+
+    def __row(self, lat):
+        return min(int((lat + 90.0) / self.size), self.nrows - 1)
+
+    def __col(self, lon):
+        return min(int((lon + 180.0) / self.size), self.ncols - 1)
+
+    def __cells(self, latmin, latmax, ranges):
+        """Stations in the cells touched by the rectangles from latmin to
+        latmax and every (LONMIN, LONMAX) in ranges, followed by the
+        stations which are not in any cell.
+
+        Every rectangle must lie within the usual ranges of latitude and
+        longitude and no cell may be touched by two of them.
+
+        """
+
+        if latmin <= latmax:
+            rows = xrange(self.__row(latmin), self.__row(latmax) + 1)
+            for lonmin, lonmax in ranges:
+                if lonmin > lonmax:
+                    continue
+
+                c0 = self.__col(lonmin)
+                c1 = self.__col(lonmax)
+                for row in rows:
+                    first = self.start[row * self.ncols + c0]
+                    last = self.start[row * self.ncols + c1 + 1]
+                    for st in self.order[first:last]:
+                        yield st
+
+        for st in self.outside:
+            yield st
+
+    def box(self, latmin, latmax, lonmin, lonmax):
+        """Indexes of the stations within a rectangle.
+
+        If lonmin is greater than lonmax the rectangle crosses the dateline.
+        Borders are included. The comparisons are done on the coordinates
+        as they are, without normalizing them.
+
+        """
+
+        if lonmin <= lonmax:
+            ranges = [(max(lonmin, -180.0), min(lonmax, 180.0))]
+        else:
+            ranges = [(-180.0, min(lonmax, 180.0)),
+                      (max(lonmin, -180.0), 180.0)]
+
+        return self.__filter(self.__cells(max(latmin, -90.0),
+                                          min(latmax, 90.0),
+                                          self.__merge(ranges)),
+                             latmin, latmax, lonmin, lonmax)
+
+    def __filter(self, stations, latmin, latmax, lonmin, lonmax):
+        latitude = self.latitude
+        longitude = self.longitude
+
+        result = set()
+        for st in stations:
+            lat = latitude[st]
+            lon = longitude[st]
+
+            if not (latmin <= lat <= latmax):
+                continue
+
+            if lonmin <= lonmax:
+                if not (lonmin <= lon <= lonmax):
+                    continue
+            elif not (lon >= lonmin or lon <= lonmax):
+                continue
+
+            result.add(st)
+
+        return result
+
+    def candidates(self, lat, lon, radius):
+        """Indexes of the stations which may be closer than radius (in
+        degrees) to the point (lat, lon).
+
+        All the stations within that great-circle distance are returned,
+        but also some others. The caller is expected to compute the exact
+        distance of every candidate.
+
+        """
+
+        r = radius + self.MARGIN
+
+        latmin = max(lat - r, -90.0)
+        latmax = min(lat + r, 90.0)
+
+        # Maximum difference of longitude between the centre and any point
+        # of the circle. If the circle includes a pole, all of them.
+        if r >= 90.0 - abs(lat):
+            dlon = 180.0
+        else:
+            dlon = math.degrees(math.asin(math.sin(math.radians(r)) /
+                                          math.cos(math.radians(lat))))
+
+        lon = (lon + 180.0) % 360.0 - 180.0
+        lonmin = lon - dlon
+        lonmax = lon + dlon
+
+        if dlon >= 180.0:
+            ranges = [(-180.0, 180.0)]
+        elif lonmin < -180.0:
+            # The circle crosses the dateline
+            ranges = [(-180.0, lonmax), (lonmin + 360.0, 180.0)]
+        elif lonmax > 180.0:
+            ranges = [(-180.0, lonmax - 360.0), (lonmin, 180.0)]
+        else:
+            ranges = [(lonmin, lonmax)]
+
+        return self.__cells(latmin, latmax, self.__merge(ranges))
+
+    def __merge(self, ranges):
+        """Join the two parts of a range of longitudes crossing the
+        dateline if they touch the same cell.
+
+        """
+
+        if len(ranges) == 2 and ranges[0][0] <= ranges[0][1] and \
+           ranges[1][0] <= ranges[1][1] and \
+           self.__col(ranges[0][1]) >= self.__col(ranges[1][0]):
+            return [(-180.0, 180.0)]
+
+        return ranges
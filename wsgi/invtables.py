@@ -0,0 +1,573 @@
+#!/usr/bin/env python
+#
+# Columnar tables for the InventoryCache of the Arclink web interface
+#
+# ----------------------------------------------------------------------
+
+
+"""Columnar tables for the InventoryCache of the Arclink web interface
+
+Copyright (C) 2016 GEOFON team, Helmholtz-Zentrum Potsdam - Deutsches GeoForschungsZentrum GFZ
+
+Every level of the inventory (networks, stations, sensor locations and
+streams) is kept in a Table. A Table stores one typed array per attribute
+instead of one Python list per row. Times are kept as seconds since the
+epoch and strings are shared between rows, so that a whole inventory fits
+in a small fraction of the memory needed by lists of lists.
+
+Rows can still be read by position (table[i]) in the layout of the former
+lists, but this is only meant for code that is not performance critical.
+
+
+This program is free software; you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 2, or (at your option) any later
+version. For more information, see http://www.gnu.org/
+
+"""
+
+import array
+import bisect
+import calendar
+import datetime
+import time
+import zlib
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+NAN = float('nan')
+INF = float('inf')
+
+# Storage of every kind of column. The columns are:
+# ARRAY TYPECODE (None for a list), VALUE STORED INSTEAD OF None
+KINDS = {'idx': ('i', -1),
+         'year': ('h', 0),
+         'flag': ('b', 0),
+         'float': ('d', NAN),
+         'time': ('d', NAN),
+         'str': (None, None)}
+
+
+def toepoch(dt):
+    """Convert a (naive, UTC) datetime to seconds since the epoch."""
+
+    if dt.tzinfo is None:
+        delta = dt - _EPOCH
+        return delta.days * 86400 + delta.seconds + \
+            delta.microseconds / 1000000.0
+
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1000000.0
+
+
+# Ordinal of 1970-01-01 (see datetime.date.toordinal)
+_EPOCH_ORDINAL = 719163
+
+
+def parsetime(s):
+    """Convert a time as found in the Arclink inventory
+    (YYYY-MM-DDTHH:MM:SS[.ffff]Z) to seconds since the epoch.
+
+    This is several times faster than datetime.strptime. ValueError is
+    raised if the string does not have this format.
+
+    """
+
+    if s[4] != '-' or s[7] != '-' or s[10] != 'T' or s[13] != ':' or \
+       s[16] != ':' or s[-1] != 'Z':
+        raise ValueError('Invalid time: %s' % s)
+
+    days = datetime.date(int(s[0:4]), int(s[5:7]),
+                         int(s[8:10])).toordinal() - _EPOCH_ORDINAL
+    secs = int(s[11:13]) * 3600 + int(s[14:16]) * 60 + int(s[17:19])
+
+    if len(s) > 20:
+        if s[19] != '.':
+            raise ValueError('Invalid time: %s' % s)
+
+        secs += float(s[19:-1])
+
+    return days * 86400.0 + secs
+
+
+def fromepoch(secs):
+    """Convert seconds since the epoch to a (naive, UTC) datetime."""
+
+    return _EPOCH + datetime.timedelta(seconds=secs)
+
+
+def isfinite(value):
+    """False for None, NaN and both infinities."""
+
+    return value is not None and value - value == 0.0
+
+
+def gmyear(secs):
+    """Year of a time given in seconds since the epoch."""
+
+    return time.gmtime(secs).tm_year
+
+
+class Table(object):
+    """Columnar storage for one level of the inventory.
+
+    The columns are declared in "layout" as (NAME, KIND) pairs and are
+    available as attributes of the table with the same name. "rowlayout"
+    tells which column goes in every position of a row as returned by
+    table[i] (None for an unused, reserved position). "arrays" names
+    extra integer arrays, not aligned with the rows, owned by the table.
+
+    Columns only need to support len() and indexing, so that a table can
+    also be backed by a memory-mapped snapshot (see invsnapshot).
+
+    """
+
+    layout = ()
+    rowlayout = ()
+    arrays = ()
+
+    def __init__(self):
+        for name, kind in self.layout:
+            typecode = KINDS[kind][0]
+            setattr(self, name, [] if typecode is None else
+                    array.array(typecode))
+
+        for name in self.arrays:
+            setattr(self, name, array.array('i'))
+
+        self.kinds = dict(self.layout)
+
+    def __len__(self):
+        return len(getattr(self, self.layout[0][0]))
+
+    def append(self, *values):
+        """Append a row. Values are given in the order of the layout."""
+
+        for (name, kind), value in zip(self.layout, values):
+            if value is None:
+                value = KINDS[kind][1]
+
+            getattr(self, name).append(value)
+
+    def extend(self, other):
+        """Append all the rows of another table of the same class.
+
+        The extra arrays are appended as they are, so any index into them
+        must be valid in both tables.
+
+        """
+
+        for name, kind in self.layout:
+            getattr(self, name).extend(getattr(other, name))
+
+        for name in self.arrays:
+            getattr(self, name).extend(getattr(other, name))
+
+    def copyrows(self, other, first, last, shift={}):
+        """Append rows first to last (excluded) of another table of the
+        same class, adding shift[NAME] to the values of column NAME.
+
+        """
+
+        for name, kind in self.layout:
+            values = getattr(other, name)[first:last]
+            if name in shift:
+                delta = shift[name]
+                values = [v + delta for v in values]
+
+            getattr(self, name).extend(values)
+
+    def pop(self):
+        """Remove the last row."""
+
+        for name, kind in self.layout:
+            getattr(self, name).pop()
+
+    def get(self, name, i):
+        """Value of column "name" in row i, with None for missing values
+        and datetime for times.
+
+        """
+
+        value = getattr(self, name)[i]
+        kind = self.kinds[name]
+
+        if kind == 'time':
+            return fromepoch(value) if isfinite(value) else None
+
+        if kind == 'float':
+            return value if value == value else None
+
+        if kind == 'str':
+            return value
+
+        return None if value == KINDS[kind][1] else value
+
+    def __getitem__(self, i):
+        return [None if name is None else self.get(name, i)
+                for name in self.rowlayout]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+class NetworkTable(Table):
+    """Networks and virtual networks (stationGroup).
+
+    A normal network points to its first and last (excluded) child in the
+    table of stations. A virtual network has no pointers but a slice of
+    "refs", with the indexes of the stations it groups.
+
+    The digest of a normal network identifies its XML (see invdiff), so that
+    the networks which did not change can be found when the inventory is
+    read again.
+
+    """
+
+    layout = (('code', 'str'),
+              ('first', 'idx'),
+              ('last', 'idx'),
+              ('vfirst', 'idx'),
+              ('vlast', 'idx'),
+              ('start', 'year'),
+              ('end', 'year'),
+              ('description', 'str'),
+              ('restricted', 'flag'),
+              ('netclass', 'str'),
+              ('archive', 'str'),
+              ('institutions', 'str'),
+              ('digest', 'str'))
+
+    rowlayout = ('code', 'first', 'last', None, 'start', 'end',
+                 'description', 'restricted', 'netclass', 'archive',
+                 'institutions')
+
+    arrays = ('refs',)
+
+    def isvirtual(self, i):
+        return self.first[i] < 0
+
+    def children(self, i):
+        """Indexes of the stations in network i."""
+
+        if self.first[i] >= 0:
+            return xrange(self.first[i], self.last[i])
+
+        return self.refs[self.vfirst[i]:self.vlast[i]]
+
+    def key(self, i):
+        """Key of the network as used by the web client (CODE-START-END)."""
+
+        return '%s-%s-%s' % (self.code[i], self.start[i] or None,
+                             self.end[i] or None)
+
+    def __getitem__(self, i):
+        row = Table.__getitem__(self, i)
+        if self.isvirtual(i):
+            row[3] = list(self.children(i))
+
+        return row
+
+
+class StationTable(Table):
+    layout = (('network', 'idx'),
+              ('first', 'idx'),
+              ('last', 'idx'),
+              ('code', 'str'),
+              ('latitude', 'float'),
+              ('longitude', 'float'),
+              ('description', 'str'),
+              ('start', 'time'),
+              ('end', 'time'),
+              ('elevation', 'float'),
+              ('restricted', 'flag'),
+              ('publicID', 'str'))
+
+    rowlayout = ('network', 'first', 'last', None, 'code', 'latitude',
+                 'longitude', 'description', 'start', 'end', 'elevation',
+                 'restricted')
+
+
+class SensorLocTable(Table):
+    layout = (('station', 'idx'),
+              ('first', 'idx'),
+              ('last', 'idx'),
+              ('code', 'str'))
+
+    rowlayout = ('station', 'first', 'last', None, 'code')
+
+
+class StreamTable(Table):
+    """Streams. sensortype and datalogger are taken from the sensor and
+    datalogger with the publicIDs in sensorref and dataloggerref.
+
+    """
+
+    layout = (('sensorLoc', 'idx'),
+              ('code', 'str'),
+              ('sensortype', 'str'),
+              ('denominator', 'float'),
+              ('numerator', 'float'),
+              ('datalogger', 'str'),
+              ('start', 'time'),
+              ('end', 'time'),
+              ('restricted', 'flag'),
+              ('sensorref', 'str'),
+              ('dataloggerref', 'str'))
+
+    rowlayout = ('sensorLoc', 'code', 'sensortype', 'denominator',
+                 'numerator', 'datalogger', 'start', 'end', 'restricted')
+
+    def sps(self, i):
+        """Sampling rate of stream i, or None if it is not known."""
+
+        denom = self.denominator[i]
+        numer = self.numerator[i]
+        if denom != denom or numer != numer or not denom:
+            return None
+
+        return numer / denom
+
+
+class StreamIndex(Table):
+    """Epochs of every stream, by (net, sta, cha, loc).
+
+    The keys are sorted and "order" holds the indexes of all the epochs in
+    the table of streams, grouped by key and sorted by start time within
+    every key. "hashes" are the CRC-32 of the keys, sorted, and "byhash"
+    the position of the key of every hash. Lookups are binary searches on
+    the hashes, so that the index does not need a dictionary and can be
+    memory-mapped like the other tables.
+
+    "disjoint" tells whether the epochs of a key do not overlap. Their
+    ends are then sorted as well, and the epochs overlapping a time window
+    are found by binary search too.
+
+    """
+
+    layout = (('key', 'str'),
+              ('first', 'idx'),
+              ('last', 'idx'),
+              ('disjoint', 'flag'))
+
+    rowlayout = ('key', 'first', 'last')
+
+    arrays = ('order', 'hashes', 'byhash')
+
+    # Separator of the codes in a key. It sorts before any valid character,
+    # so that keys are sorted as the tuples they come from.
+    SEP = '\0'
+
+    @staticmethod
+    def hash(k):
+        """CRC-32 of a key (a string) as stored in "hashes"."""
+
+        if isinstance(k, unicode):
+            k = k.encode('utf-8')
+
+        return zlib.crc32(k)
+
+    def find(self, key):
+        """Position of key (a tuple) in the index, or -1."""
+
+        k = self.SEP.join(key)
+        h = self.hash(k)
+
+        hashes = self.hashes
+        j = bisect.bisect_left(hashes, h)
+        while j < len(hashes) and hashes[j] == h:
+            i = self.byhash[j]
+            if self.key[i] == k:
+                return i
+
+            j += 1
+
+        return -1
+
+    def epochs(self, key):
+        """Indexes of the streams with the given key, or None."""
+
+        i = self.find(key)
+        if i < 0:
+            return None
+
+        return self.order[self.first[i]:self.last[i]]
+
+    def overlapping(self, i, streams, start, end, openend):
+        """First stream of the key in position i whose epoch overlaps the
+        time window from start to end (in seconds since the epoch), or -1.
+
+        Epochs without end are taken as ending at openend. If several
+        epochs overlap the window, the one which comes first in the table
+        of streams (that is, in the inventory) is returned.
+
+        """
+
+        order = self.order
+        first = self.first[i]
+        last = self.last[i]
+        begin = streams.start
+        finish = streams.end
+
+        if self.disjoint[i]:
+            # First epoch ending after start. The ones after it overlap
+            # the window until one starts after end. Ends are sorted as they
+            # are stored, not after replacing open ends with openend.
+            lo = first
+            hi = last
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if finish[order[mid]] <= start:
+                    lo = mid + 1
+                else:
+                    hi = mid
+
+            candidates = xrange(lo, last)
+        else:
+            candidates = xrange(first, last)
+
+        found = -1
+        for pos in candidates:
+            s = order[pos]
+            if begin[s] >= end:
+                if self.disjoint[i]:
+                    break
+
+                continue
+
+            e = finish[s]
+            if e == INF:
+                e = openend
+
+            if start < e and (found < 0 or s < found):
+                found = s
+
+        return found
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def iteritems(self):
+        for i in xrange(len(self)):
+            yield (tuple(self.key[i].split(self.SEP)),
+                   self.order[self.first[i]:self.last[i]])
+
+
+def indexStreams(networks, stations, sensorsLoc, streams):
+    """Build the StreamIndex of the given tables."""
+
+    keys = []
+    for s in xrange(len(streams)):
+        sensorLoc = streams.sensorLoc[s]
+        station = sensorsLoc.station[sensorLoc]
+
+        # (net,sta,cha,loc)
+        keys.append(StreamIndex.SEP.join((
+            networks.code[stations.network[station]], stations.code[station],
+            streams.code[s], sensorsLoc.code[sensorLoc])))
+
+    # Streams grouped by key
+    sortedkeys = []
+    groups = []
+    for s in sorted(xrange(len(keys)), key=keys.__getitem__):
+        if sortedkeys and sortedkeys[-1] == keys[s]:
+            groups[-1].append(s)
+        else:
+            sortedkeys.append(keys[s])
+            groups.append([s])
+
+    return _streamIndex(sortedkeys, groups, streams)
+
+
+def reindexStreams(index, remap, networks, stations, sensorsLoc, streams):
+    """Update a StreamIndex after the tables of streams changed.
+
+    remap gives, for every stream of the previous tables, its index in the
+    new tables or -1 if it was removed. The keys of the streams which are
+    not in remap are computed and merged with the previous index, so that
+    the result is the same as with indexStreams.
+
+    """
+
+    kept = set(remap)
+    added = {}
+    for s in xrange(len(streams)):
+        if s in kept:
+            continue
+
+        sensorLoc = streams.sensorLoc[s]
+        station = sensorsLoc.station[sensorLoc]
+
+        # (net,sta,cha,loc)
+        key = StreamIndex.SEP.join((
+            networks.code[stations.network[station]], stations.code[station],
+            streams.code[s], sensorsLoc.code[sensorLoc]))
+        added.setdefault(key, []).append(s)
+
+    # Previous keys and new positions of their epochs
+    oldkeys = index.key[0:len(index)]
+    mapped = [remap[s] for s in index.order[0:len(index.order)]]
+    first = index.first
+    last = index.last
+
+    keys = []
+    groups = []
+    for i in xrange(len(oldkeys)):
+        key = oldkeys[i]
+        epochs = mapped[first[i]:last[i]]
+        if -1 in epochs:
+            epochs = [s for s in epochs if s >= 0]
+
+        if key in added:
+            epochs.extend(added.pop(key))
+
+        if epochs:
+            keys.append(key)
+            groups.append(epochs)
+
+    # Keys which were not in the previous index
+    if added:
+        for key in added:
+            keys.append(key)
+            groups.append(added[key])
+
+        positions = sorted(xrange(len(keys)), key=keys.__getitem__)
+        keys = [keys[g] for g in positions]
+        groups = [groups[g] for g in positions]
+
+    return _streamIndex(keys, groups, streams)
+
+
+def _streamIndex(keys, groups, streams):
+    """StreamIndex with the given keys (sorted) and the streams of every
+    key (a list per key, which is sorted in place).
+
+    """
+
+    start = streams.start
+    end = streams.end
+
+    def bystart(s):
+        return (start[s], s)
+
+    result = StreamIndex()
+    result.key = keys
+    for epochs in groups:
+        disjoint = 1
+        if len(epochs) > 1:
+            epochs.sort(key=bystart)
+            for k in xrange(len(epochs) - 1):
+                if end[epochs[k]] > start[epochs[k + 1]]:
+                    disjoint = 0
+                    break
+
+        result.first.append(len(result.order))
+        result.order.extend(epochs)
+        result.last.append(len(result.order))
+        result.disjoint.append(disjoint)
+
+    hashes = [StreamIndex.hash(k) for k in keys]
+    result.byhash.extend(sorted(xrange(len(keys)), key=hashes.__getitem__))
+    result.hashes.extend(hashes[i] for i in result.byhash)
+
+    return result
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# Bounded cache of results of the web interface
+#
+# ----------------------------------------------------------------------
+
+
+"""Bounded cache of results of the web interface
+
+Copyright (C) 2016 GEOFON team, Helmholtz-Zentrum Potsdam - Deutsches GeoForschungsZentrum GFZ
+
+An LRUCache keeps values (typically JSON documents ready to be sent) under
+hashable keys. The total size of the values is limited: when a new one
+does not fit, the least recently used entries are dropped. By default the
+size of a value is its length; caches of other objects pass a function to
+measure them, e.g. one counting every value as 1 to limit the number of
+entries. Entries may also expire a fixed number of seconds after they were
+stored, the same for all of them or given for every entry.
+
+The cache is shared by all the threads of a process, so every operation
+takes a lock. Hits, misses and evictions are counted, see stats().
+
+
+This program is free software; you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 2, or (at your option) any later
+version. For more information, see http://www.gnu.org/
+
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+# ttl of put() when not given
+_DEFAULT = object()
+
+
+class LRUCache(object):
+    """Values kept for ttl seconds, up to maxsize in total.
+
+    sizeof(value) is the size of a value. Values larger than maxsize are
+    never stored. A cache with maxsize 0 stores nothing, one with ttl None
+    keeps the values until they are dropped to make room for others.
+
+    """
+
+    def __init__(self, maxsize, ttl, sizeof=len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sizeof = sizeof
+
+        # key -> (expiry time, value), least recently used first
+        self.__entries = OrderedDict()
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the value stored under key, or None."""
+
+        with self.__lock:
+            try:
+                (expiry, value) = self.__entries.pop(key)
+
+            except KeyError:
+                self.misses += 1
+                return None
+
+            if expiry is not None and expiry <= time.time():
+                self.__size -= self.sizeof(value)
+                self.misses += 1
+                return None
+
+            # Back as the most recently used
+            self.__entries[key] = (expiry, value)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=_DEFAULT):
+        """Store value under key, replacing any previous one.
+
+        ttl, if given, replaces the one of the cache for this value.
+
+        """
+
+        size = self.sizeof(value)
+        if size > self.maxsize:
+            return
+
+        if ttl is _DEFAULT:
+            ttl = self.ttl
+
+        expiry = time.time() + ttl if ttl is not None else None
+
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.__size -= self.sizeof(old[1])
+
+            while self.__entries and self.__size + size > self.maxsize:
+                (k, (e, v)) = self.__entries.popitem(last=False)
+                self.__size -= self.sizeof(v)
+                self.evictions += 1
+
+            self.__entries[key] = (expiry, value)
+            self.__size += size
+
+    def clear(self):
+        """Drop all the entries."""
+
+        with self.__lock:
+            self.__entries.clear()
+            self.__size = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def stats(self):
+        """Counters and size of the cache, as a dictionary."""
+
+        with self.__lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.__entries),
+                    'size': self.__size,
+                    'maxsize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hitratio': round(float(self.hits) / lookups, 4)
+                    if lookups else None}
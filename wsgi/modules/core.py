@@ -1,9 +1,11 @@
 import os
 import json
 
+import wsgicomm
+
 class WI_Module(object):
     def __init__(self, wi):
-        self.js_conf = wi.getConfigJSON('js')
+        self.js_conf = wsgicomm.Precompressed(wi.getConfigJSON('js'))
         wi.registerAction("/configuration", self.configuration)
         wi.registerAction("/loader", self.loaderjs)
 
@@ -17,7 +19,7 @@ class WI_Module(object):
         Begun by Andres Heinloo <andres@gfz-potsdam.de>, GEOFON team, June 2013
 
         """
-        return [ self.js_conf ]
+        return self.js_conf
 
     def loaderjs(self, envir, params):
         """It returns the Javascript code to load the loader.js file in the main page.
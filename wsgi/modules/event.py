@@ -41,19 +41,42 @@ import cgi
 import csv
 import doctest
 import datetime
+import itertools
 import json
 import math
 import os
 import tempfile
 import re
 import sys
+import time
 import urllib2
 
 sys.path.append('..')  # for wsgicomm...
 import wsgicomm
+import httpclient
+import regions
+from router import Request
+from cStringIO import StringIO
 
 tempdir = tempfile.gettempdir()
 
+# Characters not allowed in the name of a service
+_serviceJunk = re.compile(r'[^a-zA-Z0-9-]+')
+
+# Connections to the event services, shared by all of them
+upstreamPool = httpclient.ConnectionPool()
+
+# Responses of the event services (see WI_Module.__init__), kept for
+# CACHE_TTL seconds, or HISTORICAL_TTL if the query ends more than
+# HISTORICAL_AGE ago: older events are seldom revised. Streamed
+# responses (see send_request) larger than STREAM_SIZE bytes are not kept
+upstreamCache = httpclient.ResponseCache(0)
+CACHE_TTL = 60
+STREAM_SIZE = 1024 * 1024
+HISTORICAL_TTL = 7 * 86400
+HISTORICAL_AGE = datetime.timedelta(days=2)
+_isoDate = re.compile(r'\d{4}-\d{2}-\d{2}')
+
 try:
     import seiscomp.logs as logs
 except ImportError:
@@ -98,6 +121,10 @@ except ImportError:
                 name += "%i" % (int(abs(flon)/22.5))
                 return name
 
+# Region names of events (see WI_Module.__init__), one Regions object
+# for the whole process
+regionResolver = regions.RegionResolver(Seismology.Regions)
+
 try:
     import seiscomp3.Math as Math
 except ImportError:
@@ -179,16 +206,30 @@ Service version:
 
         #NOT NEEDED: self.defaultLimit = config['defaultLimit']
 
+        global upstreamCache, STREAM_SIZE
+        upstreamCache = httpclient.ResponseCache(
+            wi.getConfigInt('event.cache.size', 16) * 1024 * 1024)
+        STREAM_SIZE = wi.getConfigInt('event.cache.maxbody', 1024) * 1024
+
+        global regionResolver
+        regionResolver = regions.RegionResolver(
+            Seismology.Regions,
+            step=wi.getConfigFloat('event.names.cache.step', regions.STEP),
+            maxsize=wi.getConfigInt('event.names.cache.size', regions.MAX_CELLS))
+
+        self.catalogsBody = None
         wi.registerAction("/event/catalogs", self.catalogs)
-        wi.registerAction("/event/parse", self.parse, 'columns', 'informat', 'input')
+        wi.registerAction("/event/status", self.status)
+        wi.registerAction("/event/parse", self.parse, 'columns', 'informat', 'input',
+                          maxsize=wi.getConfigInt('event.parse.maxsize', 10 * 1024 * 1024),
+                          uploads=('input',))
 
-        # Trick to get all defined catalogs registered:
-        for service in self._EventServiceCatalog:
-            wi.registerAction("/event/%s" % (service), self.query)
-        # And some more, just for testing:
-        wi.registerAction("/event/meteor", self.query)
         wi.registerAction("/event/dumpconfig", self.dumpConfig)
 
+        # All services, including those only for testing (e.g. meteor);
+        # getEvents() decides which ones are served.
+        wi.registerAction("/event/{service}", self.query)
+
         # Create handlers for all services:
         # Should these options apply to *all* services from this server??
         options = {}
@@ -199,6 +240,7 @@ Service version:
         logs.info("Options:")
         for k in sorted(options):
             logs.info('%24s: %s' % (k, str(options[k])))
+        self.options = options
 
         self.es = dict()
         for s, props in self.services.iteritems():
@@ -235,21 +277,37 @@ Service version:
 ##            ##    h = s
             logs.debug("Handler for service id=%s is '%s'" % (s, h))
 
+            # Connection to the service:
+            #   event.service.{servicename}.connecttimeout (seconds)
+            #   event.service.{servicename}.timeout (seconds)
+            #   event.service.{servicename}.concurrency (requests)
+            #   event.service.{servicename}.cachettl (seconds)
+            #   event.service.{servicename}.historicalttl (seconds)
+            opts = dict(options)
+            for (k, convert) in (('connecttimeout', float), ('timeout', float),
+                                 ('concurrency', int), ('cachettl', float),
+                                 ('historicalttl', float)):
+                if k in props:
+                    try:
+                        opts[k] = convert(props[k])
+                    except (TypeError, ValueError):
+                        logs.error("config parameter 'event.service.%s.%s' has invalid value" % (s, k))
+
             # All known handlers:
             if h == 'geofon':
-                es = ESGeofon(s, options, props['baseURL'], props['extraParams'])
+                es = ESGeofon(s, opts, props['baseURL'], props['extraParams'])
             elif h == 'comcat':
-                es = ESComcat(s, options, props['baseURL'], props['extraParams'])
+                es = ESComcat(s, opts, props['baseURL'], props['extraParams'])
             elif h == 'emsc':
-                es = ESEMSC(s, options,   props['baseURL'], props['extraParams'])
+                es = ESEMSC(s, opts,   props['baseURL'], props['extraParams'])
             elif h == 'fdsnws':
-                es = ESFdsnws(s, options, props['baseURL'], props['extraParams'])
+                es = ESFdsnws(s, opts, props['baseURL'], props['extraParams'])
             elif h == 'meteor':
-                es = ESMeteor(s, options)
+                es = ESMeteor(s, opts)
             elif h == 'neic':
                 es = ESNeic(s)
             elif h == 'parser':
-                es = ESFile(s, options)
+                es = ESFile(s, opts)
             else:
                 raise SyntaxError, "Uncaught handler %s" % h
             self.es[s] = es
@@ -257,7 +315,8 @@ Service version:
             end_time = datetime.datetime.now()
             #Python 2.7: logs.debug("Created new event service '%s' in %g s" % (s, (end_time-start_time).total_seconds()))
             logs.notice("Created new event service '%s', handler %s" % (s, h))
-            for p in ('handler', 'baseURL', 'extraParams'):
+            for p in ('handler', 'baseURL', 'extraParams', 'connecttimeout',
+                      'timeout', 'concurrency', 'cachettl', 'historicalttl'):
                 logs.debug('%24s: %s' % (p, props.get(p)))
 
         if (abort): raise SyntaxError, "Configuration problem(s), see the logs."
@@ -265,8 +324,23 @@ Service version:
     def dumpConfig(self, envir, params):
         return ("Event services configuration at %s\n" % str(datetime.datetime.now()) + str(self),)
 
+    def status(self, envir, params):
+        """Counters of the connections to the event services and of the
+        cache of their responses, in JSON format.
+
+        """
+
+        return json.dumps({'upstream': upstreamPool.stats(),
+                           'cache': upstreamCache.stats(),
+                           'regions': regionResolver.stats()})
+
     def catalogs(self, envir, params):
-        return self.getEventsCatalog()
+        # Built and compressed only once, as it depends on the
+        # configuration only
+        if self.catalogsBody is None:
+            self.catalogsBody = wsgicomm.Precompressed(self.getEventsCatalog())
+
+        return self.catalogsBody
 
     def parse(self, envir, params):
         return self.parseUserTextFile(envir, params)
@@ -344,6 +418,9 @@ Service version:
         s += "defaultLimit: " + str(self.options['defaultLimit']) + "\n"
         s += "lookupIfEmpty? " + str(self.options['lookupIfEmpty']) + "\n"
         s += "lookupIfGiven? " + str(self.options['lookupIfGiven']) + "\n"
+        s += "Upstream connections: " + str(upstreamPool.stats()) + "\n"
+        s += "Upstream cache: " + str(upstreamCache.stats()) + "\n"
+        s += "Region names: " + str(regionResolver.stats()) + "\n"
         return s
 
     def parseUserTextFile(self, envir, params):
@@ -365,7 +442,8 @@ Service version:
             if name not in params_white_list:
                 return [bodyBadRequest(envir, 'Unknown parameter name supplied', 'parser')]
 
-        return es.handler(envir, params)
+        # All values as lists, as the handlers of the services expect
+        return es.handler(envir, getattr(params, 'query', params))
 
     def getEvents(self, environ, params):
         """Event web service.
@@ -404,22 +482,30 @@ Service version:
         The first line, with or without comment, may also need ignoring. :FIXME:
 
         """
-        path = environ.get('PATH_INFO', '').lstrip('/')
-        parts = path.split('/', 3)
-        command = parts[0].lower()
-        assert(command == 'event')
+        if isinstance(params, Request):
+            # Path and query string already parsed by the router
+            service = params.args['service']
+            parameters = params.query
+
+        else:
+            # Called directly, e.g. by the tests
+            path = environ.get('PATH_INFO', '').lstrip('/')
+            parts = path.split('/', 3)
+            command = parts[0].lower()
+            assert(command == 'event')
 
-        if len(parts) == 1:
-            # There was no slash after "event", therefore no service.
-            # In future, this could return the catalog!
-            return [bodyBadRequest(environ, "No service name given, try /event/catalogs")]
+            if len(parts) == 1:
+                # There was no slash after "event", therefore no service.
+                # In future, this could return the catalog!
+                return [bodyBadRequest(environ, "No service name given, try /event/catalogs")]
 
-        service = parts[1].lower()
-        service = re.escape(service)
-        service = re.sub(r'([^a-zA-Z0-9-]+)', ' ', service)
+            if len(parts) > 2:
+                return [bodyBadRequest(environ, "Extra URL component after service name")]
 
-        if len(parts) > 2:
-            return [bodyBadRequest(environ, "Extra URL component after service name")]
+            service = parts[1]
+            parameters = cgi.parse_qs(environ.get('QUERY_STRING', ''))
+
+        service = _serviceJunk.sub(' ', service.lower())
 
         # For testing, it is nice to allow services e.g. '/event/meteor' which
         # are not in the "published" catalog. But a site which is "live"
@@ -428,10 +514,7 @@ Service version:
         if self.registeredonly and not service in self._EventServiceCatalog:
             return [bodyBadRequest(environ, "Unknown service name", service)]
 
-        if service in self.services.keys():
-            #NOT NEEDED?:
-            parameters = cgi.parse_qs(environ.get('QUERY_STRING', ''))
-            ##Should be: parameters = params
+        if service in self.services:
             return self.es[service].handler(environ, parameters)
         else:
             return [bodyBadRequest(environ, "Unknown service name", service)]
@@ -506,6 +589,40 @@ def repr_dialect(d):
         d.escapechar, repr(d.lineterminator),
         d.quotechar, d.quoting, d.skipinitialspace)
 
+# Bytes at the start of CSV input looked at to guess its dialect
+SNIFF_SIZE = 1024
+
+def sniff_csv(lines, size=SNIFF_SIZE):
+    """Guess the dialect of CSV input from its first lines.
+
+    Only whole lines up to about 'size' bytes are looked at, whatever the
+    length of the input.
+
+    Input:
+      lines - iterable of lines, with their line terminators
+    Returns:
+      (dialect, lines) - lines iterates over all the input, including
+                         the lines looked at
+    Raises:
+      csv.Error if no dialect was found.
+
+    >>> dialect, lines = sniff_csv(['a|b|c\\n', '1|2|3\\n'])
+    >>> dialect.delimiter, list(lines)
+    ('|', ['a|b|c\\n', '1|2|3\\n'])
+
+    """
+    lines = iter(lines)
+    prefix = []
+    length = 0
+    for line in lines:
+        prefix.append(line)
+        length += len(line)
+        if length >= size:
+            break
+
+    dialect = csv.Sniffer().sniff(''.join(prefix))
+    return dialect, itertools.chain(prefix, lines)
+
 def date_T(arg):
         """Dates should be 'yyyy-mm-ddThh:mm:ss', with no trailing Z or zone or milliseconds.
 
@@ -758,6 +875,22 @@ class EventWriter(object):
         """All-in-one-hit serialisation."""
         return self.write_begin(limit) + self.write_events(0, limit) + self.write_end(limit)
 
+    def stream(self, rows, limit):
+        """Serialisation of at most 'limit' events taken from 'rows', an
+        iterable, while they are sent: a wsgicomm.TextStream or JSONStream.
+
+        """
+        raise SyntaxError("In EventWriter.stream: Unimplemented output format")
+
+    def _trailer(self, rows, eol='\n'):
+        """A comment line about the failure which ended 'rows', if any,
+        produced only once the events have been written.
+
+        """
+        error = getattr(rows, 'error', None)
+        if error is not None:
+            yield "# Error: %s%s" % (error, eol)
+
 
 class EventWriterCSV(EventWriter):
     '''Write some events as a Comma Separated Values (CSV) table.
@@ -790,7 +923,7 @@ class EventWriterCSV(EventWriter):
     def write_begin(self, limit):
         self.count = 0
         #TMPFILE self.fid = open('local.csv', 'wb')
-        self.fid = tempfile.TemporaryFile('w+b')
+        self.fid = StringIO()
         self.writer = csv.writer(self.fid)
 #*****USE self.output_header?
         header = ("Event Time", "Mag", "Lat", "Lon", "ID", "Depth", "Region")
@@ -811,13 +944,29 @@ class EventWriterCSV(EventWriter):
     def write_end(self, limit):
         #TMPFILE self.fid.close()
         #TMPFILE self.fid = open('local.csv', 'rb')
-        self.fid.seek(0)
-        s = ""
-        for line in self.fid.readlines():
-            s += line
+        s = self.fid.getvalue()
         self.fid.close()
         return s + "# Lines: %i\n" % self.count
 
+    def stream(self, rows, limit):
+        return wsgicomm.TextStream(itertools.chain(self._lines(rows, limit),
+                                                   self._trailer(rows)))
+
+    def _lines(self, rows, limit):
+        buf = StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(self.output_header)
+
+        count = 0
+        for ev in itertools.islice(rows, limit):
+            writer.writerow(ev)
+            count += 1
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+
+        yield buf.getvalue() + "# Lines: %i\n" % count
+
 
 class EventWriterJSON(EventWriter):
     """Write some events as a JSON table.
@@ -839,6 +988,10 @@ class EventWriterJSON(EventWriter):
         #                                                              limit, last)
         return json.dumps([self.output_header] + self.data[0:last])
 
+    def stream(self, rows, limit):
+        return wsgicomm.JSONStream(itertools.chain([self.output_header],
+                                                   itertools.islice(rows, limit)))
+
 
 class EventWriterFDSNText(EventWriter):
     """Write some events as fdsnws-event format=text output.
@@ -865,22 +1018,47 @@ class EventWriterFDSNText(EventWriter):
         return ''
 
     def write_all(self, limit):
+        last = min(limit, len(self.data))
+        return ''.join(self._lines(self.data[0:last]))
+
+    def stream(self, rows, limit):
+        return wsgicomm.TextStream(itertools.chain(self._lines(itertools.islice(rows, limit)),
+                                                   self._trailer(rows, '\r\n')))
+
+    def _lines(self, rows):
         sep = '|'
         crlf = '\r\n'
 
-        last = min(limit, len(self.data))
+        mapping = (6, 0, 3, 4, 5, None, None, None, None, 2, 1, None, 7)
+        h = Helpers()
+
+        yield sep.join(self.fdsnws_headers) + crlf
+        for row in rows:
+            yield sep.join(str(x) for x in h.mapcols(row, mapping)) + crlf
 
-        def rows(data, first, last):
-            buf = ""
-            mapping = (6, 0, 3, 4, 5, None, None, None, None, 2, 1, None, 7)
-            h = Helpers()
-            for r in range(first, last):
-                row = data[r]
-                buf += sep.join(str(x) for x in h.mapcols(row, mapping)) + crlf
-            return buf
 
-        h = sep.join(self.fdsnws_headers)
-        return h + crlf + rows(self.data, 0, last)
+class EventStream(object):
+    """Events taken from an iterator while they are sent.
+
+    The response has already started when they are read, so a failure
+    (e.g. a malformed row from the target service) can no longer become
+    an error page. It is logged and kept in 'error' instead, and the
+    events end there; the writers then add a trailer about it where
+    their format allows (JSON output is just a shorter, closed list).
+
+    """
+
+    def __init__(self, events):
+        self.events = events
+        self.error = None
+
+    def __iter__(self):
+        try:
+            for ev in self.events:
+                yield ev
+        except Exception as e:
+            logs.error("EventStream: events cut short - %s" % str(e))
+            self.error = e
 
 
 class EventData(object):
@@ -970,6 +1148,10 @@ class EventData(object):
         #print "EventData::write_all() fmt=", fmt
         return self.handlers[fmt].write_all(limit)
 
+    def stream(self, fmt, rows, limit):
+        """Serialisation of events from 'rows' while they are sent."""
+        return self.handlers[fmt].stream(rows, limit)
+
 
 class Helpers(object):
     def mapcols(self, row, mapping):
@@ -1049,6 +1231,7 @@ class EventResponse(object):
         self.input_mapping = mapping
         self.filters = filters
         self.rows = None
+        self.events = None
         self.cols = {'otm': 0, 'mag': 1, 'mtyp': 2,
                      'lat': 3, 'lon': 4, 'dep': 5,
                      'id': 6, 'region': 7}
@@ -1081,39 +1264,66 @@ class EventResponse(object):
 
         """
         self.ed = EventData()
-        helper = Helpers()
+        for new_row in self.iter_csv(rows, limit, dialect):
+            self.ed.append(new_row)
+        return
 
-        # Save a copy. FIXME
-        fid = tempfile.NamedTemporaryFile('wb', prefix='wi', suffix='csv.txt', dir=tempdir, delete=False)
-        fname = fid.name
-        numrows = 0
-        for row in rows.splitlines():
-            numrows += 1
-            print >>fid, row
-            if (not limit) or numrows > 2*limit:
-                break
-        fid.close()
+    def stream_csv(self, rows, limit, dialect = None):
+        """Like load_csv(), but the events are only read from 'rows' while
+        they are written, see write().
 
-        if dialect == None:
-            sniffer = csv.Sniffer()
-            guess = sniffer.sniff(rows)
-            logs.debug("Guessed dialect: %s" % (repr_dialect(guess)))
-#
-# Can't re-read from rows, so I needed to write to a temporary file??? FIXME
-# FIXME: open('r'), read(size), fid.seek(0) start reader ??
-#
+        Modifies:
+          self.events - iterator over the events
+
+        """
+        self.ed = EventData()
+        self.events = self.iter_csv(rows, limit, dialect)
+
+    def prefetch(self):
+        """Read the first event of stream_csv() at once.
+
+        A failure there is raised here, before the response has
+        started, instead of while the events are sent.
+
+        """
+        if self.events is None:
+            return
         try:
-            fid = open(fname, 'rb')
-        except:
-            logs.debug("Oops, temporary file '%s' couldn't be opened.", fname)
-            raise
+            first = self.events.next()
+        except StopIteration:
+            return
+        self.events = itertools.chain([first], self.events)
+
+    def iter_csv(self, rows, limit, dialect = None):
+        """Events in 'rows', as for load_csv().
+
+        The header is read at once, the events only as they are taken
+        from the iterator returned. No more rows are read after 'limit'.
+        'rows' is a string or an iterable of lines with a close() method
+        (see EventService.send_request), closed once the events end.
+
+        """
+        helper = Helpers()
+
+        # Parsed straight from the response
+        if isinstance(rows, basestring):
+            rows = StringIO(rows)
+        lines = rows
+        if dialect == None:
+            try:
+                dialect, lines = sniff_csv(lines)
+                logs.debug("Guessed dialect: %s" % (repr_dialect(dialect)))
+            except csv.Error:
+                dialect = csv.excel
 
-        logs.info('Reopened '+fname)
-        reader = csv.reader(fid, dialect)
+        reader = csv.reader(lines, dialect)
         #logs.error("Reader dialect: %s" % (repr_dialect(dialect)))
 
-        numrow = 0
-        header = reader.next()
+        try:
+            header = reader.next()
+        except:
+            rows.close()
+            raise
         #print >>sys.stderr, "load_csv: Header:", header
         if len(header) > 1:
             # probably worked
@@ -1132,38 +1342,48 @@ class EventResponse(object):
         new_header = helper.mapcols(header_cols, self.input_mapping)
         #s += "|".join(new_header) + "\n"
 
-        for row in reader:
-            if len(row) > 0:
-                numrow += 1
-                if verbosity > 3:
-                    logs.error("Row %i: %s" % (numrow, str(row)))
-
-                first = row[0]
-                if first.startswith('#'):
-                    # Comment line, so ignore it
-                    continue
-                #s += "|".join(row) + "\n"
-                new_row = helper.mapcols(row, self.input_mapping)
-                new_row = helper.filtercols(new_row, self.filters)
-                self.ed.append(new_row)
-                if (limit) and numrow > limit:
-                    break
-        fid.close()
-        os.unlink(fname)
-        return
+        def events():
+            numrow = 0
+            try:
+                for row in reader:
+                    if len(row) > 0:
+                        numrow += 1
+                        if verbosity > 3:
+                            logs.error("Row %i: %s" % (numrow, str(row)))
+
+                        first = row[0]
+                        if first.startswith('#'):
+                            # Comment line, so ignore it
+                            continue
+                        #s += "|".join(row) + "\n"
+                        new_row = helper.mapcols(row, self.input_mapping)
+                        new_row = helper.filtercols(new_row, self.filters)
+                        yield new_row
+                        if (limit) and numrow > limit:
+                            break
+            finally:
+                # Drops the connection to the service if the limit
+                # was reached before the end of its response
+                rows.close()
+
+        return events()
 
     def _lookup_region(self, ev):
         lat = ev[self.cols['lat']]
         lon = ev[self.cols['lon']]
 
-         # FIXME: Why are lat/lon not already floats?
-        try:
-            flat = float(lat)
-            flon = float(lon)
-        except ValueError:
+        name = regionResolver.name(lat, lon)
+        if name is None:
             logs.warning("In _lookup_region: lat=%s lon=%s are not convertable to float" % (str(lat), str(lon)))
-        return Seismology.Regions().getRegionName(flat, flon)
+        return name
 
+    def _wants_region(self, ev):
+        """Should we look up a region for this event?"""
+        old = ev[self.cols['region']].strip()
+        if old == "" or old == "-" or old == "--":
+            return self.lookupIfEmpty
+        else:
+            return self.lookupIfGiven
 
     def _fill_region(self, ev):
         """Should we look up a region for this event?
@@ -1177,16 +1397,10 @@ class EventResponse(object):
 
         """
         col = self.cols['region']
-        if self.lookupIfEmpty or self.lookupIfGiven:
+        if self._wants_region(ev):
             old = ev[col].strip()
-            new = old
-            if old == "" or old == "-" or old == "--":
-                if self.lookupIfEmpty:
-                    new = self._lookup_region(ev)
-            else:
-                if self.lookupIfGiven:
-                    new = self._lookup_region(ev)
-            if new != old:
+            new = self._lookup_region(ev)
+            if new is not None and new != old:
                 #logs.debug("(%s -> %s)" % (old, new))
                 ev[col] = new
 
@@ -1212,12 +1426,33 @@ class EventResponse(object):
                 ev[col] = prefix + seq_fmt % (row)
 
     def fill_regions(self):
-        """Use this function to re-assign region names."""
+        """Use this function to re-assign region names.
+
+        For events read by stream_csv(), they are assigned while the
+        events are written.
+
+        """
         if self.lookupIfEmpty or self.lookupIfGiven:
-            for ev in self.ed.data:
-                self._fill_region(ev)
+            if self.events is not None:
+                self.events = self._filled(self.events)
+            else:
+                start = time.time()
+                # All at once, every cell is looked up only once
+                todo = [ev for ev in self.ed.data if self._wants_region(ev)]
+                names = regionResolver.names([ev[self.cols['lat']] for ev in todo],
+                                             [ev[self.cols['lon']] for ev in todo])
+                col = self.cols['region']
+                for (ev, name) in zip(todo, names):
+                    if name is not None and name != ev[col].strip():
+                        ev[col] = name
+                logs.debug("Regions of %i event(s) filled in %.3f s" % (len(todo), time.time() - start))
         return
 
+    def _filled(self, events):
+        for ev in events:
+            self._fill_region(ev)
+            yield ev
+
     def write(self, limit, fmt):
         """
         Inputs:
@@ -1225,7 +1460,8 @@ class EventResponse(object):
           fmt - string, output format required
 
         Returns:
-          string
+          string, or for events read by stream_csv() a wsgicomm.TextStream
+          or JSONStream, which reads them while it is sent
 
         """
         if fmt == 'raw':
@@ -1244,6 +1480,8 @@ class EventResponse(object):
 
         elif fmt in ('csv', 'json', 'fdsnws-text'):
             ####REMOVE BEFORE CHCKreturn self.ed.write_all('csv', 14)
+            if self.events is not None:
+                return self.ed.stream(fmt, EventStream(self.events), limit)
             return self.ed.write_all(fmt, limit)
 
         else:
@@ -1295,6 +1533,10 @@ class EventService(object):
         self.extra_params = extra_params
         self.options = options
         self.defaultLimit = options['defaultLimit']
+        self.upstream = httpclient.Upstream(upstreamPool,
+                                            options.get('connecttimeout', httpclient.CONNECT_TIMEOUT),
+                                            options.get('timeout', httpclient.TIMEOUT),
+                                            options.get('concurrency', httpclient.CONCURRENCY))
 
     def _bounding_rect(self, p_lat, p_lon, max_radius):
         """Estimate a suitable area-rectangle for an area-circle request.
@@ -1361,20 +1603,41 @@ class EventService(object):
         """Overload this method to implement a service."""
         return self.result_page(environ, start_response, '404 Not Found', 'text/plain', "Service '%s' is not implemented." % self.id)
 
-    def send_request(self, pairs):
+    def cache_ttl(self, parameters):
+        """Seconds to keep the response to a query, longer if it ends
+        in the past.
+
+        """
+        end = (parameters or {}).get('end', [None])[0]
+        if end and _isoDate.match(end):
+            past = (datetime.datetime.utcnow() - HISTORICAL_AGE).strftime('%Y-%m-%d')
+            if end[:10] < past:
+                return self.options.get('historicalttl', HISTORICAL_TTL)
+
+        return self.options.get('cachettl', CACHE_TTL)
+
+    def send_request(self, pairs, parameters=None, stream=False):
         """Connect to the target service.
 
         Prepares the URL from the EventService properties and param=value pairs.
+        The response is cached under the URL, see cache_ttl(), and
+        identical queries in progress at the same time share one request.
 
         Inputs:
            pairs - list of 'param=value' strings
+           parameters - dictionary, parameters of the query to us
+           stream - boolean, return the rows as an httpclient.Body,
+                    read from the service while they are iterated over
+                    if they are not cached (larger than STREAM_SIZE or
+                    a cache_ttl() of 0). It must be closed if it is
+                    not read to the end.
 
         Uses:
            self.service_url - string, the URL to request.
            self.extra_params
 
         Returns:
-           rows - retrieved body from the URL, if any.
+           rows - retrieved body from the URL, if any, see 'stream'.
            url - string, the URL which was used.
 
         """
@@ -1385,13 +1648,20 @@ class EventService(object):
 
         dryrun = False  # Not implemented yet.
         if dryrun:
-            rows = ''
+            rows = httpclient.Body() if stream else ''
         else:
             try:
-                ua = 'Python-urllib/%i.%i (webdc3)' % (sys.version_info[0:2])
-                req = urllib2.Request(url, headers={'User-Agent': ua})
-                response = urllib2.urlopen(req)
-                rows = response.read()
+                # Through a persistent connection, with the timeouts and
+                # the limit of requests of this service
+                if stream:
+                    rows = upstreamCache.open(url,
+                                              lambda u: self.upstream.open(u).body,
+                                              self.cache_ttl(parameters),
+                                              STREAM_SIZE)
+                else:
+                    rows = upstreamCache.get(url,
+                                             lambda u: self.upstream.get(u).body,
+                                             self.cache_ttl(parameters))
             except urllib2.URLError as e:
                 logs.error("Errors fetching from URL: %s" % (url))
                 logs.error(str(e))
@@ -1401,7 +1671,7 @@ class EventService(object):
                 #                       "No answer")
 
             # TEMP FOR DEBUGGING - RACE/PERMISSION problems
-            if (verbosity > 5):
+            if (verbosity > 5) and not stream:
                 fid = open(os.path.join(tempdir, 'latest_response.dat'), 'w')
                 print >>fid, rows
                 fid.close()
@@ -1433,8 +1703,9 @@ class EventService(object):
         er = EventResponse(self.csv_dialect, self.column_map, self.filter_table, self.options)
 
         if fmt in ('csv', 'json', 'fdsnws-text'):
-            er.load_csv(rows, limit, self.csv_dialect)
+            er.stream_csv(rows, limit, self.csv_dialect)
             er.fill_regions()
+            er.prefetch()
         else:
             er.load_plain(rows)
         return er
@@ -1453,7 +1724,8 @@ class EventService(object):
     def write_response(self, er, limit, fmt):
         """Prepare the output in the desired format.
 
-        Output: string, depends on the value of 'fmt'.
+        Output: string or stream (see EventResponse.write), depends on
+        the value of 'fmt'.
           'raw'  - just what was received from the target service
           'text' - the same, but limited to 'limit' events?
           'csv'  - see EventWriterCSV
@@ -1484,6 +1756,11 @@ class EventService(object):
             er = self.format_response(allrows, limit, fmt)
             er = self.filter_response(er)  # Now should er be a member of es?? :FIXME:
             content = self.write_response(er, limit, fmt)
+            if not isinstance(content, basestring):
+                # Events read, filled and written while they are sent
+                if header:
+                    content = wsgicomm.TextStream(itertools.chain([header], content))
+                return content
             return self.result_page(environ, start_response, '200 OK', 'text/plain', header + content)
         except SyntaxError as e:
             self.raise_client_400(environ, str(e))
@@ -1759,9 +2036,12 @@ class ESFile(EventService):
             self.raise_client_400(environ, 'Input format can only be \'csv\' today')
             logs.warning('ESFile: Input format was "%s"' % input_fmt)
 
-        infile = str(parameters['input'][0])  ### Is that right??
-        lines = infile.splitlines()
-        logs.info('ESFile::handler: input has %i line(s)' % len(lines))
+        infile = parameters['input'][0]
+        if isinstance(infile, basestring):
+            lines = StringIO(infile)
+        else:
+            # An upload (see formdata.Upload), read line by line
+            lines = iter(infile)
         thing = str(parameters['columns'][0])
         columns = thing.split(',')
         logs.info('ESFile::handler: columns are %s' % str(columns))
@@ -1774,86 +2054,69 @@ class ESFile(EventService):
         except ValueError as e:
             self.raise_client_400(environ, str(e))
 
-        logs.debug("ESFile::handler: Input file '%s'" % (infile))
+        logs.debug("ESFile::handler: Input of %i byte(s)" % (len(infile)))
         logs.debug("ESFile::handler: Columns: [%s] (%i)" % ("|".join(columns), len(columns)))
 
-##        if not os.path.exists(infile):
-##            self.raise_client_error(environ, '500 Internal Server Error', 'No such file')
-
-        # FIXME: Writing to a temp file again! Perhaps put it in an EventResponse.rows??
-        infile = os.path.join(tempdir, 'user_input_csv.txt')
-        logs.debug('ESFile::handler: Writing to %s' % (infile))
-        with open(infile, 'w') as fid:
-            for t in lines:
-                print >>fid, t
-
         ed = EventData()
         helper = Helpers()
         mapping = self.column_map(columns)  # Will come from 'columns' parameter of the request. Use (4, 2, 5, 6, 7, 0, 1) for eqinfo
         limit = self.defaultLimit           # Only read (and write) this many events.
 
         logs.debug('ESFile::handler: Mapping = %s' % (str(mapping)))
-        logs.debug('ESFile::handler: Reading back from %s' % (infile))
-        e = ''
 
         # Count number of imported events
         count = 0
-        with open(infile, 'rb') as csvfd:
-            try:
-                dialect = csv.Sniffer().sniff(csvfd.read(1024))
-                logs.info("ESFile::handler: Sniffing file found dialect: %s" % repr_dialect(dialect))
-            except:
-                logs.notice("ESFile::handler: Sniffing file failed: %s" % (str(e)))
-                self.raise_client_400(environ, "Failed to detect a readable CSV file.")
-            csvfd.seek(0)
-
-            er = EventResponse(dialect, mapping, self.filter_table, self.options)
-            # Why can't we just use er.load_csv() here now?
-            # It would rewrite and read from a different temp file, re-sniff...
-
-            reader = csv.reader(csvfd, dialect)
-
-            # Is there a header? Heuristic: if there's any item
-            # starting with a digit [0-9] or '+' or '-' in this
-            # row, it's probably not a header!
-            header = reader.next()
-            is_header = True
-            for word in header:
-                if re.match('^[0-9+-]', word):
-                    is_header = False
-            if not is_header:
-                csvfd.seek(0)
-                reader = csv.reader(csvfd, dialect)
-
-            for row in reader:
-                logs.debug("Row %i: %i item(s), content: %s" % (count, len(row), str(row)))
-
-                if len(row) < min_columns:
-                    # Skip rows which don't have enough data, with NO WARNING.
-                    # Extra items on the row are ignored.
-                    continue
+        try:
+            dialect, lines = sniff_csv(lines)
+            logs.info("ESFile::handler: Sniffing file found dialect: %s" % repr_dialect(dialect))
+        except csv.Error as e:
+            logs.notice("ESFile::handler: Sniffing file failed: %s" % (str(e)))
+            self.raise_client_400(environ, "Failed to detect a readable CSV file.")
 
-                # This can arise from dopey user input?:
-                if not (len(row) >= len(columns)):
-                    self.raise_client_400(environ, "Input row %i seems too short: %i < %i" % (count, len(row), len(columns)))
+        er = EventResponse(dialect, mapping, self.filter_table, self.options)
+        # Why can't we just use er.load_csv() here now?
+        # It would re-sniff, and the checks of user input differ...
 
-                ##if len(row) >= len(mapping):
-                if len(row) >= len(columns):
-                    new_row = self.check_event(columns, row)
-                    if not new_row:
-                        # Silently skip this row
-                        continue
-                    new_row = helper.mapcols(new_row, mapping)
-                    new_row = helper.filtercols(new_row, self.filter_table)
-                    er.ed.append(new_row)
-                    logs.info("New %i: %i item(s), content: %s" % (count, len(new_row), str(new_row)))
-                    count += 1
+        reader = csv.reader(lines, dialect)
+
+        # Is there a header? Heuristic: if there's any item
+        # starting with a digit [0-9] or '+' or '-' in this
+        # row, it's probably not a header!
+        header = reader.next()
+        is_header = True
+        for word in header:
+            if re.match('^[0-9+-]', word):
+                is_header = False
+        if not is_header:
+            reader = itertools.chain([header], reader)
 
-                    if count > limit:
-                        msg = "Too many items, limit is %i" % (limit)
-                        self.raise_client_error(environ, '413 Request Entity Too Large', msg)
+        for row in reader:
+            logs.debug("Row %i: %i item(s), content: %s" % (count, len(row), str(row)))
+
+            if len(row) < min_columns:
+                # Skip rows which don't have enough data, with NO WARNING.
+                # Extra items on the row are ignored.
+                continue
+
+            # This can arise from dopey user input?:
+            if not (len(row) >= len(columns)):
+                self.raise_client_400(environ, "Input row %i seems too short: %i < %i" % (count, len(row), len(columns)))
+
+            ##if len(row) >= len(mapping):
+            if len(row) >= len(columns):
+                new_row = self.check_event(columns, row)
+                if not new_row:
+                    # Silently skip this row
+                    continue
+                new_row = helper.mapcols(new_row, mapping)
+                new_row = helper.filtercols(new_row, self.filter_table)
+                er.ed.append(new_row)
+                logs.info("New %i: %i item(s), content: %s" % (count, len(new_row), str(new_row)))
+                count += 1
 
-        os.unlink(infile)
+                if count > limit:
+                    msg = "Too many items, limit is %i" % (limit)
+                    self.raise_client_error(environ, '413 Request Entity Too Large', msg)
 
         if count == 0:
             self.raise_client_204(environ, 'No rows were read')
@@ -1924,7 +2187,7 @@ class ESEMSC(EventService):
 
         # Make the request
         try:
-            allrows, url = self.send_request(pairs)
+            allrows, url = self.send_request(pairs, parameters)
         except urllib2.URLError as e:
             msg = "No answer from URL / %s" % (e)
             self.raise_client_error(environ, '503 Temporarily Unavailable', msg)
@@ -2124,7 +2387,7 @@ class ESComcat(EventService):
         fmt = hold_dict.get('format', 'text')
 
         try:
-            allrows, url = self.send_request(pairs)
+            allrows, url = self.send_request(pairs, parameters)
         except urllib2.URLError as e:
             msg = "No answer from URL / %s" % (e)
             self.raise_client_error(environ, '503 Temporarily Unavailable', msg)
@@ -2213,7 +2476,7 @@ class ESNeic(EventService):
 
         #url = self.service_url + '?' + self.extra_params + '&'.join(pairs)
         try:
-            allrows, url = self.send_request(pairs)
+            allrows, url = self.send_request(pairs, parameters)
         except urllib2.URLError as e:
             msg = "No answer from URL / %s" % (e)
             self.raise_client_error(environ, '503 Temporarily Unavailable', msg)
@@ -2479,16 +2742,25 @@ class ESGeofon(EventService):
         if limit > -1 and limit <= self.defaultLimit:
             pairs.append('nmax=%i' % (limit))
 
+        # Formats parsed as CSV read the events while they are sent
+        stream = fmt.startswith("json") or fmt == "csv" or fmt == "fdsnws-text"
+
         try:
-            allrows, url = self.send_request(pairs)
+            allrows, url = self.send_request(pairs, parameters, stream)
         except urllib2.URLError as e:
             msg = "No answer from URL / %s" % (e)
             self.raise_client_error(environ, '503 Temporarily Unavailable', msg)
 
         # Heuristic to identify "no data" from eqinfo: ';' and one line break.
-        numrows = allrows.count('\n')
-        if numrows <= 1 and allrows.count(self.csv_dialect.delimiter) > 1:
-            self.raise_client_204(environ, 'No events returned')
+        # Only a short response can be without data, so a streamed one
+        # is looked at only as far as SNIFF_SIZE.
+        head = allrows.peek(SNIFF_SIZE) if stream else allrows
+        numrows = head.count('\n')
+        if len(head) < SNIFF_SIZE or not stream:
+            if numrows <= 1 and head.count(self.csv_dialect.delimiter) > 1:
+                if stream:
+                    allrows.close()
+                self.raise_client_204(environ, 'No events returned')
 
         # Now work on trimming away region outside the circle...
         # July 25: This APPROACH IS WRONG. DOn't try hacking raw text, have send_response accept a structure
@@ -2547,12 +2819,8 @@ class ESFdsnws(EventService):
     filter_table = (date_T, floatordash, None, float, float, floatordash, None, None)
 
     def __init__(self, name, options, service_url, extra_params):
+        EventService.__init__(self, name, options, service_url, extra_params)
         self.name = name
-        self.options = options
-        self.id = name
-        self.service_url = service_url
-        self.extra_params = extra_params
-        self.defaultLimit = options['defaultLimit']
 
     def handler(self, environ, parameters):
         paramMap = defaultParamMap
@@ -2589,7 +2857,7 @@ class ESFdsnws(EventService):
 
         # send a request
         try:
-            allrows, url = self.send_request(pairs)
+            allrows, url = self.send_request(pairs, parameters)
         except urllib2.URLError as e:
             msg = "No answer from URL / %s" % (e)
             self.raise_client_error(environ, '503 Temporarily Unavailable', msg)
@@ -31,6 +31,8 @@ The list of functions exported by this module is:
 - phases: list of phases available to use in "Relative mode"
 - export: downloads a file with the selected stations/streams
 - timewindows: prepares time windows for each (event, stream)
+- status: age and size of the version of the inventory in use and
+  counters of the caches of results of query and of travel times
 
 
 This program is free software; you can redistribute it and/or modify
@@ -52,11 +54,18 @@ GNU General Public License for more details.
 ##################################################################
 
 import datetime
+import hashlib
+import itertools
 import json
+import multiprocessing
+import threading
+import time
 
 import wsgicomm
+import geodist
+import traveltimes
+from lrucache import LRUCache
 import seiscomp3.Seismology
-import seiscomp3.Math as Math
 from seiscomp import logs
 from seiscomp.xmlparser import DateTimeAttr
 
@@ -69,7 +78,75 @@ class MyJSONEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+# The WI_Module seen by the workers of its pool (see WI_Module.__init__)
+_pooled = None
+
+
+def _initWorker():
+    """Prepare a new worker of the pool.
+
+    The pool is forked once, when the module is loaded, so the locks
+    copied from the parent process are not held by any other thread. They
+    are replaced anyway, as well as the cache of travel times, which
+    starts empty.
+
+    """
+
+    module = _pooled
+    module.ttLock = threading.Lock()
+    module.ttCache = LRUCache(module.ttCache.maxsize, None,
+                              module.ttCache.sizeof)
+
+
+def _timewindowsWorker(source, args):
+    """Time windows of a chunk of events, computed in a worker with the
+    version of the inventory built from the XML file with fingerprint
+    source (see InventoryCache.follow).
+
+    Returns the list of time windows, how much the counters of travel times
+    grew, the differences found in validation mode and the class and body
+    of the WIError raised, if any (they cannot be pickled, so the parent
+    raises them again). Returns None if that version of the inventory is
+    not available here; the parent computes the chunk itself then.
+
+    """
+
+    module = _pooled
+
+    if not module.ic.follow(source):
+        return None
+
+    with module.ttLock:
+        module.ttErrors = {}
+        before = (module.ttStreams, module.ttLocations,
+                  module.ttInterpolated, module.ttComputed)
+
+    try:
+        # More than max_lines are useless to the parent
+        rows = list(itertools.islice(module._timewindows_events(*args),
+                                     module.max_lines + 1))
+        error = None
+
+    except wsgicomm.WIError, e:
+        rows = []
+        error = (e.__class__, e.body)
+
+    with module.ttLock:
+        after = (module.ttStreams, module.ttLocations,
+                 module.ttInterpolated, module.ttComputed)
+
+        return (rows, [a - b for a, b in zip(after, before)],
+                module.ttErrors, error)
+
+
 class WI_Module(object):
+    # Parameters which change the result of a query or its format
+    QUERY_PARAMS = ('start', 'end', 'network', 'networktype', 'station',
+                    'sensortype', 'preferredsps', 'streams', 'minlat',
+                    'maxlat', 'minlon', 'maxlon', 'minradius', 'maxradius',
+                    'minazimuth', 'maxazimuth', 'events', 'compact',
+                    'format')
+
     def __init__(self, wi):
         wi.registerAction("/metadata/networktypes", self.networktypes)
         wi.registerAction("/metadata/sensortypes", self.sensortypes)
@@ -78,15 +155,88 @@ class WI_Module(object):
         wi.registerAction("/metadata/stations", self.getStations)
         wi.registerAction("/metadata/streams", self.getStreams)
         wi.registerAction("/metadata/query", self.query)
-        wi.registerAction("/metadata/import", self.upload_selection)
+        wi.registerAction("/metadata/import", self.upload_selection,
+                          maxsize=wi.getConfigInt('metadata.import.maxsize',
+                                                  10 * 1024 * 1024),
+                          uploads=('file',))
         wi.registerAction("/metadata/export", self.download_selection)
         wi.registerAction("/metadata/timewindows", self.timewindows)
+        wi.registerAction("/metadata/status", self.status)
+
+        # Responses which only depend on the parameters and the inventory
+        for name in ('networks', 'stations', 'streams', 'query'):
+            wi.registerValidator("/metadata/" + name, self.validators)
 
         self.max_lines = wi.getConfigInt('js.request.totalLineLimit', 10000)
 
         self.ic = wi.ic
+
+        # The types of networks do not change
+        self.nettypes = wsgicomm.Precompressed(json.dumps(self.ic.nettypes))
+
+        # Results of query, already in JSON format (see __queryKey)
+        self.queryCache = LRUCache(
+            wi.getConfigInt('metadata.query.cache.size', 32) * 1024 * 1024,
+            wi.getConfigInt('metadata.query.cache.ttl', 600))
+        self.queryVersion = None
+
         self.ttt = seiscomp3.Seismology.TravelTimeTable()
 
+        # Arrivals of phases per event and station location (see
+        # __arrivals), which do not change. Bounded by number of entries.
+        self.ttCache = LRUCache(
+            wi.getConfigInt('metadata.traveltimes.cache.size', 100000), None,
+            lambda arrivals: 1)
+
+        # Grid of first arrivals (see traveltimes), built in background
+        # (see __buildGrid), or at once if there is a pool of workers.
+        # Until it is ready the arrivals are computed exactly.
+        self.ttGrid = None
+        self.ttUseGrid = wi.getConfigBool('metadata.traveltimes.grid', True)
+
+        # Validation mode: interpolated arrivals are also computed exactly
+        # and differences larger than ttTolerance seconds are logged
+        self.ttValidate = wi.getConfigBool('metadata.traveltimes.validate',
+                                           False)
+        self.ttTolerance = wi.getConfigFloat(
+            'metadata.traveltimes.tolerance', 1.0)
+        self.ttErrors = {}
+
+        # Streams and station locations for which a time window was needed,
+        # and how the arrivals at the locations were found
+        self.ttLock = threading.Lock()
+        self.ttStreams = 0
+        self.ttLocations = 0
+        self.ttInterpolated = 0
+        self.ttComputed = 0
+
+        # Time windows of many (event, stream) pairs are computed by a pool
+        # of twWorkers processes, if any (see __timewindows_pool)
+        self.twWorkers = wi.getConfigInt('metadata.timewindows.workers', 0)
+        self.twParallel = wi.getConfigInt('metadata.timewindows.parallel',
+                                          20000)
+        self.twDeadline = wi.getConfigInt('metadata.timewindows.deadline',
+                                          300)
+        self.twPool = None
+
+        if self.twWorkers > 0:
+            # The pool is forked only here, never from the thread of a
+            # request: a lock held by another thread at the time of the
+            # fork (e.g. in logging) would stay held for ever in the
+            # workers. The workers need the grid, so it is built first.
+            if self.ttUseGrid:
+                self.__buildGrid()
+
+            global _pooled
+            _pooled = self
+            self.twPool = multiprocessing.Pool(self.twWorkers, _initWorker)
+
+        elif self.ttUseGrid:
+            builder = threading.Thread(target=self.__buildGrid,
+                                       name='TravelTimeGrid')
+            builder.daemon = True
+            builder.start()
+
     def networktypes(self, envir, params):
         """Returns the available types of networks.
 
@@ -110,7 +260,7 @@ class WI_Module(object):
 
         """
 
-        return json.dumps(self.ic.nettypes)
+        return self.nettypes
 
     def sensortypes(self, envir, params):
         """Returns the available sensor types.
@@ -152,6 +302,80 @@ class WI_Module(object):
 
         return json.dumps(self.ic.phases)
 
+    def status(self, envir, params):
+        """Returns information about the version of the inventory in use,
+        the cache of results of query and the travel times computed for
+        timewindows.
+
+        Input: nothing
+        Output: object in JSON format. "age" is the number of seconds since
+                the tables in use were built, "source" identifies the XML
+                file they come from and "reloading" tells whether a new
+                version is being loaded in background. In "traveltimes",
+                "streams" is the number of (event, stream) pairs seen by
+                timewindows, "interpolated" and "computed" tell how many
+                station locations had their arrivals interpolated in the
+                grid or computed exactly and "saved" is the number of
+                calls to compute() avoided. In validation mode "errors"
+                has the number of arrivals compared and the largest
+                difference in seconds per family of phases.
+
+        Example:
+        {"inventory": {"age": 1532.7, "built": "2016-03-01T10:00:12Z",
+                       "loaded": "2016-03-01T10:00:13Z",
+                       "source": {"size": 15840211,
+                                  "md5": "0c5f3e1d8a2b4c6e9f7a1b3d5e7f9a0b"},
+                       "reloading": false, "networks": 734,
+                       "stations": 12081, "streams": 101447},
+         "querycache": {"entries": 12, "size": 1843210,
+                        "maxsize": 33554432, "hits": 310, "misses": 25,
+                        "evictions": 0, "hitratio": 0.9254},
+         "traveltimes": {"entries": 210, "size": 210, "maxsize": 100000,
+                         "hits": 90, "misses": 7000, "evictions": 0,
+                         "hitratio": 0.0127, "streams": 31500,
+                         "locations": 7000, "interpolated": 6700,
+                         "computed": 210, "saved": 31290,
+                         "grid": true, "errors": {}}}
+
+        """
+
+        traveltimes = self.ttCache.stats()
+        with self.ttLock:
+            traveltimes['streams'] = self.ttStreams
+            traveltimes['locations'] = self.ttLocations
+            traveltimes['interpolated'] = self.ttInterpolated
+            traveltimes['computed'] = self.ttComputed
+            traveltimes['errors'] = dict(self.ttErrors)
+
+        traveltimes['saved'] = traveltimes['streams'] - \
+            traveltimes['computed']
+        traveltimes['grid'] = self.ttGrid is not None
+
+        return json.dumps({'inventory': self.ic.status(),
+                           'querycache': self.queryCache.stats(),
+                           'traveltimes': traveltimes})
+
+    def validators(self, envir, params):
+        """Validators (ETag and time of last modification) of the response
+        to a request of networks, stations, streams or query.
+
+        The ETag is derived from the version of the inventory, the function
+        and all the parameters but "_" (used by the browser to avoid its own
+        cache). The response was last modified when the inventory in use was
+        built.
+
+        """
+
+        inv = self.ic.refresh()
+
+        items = sorted((name, value) for name, value in params.iteritems()
+                       if name != '_')
+        digest = hashlib.md5(json.dumps((inv.built, inv.source and
+                                         inv.source[1].encode('hex'),
+                                         envir.get('PATH_INFO'), items)))
+
+        return ('W/"%s"' % digest.hexdigest(), inv.built)
+
     def getNetworks(self, envir, params):
         """Returns the available networks which pass the filter criteria
         received in params.
@@ -244,23 +468,160 @@ class WI_Module(object):
                   [maxazimuth={float}]
                   [preferedsps={int}]
                   [events=<event data sent as POST>]
+                  [compact={true|false}]
+                  [format={rows|columnar}]
 
         Output: list in JSON format. Every item in the list has ten columns.
                 ID, NETCODE, STATIONCODE, LATITUDE, LONGITUDE, RESTRICTED,
                 NETCLASS, ARCHIVE, NETOPERATOR, STREAMS.
                 STREAMS is a list with the available channels in a
                 two-characters format. e.g. ["BH","HH","LN"].
+                With compact=true there are no spaces after separators.
+                The list is sent while it is encoded (see JSONStream).
+
+                With format=columnar, an object with the same information
+                by columns (see __columnar).
 
         """
 
-        result = self.ic.getQuery(params)
+        fmt = params.get('format', 'rows')
+        if fmt not in ('rows', 'columnar'):
+            raise wsgicomm.WIClientError, 'Invalid format: ' + str(fmt)
+
+        # Take the version before the query, so that a result is never
+        # stored as one of a later version
+        inv = self.ic.refresh()
+        if inv is not self.queryVersion:
+            # The results of the previous version are useless
+            self.queryCache.clear()
+            self.queryVersion = inv
+
+        key = self.__queryKey(inv, params)
+        result = self.queryCache.get(key)
+        if result is not None:
+            return result
+
+        rows = self.ic.getQuery(params)
+        header = rows.next()
 
         # If there is no data available send a 204 error.
         # There is always one line containing the headers
-        if len(result) <= 1:
+        first = next(rows, None)
+        if first is None:
             raise wsgicomm.WIContentError('No stations were found.', 0)
 
-        return json.dumps(result)
+        result = itertools.chain([header, first], rows)
+
+        if fmt == 'columnar':
+            result = json.dumps(self.__columnar(result),
+                                separators=self.__separators(params))
+            self.queryCache.put(key, result)
+            return result
+
+        # Stored in the cache once it has been sent completely
+        return wsgicomm.JSONStream(
+            result, separators=self.__separators(params),
+            complete=lambda text: self.queryCache.put(key, text),
+            keep=self.queryCache.maxsize)
+
+    def __columnar(self, rows):
+        """Result of getQuery (an iterator over the header and the rows)
+        by columns.
+
+        Attributes of networks are given once, in "networks", and every
+        station refers to them by position. The same for the codes of the
+        streams (LOC.CHA), listed once in "streamcodes". Example:
+
+        {"format": "columnar", "length": 2,
+         "networks": {"netcode": ["GE"], "netclass": ["p"],
+                      "archive": ["GFZ"], "netoperator": ["GFZ"]},
+         "streamcodes": [".BHZ", ".HHZ"],
+         "columns": {"key": ["GE-1993-APE-2004319", "GE-1993-KBS-200691"],
+                     "network": [0, 0], "statcode": ["APE", "KBS"],
+                     "latitude": [37.07, 78.92], "longitude": [25.53, 11.94],
+                     "restricted": [2, 2], "streams": [[0, 1], [1]],
+                     "streams_restricted": [[2, 2], [2]]}}
+
+        """
+
+        header = rows.next()
+        col = dict((name, i) for i, name in enumerate(header))
+        netattrs = ('netcode', 'netclass', 'archive', 'netoperator')
+
+        networks = dict((name, []) for name in netattrs)
+        netidx = {}
+        streamcodes = []
+        streamidx = {}
+
+        columns = dict((name, []) for name in
+                       ('key', 'network', 'statcode', 'latitude', 'longitude',
+                        'restricted', 'streams', 'streams_restricted'))
+
+        length = 0
+        for row in rows:
+            length += 1
+            net = tuple(row[col[name]] for name in netattrs)
+            try:
+                n = netidx[net]
+
+            except KeyError:
+                n = netidx[net] = len(netidx)
+                for name, value in zip(netattrs, net):
+                    networks[name].append(value)
+
+            streams = []
+            for code in row[col['streams']]:
+                try:
+                    streams.append(streamidx[code])
+
+                except KeyError:
+                    streamidx[code] = len(streamcodes)
+                    streams.append(len(streamcodes))
+                    streamcodes.append(code)
+
+            columns['network'].append(n)
+            columns['streams'].append(streams)
+            for name in ('key', 'statcode', 'latitude', 'longitude',
+                         'restricted', 'streams_restricted'):
+                columns[name].append(row[col[name]])
+
+        return {'format': 'columnar', 'length': length,
+                'networks': networks, 'streamcodes': streamcodes,
+                'columns': columns}
+
+    def __separators(self, params):
+        """Separators of JSON for the format asked in params: None (the
+        default of json) or, with compact=true, without spaces.
+
+        """
+
+        if params.get('compact', 'false').lower() in ('true', '1'):
+            return (',', ':')
+
+        return None
+
+    def __queryKey(self, inv, params):
+        """Key of the result of a query in self.queryCache.
+
+        The key identifies the version of the inventory and the parameters
+        which change the result. Lists of codes are sorted, as the order
+        does not matter, and any other parameter (e.g. added by the browser
+        to avoid its own cache) is ignored.
+
+        """
+
+        items = []
+        for name in self.QUERY_PARAMS:
+            value = params.get(name)
+            if value is None:
+                continue
+
+            if name in ('station', 'streams'):
+                value = ','.join(sorted(set(value.split(','))))
+
+            items.append((name, value))
+
+        return (inv.built, inv.source, hashlib.md5(json.dumps(items)).digest())
 
     def upload_selection(self, envir, params):
         """Returns the stations/streams received in the uploaded file
@@ -277,25 +638,33 @@ class WI_Module(object):
 
         # result = self.ic.getFromUpload(params)
 
+        # The upload gives its lines one by one, a string is split
+        upload = params.get('file')
+        if upload is None:
+            raise wsgicomm.WIClientError, "Parameter 'file' is missing"
+        if isinstance(upload, basestring):
+            upload = upload.splitlines()
+
         # Omit empty lines and lines containing only whitespace
-        lines = [line for line in params['file'].splitlines()
-                 if line.strip()]
+        lines = (line for chunk in upload for line in chunk.splitlines()
+                 if line.strip())
+
         # Test if we are working with a FDSN-WS station file (at chennel level)
-        if lines[0][0] == '#':
+        first = next(lines, '')
+        if first.startswith('#'):
             separ = '|'
-            lines = lines[1:]
         # or with an own file
         else:
             separ = ' '
+            lines = itertools.chain((first,), lines)
 
-        auxLines = [tuple(line.split(separ, 4)) for line in lines]
-
-        # Remove extra fields if they are present
-        lines = [(line[0], line[1], line[2] if len(line[2]) else '--', line[3])
-                 for line in auxLines if len(line) >= 4]
-
-        # Remove duplicate lines
-        nslcSet = set(lines)
+        # Remove extra fields if they are present and duplicate lines
+        nslcSet = set()
+        for line in lines:
+            line = line.split(separ, 4)
+            if len(line) >= 4:
+                nslcSet.add((line[0], line[1], line[2] if len(line[2]) else '--',
+                             line[3]))
 
         # Create a set of stations to call getQuery
         nsSet = set([(nslc[0], nslc[1]) for nslc in nslcSet])
@@ -312,37 +681,30 @@ class WI_Module(object):
             n, s = nsList.pop(0)
 
             # To make notation shorter
-            ptNets = self.ic.networks
-            ptStats = self.ic.stations
+            inv = self.ic.refresh()
+            ptNets = inv.networks
+            ptStats = inv.stations
 
             # Cycle through networks
-            for net in ptNets:
+            for netIdx in xrange(len(ptNets)):
                 # Check if I found the network
-                if n == net[0]:
+                if n == ptNets.code[netIdx]:
                     # A normal network has pointers to first and last child
-                    if((net[1] is not None) and (net[2] is not None)):
-                        list_of_children = range(net[1], net[2])
-                    # A virtual network has a list of children
-                    else:
-                        list_of_children = net[3]
-
+                    # while a virtual network has a list of children
                     # Cycle through children (stations)
-                    for staIdx in list_of_children:
-                        sta = ptStats[staIdx]
+                    for staIdx in ptNets.children(netIdx):
                         # Check if I found the station
-                        if s == sta[4]:
+                        if s == ptStats.code[staIdx]:
 
                             # Build key to avoid duplicates due to different
                             # epochs! See GE.APE
-                            statKey = '%s-%s-%s-%s' % (net[0], net[4],
-                                                       net[5], sta[4])
+                            netKey = ptNets.key(netIdx)
+                            statKey = '%s-%s' % (netKey, s)
                             if statKey not in statsSet:
                                 # Query for ALL the streams in the station
-                                auxParams = {'network': '%s-%s-%s' %
-                                             (net[0], net[4], net[5]),
-                                             'station': '%s-%s-%s-%s' %
-                                             (net[0], net[4], net[5], sta[4])}
-                                partial = self.ic.getQuery(auxParams)
+                                auxParams = {'network': netKey,
+                                             'station': statKey}
+                                partial = list(self.ic.getQuery(auxParams))
 
                                 # Filter by location and channel
                                 # Remove header
@@ -361,7 +723,7 @@ class WI_Module(object):
 
                                         # Check if this stream is among the
                                         # requested ones
-                                        if ((net[0], sta[4], auxLoc, auxCh)
+                                        if ((n, s, auxLoc, auxCh)
                                                 in nslcSet):
                                             # And add it to the filtered
                                             # streams
@@ -461,59 +823,252 @@ class WI_Module(object):
                         content_type=content_type)
         return body
 
+    def __nslc(self, nscl):
+        """Check a stream received as [net, sta, cha, loc] and return it as
+        a tuple of strings.
+
+        """
+
+        try:
+            if len(nscl) != 4:
+                msg = "Invalid stream: " + str(nscl)
+                raise wsgicomm.WIClientError, msg
+
+            return (str(nscl[0]), str(nscl[1]), str(nscl[2]), str(nscl[3]))
+
+        except (TypeError, ValueError):
+            raise wsgicomm.WIClientError, "Invalid stream: " + str(nscl)
+
     def __timewindows_tw(self, streams, start_time, end_time):
-        result = []
+        """Time windows of the streams in a fixed period, as an iterator.
 
-        for nscl in streams:
-            try:
-                if len(nscl) != 4:
-                    msg = "Invalid stream: " + str(nscl)
-                    raise wsgicomm.WIClientError, msg
+        The streams are checked and looked up at once, the rows are built
+        while they are taken.
 
-                net = str(nscl[0])
-                sta = str(nscl[1])
-                cha = str(nscl[2])
-                loc = str(nscl[3])
+        """
 
-            except (TypeError, ValueError):
-                raise wsgicomm.WIClientError, "invalid stream: " + str(nscl)
+        nslcs = [self.__nslc(nscl) for nscl in streams]
+        infos = self.ic.getStreamInfoMany([(start_time, end_time, nslc)
+                                           for nslc in nslcs])
 
-            streamInfo = self.ic.getStreamInfo(start_time, end_time, net,
-                                               sta, cha, loc)
+        # stream does exist in this time range
+        return ((start_time, end_time, net, sta, cha, loc, streamInfo['size'])
+                for (net, sta, cha, loc), streamInfo in zip(nslcs, infos)
+                if streamInfo)
 
-            if streamInfo:  # stream does exist in this time range
-                result.append((start_time, end_time, net, sta, cha, loc,
-                               streamInfo['size']))
+    def __limited(self, rows):
+        """The rows of timewindows, raising WIClientError when there are
+        more than self.max_lines of them.
 
-                if len(result) > self.max_lines:
-                    msg = "Maximum request size exceeded"
-                    raise wsgicomm.WIClientError, msg
+        """
+
+        count = 0
+        for row in rows:
+            count += 1
+            if count > self.max_lines:
+                msg = "Maximum request size exceeded"
+                raise wsgicomm.WIClientError, msg
+
+            yield row
+
+    def __buildGrid(self):
+        """Build the TravelTimeGrid of self.ttt, in the thread started by
+        __init__ or, if there is a pool of workers, before forking it.
+
+        """
+
+        start = time.time()
+        try:
+            grid = traveltimes.TravelTimeGrid(self.ttt)
+
+        except Exception, e:
+            logs.error("/metadata/timewindows: could not build grid "
+                       "of travel times: " + str(e))
+            self.ttUseGrid = False
+            return
+
+        # A single assignment: requests see either no grid or all of it
+        self.ttGrid = grid
+        logs.info("Grid of travel times built in %.1f s" %
+                  (time.time() - start))
+
+    def __grid(self):
+        """The TravelTimeGrid of self.ttt, or None if interpolation is
+        disabled or the grid is not ready (yet). Requests never wait for
+        it.
+
+        """
+
+        return self.ttGrid
+
+    def __families(self, delta, phases):
+        """Families of phases (see traveltimes) needed for phases at delta
+        degrees from the event.
+
+        """
+
+        result = set()
+        for phase in phases:
+            if phase == 'P' and delta >= traveltimes.PKP_DISTANCE:
+                result.add('PKP')
+
+            elif phase in traveltimes.FAMILIES:
+                result.add(phase)
 
         return result
 
-    def __isphase(self, ttphase, phase):
+    def __arrivals(self, ev_lat, ev_lon, ev_dep, locations, phases):
+        """First arrivals after the origin time of the families of phases
+        used by timewindows (see traveltimes.firstArrivals), for every
+        station location of an event.
 
-        # The list of phases P and S has been provided by Joachim per email
-        # on 14.08.2013
-        # The case of P and a distance larger than 120 deg must be checked
-        # outside this function as we do not have this information here.
-        # March/April 2014: Phase "OT" contributed by Carlo Cauzzi, ETHZ.
-        if phase == 'P':
-            if ttphase in ('P', 'Pg', 'Pb', 'Pn', 'Pdif', 'Pdiff'):
-                return True
+        Input: locations={dictionary}  # (lat, lon, elevation) -> distance
+               phases={list}           # start and end phase
 
-        elif phase == 'S':
-            if ((ttphase in ('S', 'Sg', 'Sb', 'Sn', 'Sdif', 'Sdiff')) or
-                    ttphase.startswith('SKS')):
-                return True
-        elif phase =='OT': # Oh well, it's not a phase but better to be consistent with what we have #Carlo
-            return True
+        Output: dictionary location -> arrivals, None where compute()
+                failed.
 
-        else:
-            msg = 'Wrong phase received! Only "P", "S" and "OT" are implemented.'
-            raise wsgicomm.WIClientError, msg
+        Arrivals are interpolated in the grid of travel times if possible
+        and otherwise computed exactly and kept in self.ttCache.
+
+        """
+
+        result = {}
+        pending = []
+
+        for coords, delta in locations.iteritems():
+            arrivals = self.ttCache.get((ev_lat, ev_lon, ev_dep) + coords)
+            if arrivals is not None:
+                result[coords] = arrivals
+
+            else:
+                pending.append((coords, delta))
+
+        grid = self.__grid() if pending else None
+        if grid is not None:
+            interpolated = grid.arrivals([delta for c, delta in pending],
+                                         [ev_dep] * len(pending))
+
+            exact = []
+            for (coords, delta), arrivals in zip(pending, interpolated):
+                if self.__families(delta, phases).issubset(arrivals):
+                    result[coords] = arrivals
+
+                else:
+                    exact.append((coords, delta))
 
-        return False
+            with self.ttLock:
+                self.ttInterpolated += len(pending) - len(exact)
+
+            if self.ttValidate:
+                computed = set(c for c, d in exact)
+                self.__validate(grid, ev_lat, ev_lon, ev_dep,
+                                [(c, d) for c, d in pending
+                                 if c not in computed])
+
+            pending = exact
+
+        for coords, delta in pending:
+            (st_lat, st_lon, st_alt) = coords
+
+            with self.ttLock:
+                self.ttComputed += 1
+
+            try:
+                ttlist = self.ttt.compute(ev_lat, ev_lon, ev_dep, st_lat,
+                                          st_lon, st_alt)
+            except Exception, e:
+                msg = "/metadata/timewindows: exception from " + \
+                    "ttt.compute(): " + str(e)
+                logs.error(msg)
+                result[coords] = None
+                continue
+
+            arrivals = traveltimes.firstArrivals(ttlist)
+            self.ttCache.put((ev_lat, ev_lon, ev_dep) + coords, arrivals)
+            result[coords] = arrivals
+
+        return result
+
+    def __validate(self, grid, ev_lat, ev_lon, ev_dep, locations):
+        """Compare interpolated arrivals with those of compute() and keep
+        the largest differences in self.ttErrors.
+
+        """
+
+        points = [(ev_lat, ev_lon, ev_dep) + coords + (delta,)
+                  for coords, delta in locations]
+
+        try:
+            errors = grid.validate(self.ttt, points)
+
+        except Exception, e:
+            logs.error("/metadata/timewindows: exception from "
+                       "ttt.compute(): " + str(e))
+            return
+
+        with self.ttLock:
+            for fam, (count, maxdiff) in errors.iteritems():
+                (total, largest) = self.ttErrors.get(fam, (0, 0.0))
+                self.ttErrors[fam] = (total + count, max(largest, maxdiff))
+
+        for fam, (count, maxdiff) in sorted(errors.iteritems()):
+            if maxdiff > self.ttTolerance:
+                logs.warning("/metadata/timewindows: interpolated %s arrivals "
+                             "off by up to %.2f s for event %s" %
+                             (fam, maxdiff, str((ev_lat, ev_lon, ev_dep))))
+
+    def __timewindow(self, ev_lat, ev_lon, ev_dep, ev_time, coords, delta,
+                     arrivals, startphase, startoffset, endphase, endoffset):
+        """Time window (start_time, end_time) of the streams at a station
+        location for one event, or None if it cannot be computed.
+
+        See __timewindows_ev for the meaning of the parameters. delta is the
+        distance in degrees between the event and the station and arrivals
+        the first arrivals there (see __arrivals).
+
+        """
+
+        if arrivals is None:
+            return None
+
+        (st_lat, st_lon, st_alt) = coords
+
+        times = []
+
+        for (name, phase, offset) in (('startphase', startphase, startoffset),
+                                      ('endphase', endphase, endoffset)):
+            if phase not in ('P', 'S', 'OT'):
+                # Only reported if compute() returned any phase, as before
+                if arrivals:
+                    logs.error('/metadata/timewindows: Wrong %s received! '
+                               'Only "P", "S" and "OT" are implemented.' %
+                               name)
+                    return None
+
+                arrival = None
+
+            elif (phase == 'P') and (delta >= traveltimes.PKP_DISTANCE):
+                arrival = arrivals.get('PKP')
+
+            else:
+                arrival = arrivals.get(phase)
+
+            if arrival is None:
+                msg = "/metadata/timewindows: did not find %s " % name \
+                    + "'%s' for %s" % (phase, str((ev_lat, ev_lon, ev_dep,
+                                                   st_lat, st_lon, st_alt)))
+                logs.error(msg)
+                times.append(None)
+
+            else:
+                times.append(ev_time + datetime.timedelta(
+                    seconds=arrival + offset * 60))
+
+        if None in times:
+            return None
+
+        return tuple(times)
 
     def __timewindows_ev(self, streams, events, startphase, startoffset,
                          endphase, endoffset):
@@ -530,158 +1085,180 @@ class WI_Module(object):
                                        # POSITIVE if AFTER arrival of
                                        # 'endphase' at station.
 
-        Output: list of start/end times per stream, AND estimated data volume,
+        Output: iterator over start/end times per stream, AND estimated data
+                volume,
                 (start_time, end_time, net, sta, cha, loc, streamInfo['size'])
+                The events are checked at once, but the rows are computed
+                while they are taken.
 
         NOTE 1: stream is a list of [net, sta, cha, loc] instead of nslc here!
-        NOTE 2: There are many redundant time window computations for multiple
-        streams at the same location
+        NOTE 2: The time window is computed once for all the streams at the
+        same location, with arrivals interpolated in a grid of travel times
+        or computed exactly and kept in self.ttCache (see __arrivals).
         """
 
-        result = []
+        deadline = time.time() + self.twDeadline if self.twDeadline else None
 
+        # Checked only once, and only if there is any event
+        nslcs = [self.__nslc(nscl) for nscl in streams] if events else []
+
+        parsed = []
         for ev in events:
             try:
                 if len(ev) != 4:
                     raise wsgicomm.WIClientError, "invalid event: " + str(ev)
 
-                ev_lat = float(ev[0])
-                ev_lon = float(ev[1])
-                ev_dep = float(ev[2])
-                ev_time = DateTimeAttr().fromxml(ev[3])
+                parsed.append((float(ev[0]), float(ev[1]), float(ev[2]),
+                               DateTimeAttr().fromxml(ev[3])))
 
             except (TypeError, ValueError):
                 raise wsgicomm.WIClientError, "invalid event: " + str(ev)
 
-            for nscl in streams:
-                try:
-                    if len(nscl) != 4:
-                        msg = "Invalid stream: " + str(nscl)
-                        raise wsgicomm.WIClientError, msg
+        args = (nslcs, parsed, startphase, startoffset, endphase, endoffset,
+                deadline)
 
-                    net = str(nscl[0])
-                    sta = str(nscl[1])
-                    cha = str(nscl[2])
-                    loc = str(nscl[3])
+        if self.twWorkers > 0 and len(parsed) > 1 and \
+                len(parsed) * len(nslcs) >= self.twParallel:
+            return self.__timewindows_pool(*args)
 
-                except (TypeError, ValueError):
-                    msg = "Invalid stream: " + str(nscl)
-                    raise wsgicomm.WIClientError, msg
+        return self._timewindows_events(*args)
+
+    def _timewindows_events(self, nslcs, events, startphase, startoffset,
+                            endphase, endoffset, deadline):
+        """Time windows of the streams nslcs for a list of events, each
+        given as (lat, lon, depth, time). See __timewindows_ev; also run
+        by the workers of the pool (see _timewindowsWorker). The rows are
+        generated event by event.
+
+        Raises WIServiceError if the deadline (a time.time() value, or
+        None) passes before all the events are processed.
 
-                # we don't have actual time window yet, just use ev_time to
-                # get the coordinates
-                streamInfo = self.ic.getStreamInfo(ev_time, ev_time, net, sta,
-                                                   cha, loc)
+        """
 
-                if streamInfo is None:  # stream is not available
-                    continue
+        for (ev_lat, ev_lon, ev_dep, ev_time) in events:
+            if deadline is not None and time.time() > deadline:
+                msg = "Time windows not computed within %d seconds, " \
+                    "please select fewer events or streams" % self.twDeadline
+                raise wsgicomm.WIServiceError, msg
+
+            # Streams available at the time of the event. We don't have
+            # actual time window yet, just use ev_time to get the
+            # coordinates.
+            located = [nslc + (streamInfo,) for nslc, streamInfo in
+                       zip(nslcs, self.ic.getStreamInfoMany(
+                           [(ev_time, ev_time, nslc) for nslc in nslcs]))
+                       if streamInfo is not None]
+
+            # Time windows of the streams, checked all at once at the end
+            windows = []
+
+            # Compute in one call the distances between event and stations
+            distances = geodist.delazi([ev_lat], [ev_lon],
+                                       [si['latitude'] for n, s, c, l, si
+                                        in located],
+                                       [si['longitude'] for n, s, c, l, si
+                                        in located])[0][0]
+
+            # Station locations, each with its distance to the event
+            locations = {}
+            for (net, sta, cha, loc, si), delta in zip(located, distances):
+                locations.setdefault((si['latitude'], si['longitude'],
+                                      si['elevation']), delta)
+
+            arrivals = self.__arrivals(ev_lat, ev_lon, ev_dep, locations,
+                                       (startphase, endphase))
+
+            # Time window at every station location, shared by all its
+            # streams. None if it could not be computed.
+            located_tw = {}
+            for coords, delta in locations.iteritems():
+                located_tw[coords] = self.__timewindow(
+                    ev_lat, ev_lon, ev_dep, ev_time, coords, delta,
+                    arrivals[coords], startphase, startoffset, endphase,
+                    endoffset)
+
+            for net, sta, cha, loc, si in located:
+                tw = located_tw[(si['latitude'], si['longitude'],
+                                 si['elevation'])]
+
+                if tw is not None:
+                    windows.append(tw + ((net, sta, cha, loc),))
+
+            with self.ttLock:
+                self.ttStreams += len(located)
+                self.ttLocations += len(locations)
+
+            # retry with actual time windows
+            for (start_time, end_time, (net, sta, cha, loc)), streamInfo in \
+                    zip(windows, self.ic.getStreamInfoMany(windows)):
+                if streamInfo:
+                    yield (start_time, end_time, net, sta, cha, loc,
+                           streamInfo['size'])
+
+    def __timewindows_pool(self, nslcs, events, startphase, startoffset,
+                           endphase, endoffset, deadline):
+        """Same as _timewindows_events, but the events are split in
+        consecutive chunks processed by the pool of workers. The results
+        of the chunks are generated in the original order, each as soon
+        as it is ready.
+
+        The workers were forked with the inventory as it was when the
+        module was loaded. They are given the fingerprint of the version in
+        use, and map its snapshot themselves if it changed since then (see
+        InventoryCache.follow). A chunk which a worker cannot compute with
+        that version is computed here.
 
-                st_lat = streamInfo['latitude']
-                st_lon = streamInfo['longitude']
-                st_alt = streamInfo['elevation']
+        """
 
-                start_time = None
-                end_time = None
+        source = self.ic.current.source
 
-                # Assumption here is that compute() returns phases sorted by
-                # time. Therefore breaking after the first gives the earliest
-                # phase in the set defined in __isphase().
-                # FIXME: Combine startphase and endphase logic into
-                # function+loop?
+        # Twice as many chunks as workers, so that they finish together
+        size = -(-len(events) // (2 * self.twWorkers))
+        args = [(nslcs, events[i:i + size], startphase, startoffset,
+                 endphase, endoffset, deadline)
+                for i in xrange(0, len(events), size)]
+        chunks = [self.twPool.apply_async(_timewindowsWorker, (source, a))
+                  for a in args]
 
-                # Compute in delta the distance between event and station
-                delta = Math.delazi(ev_lat, ev_lon, st_lat, st_lon)[0]
-                # Threshold distance in degrees at which PKP arrives earlier
-                # than P and friends (see Joachim's email - 14.08.2013)
-                delta_threshold = 120
+        for chunk, a in zip(chunks, args):
+            try:
+                timeout = None
+                if deadline is not None:
+                    # A little longer than the workers, which check it
+                    # themselves between events
+                    timeout = max(0, deadline - time.time()) + 5
 
-                try:
-                    ttlist = self.ttt.compute(ev_lat, ev_lon, ev_dep, st_lat,
-                                              st_lon, st_alt)
-                except Exception, e:
-                    msg = "/metadata/timewindows: exception from " + \
-                        "ttt.compute(): " + str(e)
-                    logs.error(msg)
-                    continue
+                answer = chunk.get(timeout)
 
-                try:
-                    for tt in ttlist:
-                        if (startphase == 'P') and (delta >= delta_threshold):
-                            if (tt.phase.startswith('PKP') or
-                                    tt.phase.startswith('PKiKP')):
-                                start_time = ev_time + \
-                                    datetime.timedelta(seconds=tt.time +
-                                                       startoffset * 60)
-                                break
-
-                        elif ((startphase == 'S') or
-                              ((startphase == 'P') and
-                               (delta < delta_threshold))):
-                            if self.__isphase(tt.phase, startphase):
-                                start_time = ev_time + datetime.timedelta(
-                                    seconds=tt.time + startoffset * 60)
-                                break
-                        elif (startphase == 'OT'):
-                            start_time = ev_time + datetime.timedelta(seconds=startoffset * 60)
-                        else:
-                            msg = 'Wrong startphase received! Only "P", ' + \
-                                '"S" and "OT" are implemented.'
-                            raise wsgicomm.WIClientError, msg
-
-                    for tt in ttlist:
-                        if (endphase == 'P') and (delta >= delta_threshold):
-                            if (tt.phase.startswith('PKP') or
-                                    tt.phase.startswith('PKiKP')):
-                                end_time = ev_time + datetime.timedelta(
-                                    seconds=tt.time + endoffset * 60)
-                                break
-
-                        elif ((endphase == 'S') or
-                              ((endphase == 'P') and
-                               (delta < delta_threshold))):
-                            if self.__isphase(tt.phase, endphase):
-                                end_time = ev_time + datetime.timedelta(
-                                    seconds=tt.time + endoffset * 60)
-                                break
-                        elif (endphase == 'OT'):
-                                end_time = ev_time + datetime.timedelta(seconds=endoffset * 60)
-                        else:
-                            msg = 'Wrong endphase received! Only "P", ' + \
-                                '"S" and "OT" are implemented.'
-                            raise wsgicomm.WIClientError, msg
-
-                except Exception, e:
-                    logs.error("/metadata/timewindows: " + str(e))
-                    continue
-
-                if start_time is None:
-                    msg = "/metadata/timewindows: did not find startphase " \
-                        + "'%s' for %s" % (startphase, str((ev_lat, ev_lon,
-                                                            ev_dep, st_lat,
-                                                            st_lon, st_alt)))
-                    logs.error(msg)
-
-                if end_time is None:
-                    msg = "/metadata/timewindows: did not find endphase " \
-                        + "'%s' for %s" % (endphase, str((ev_lat, ev_lon,
-                                                          ev_dep, st_lat,
-                                                          st_lon, st_alt)))
-                    logs.error(msg)
-
-                if start_time is not None and end_time is not None:
-                    # retry with actual time window
-                    streamInfo = self.ic.getStreamInfo(start_time, end_time,
-                                                       net, sta, cha, loc)
-
-                    if streamInfo:
-                        result.append((start_time, end_time, net, sta, cha,
-                                       loc, streamInfo['size']))
-
-                        if len(result) > self.max_lines:
-                            msg = "Maximum request size exceeded"
-                            raise wsgicomm.WIClientError, msg
+            except multiprocessing.TimeoutError:
+                msg = "Time windows not computed within %d seconds, " \
+                    "please select fewer events or streams" % self.twDeadline
+                raise wsgicomm.WIServiceError, msg
 
-        return result
+            if answer is None:
+                for row in self._timewindows_events(*a):
+                    yield row
+
+                continue
+
+            (rows, counters, errors, error) = answer
+
+            with self.ttLock:
+                self.ttStreams += counters[0]
+                self.ttLocations += counters[1]
+                self.ttInterpolated += counters[2]
+                self.ttComputed += counters[3]
+
+                for fam, (count, maxdiff) in errors.iteritems():
+                    (total, largest) = self.ttErrors.get(fam, (0, 0.0))
+                    self.ttErrors[fam] = (total + count,
+                                          max(largest, maxdiff))
+
+            if error is not None:
+                raise error[0], error[1]
+
+            for row in rows:
+                yield row
 
     def __get_param(self, params, conv, name):
         try:
@@ -698,7 +1275,8 @@ class WI_Module(object):
                start={datetimestring}
                end={datetimestring}
                streams=JSON
-           Response:   JSON
+               [compact={true|false}]
+           Response:   JSON, indented unless compact=true
 
         """
 
@@ -746,11 +1324,14 @@ class WI_Module(object):
             result = self.__timewindows_ev(streams, events, startphase,
                                            startoffset, endphase, endoffset)
 
-        if isinstance(result, tuple):
-            return result
-
-        try:
-            return json.dumps(result, cls=MyJSONEncoder, indent=4)
-
-        except ValueError, e:
-            raise wsgicomm.WIInternalError, str(e)
+        # The first row is computed at once, so that an error found there
+        # is still sent as an error page
+        result = self.__limited(result)
+        first = next(result, None)
+        if first is not None:
+            result = itertools.chain([first], result)
+
+        separators = self.__separators(params)
+        return wsgicomm.JSONStream(result, cls=MyJSONEncoder,
+                                   indent=4 if separators is None else None,
+                                   separators=separators)
@@ -102,10 +102,10 @@ class WI_Module(object):
         return d
 
     def __estimate_size(self, req_body):
-        for rl in req_body:
-            info = self.ic.getStreamInfo(rl.start_time, rl.end_time,
-                    rl.net, rl.sta, rl.cha, rl.loc)
+        infos = self.ic.getStreamInfoMany([(rl.start_time, rl.end_time,
+                    (rl.net, rl.sta, rl.cha, rl.loc)) for rl in req_body])
 
+        for rl, info in zip(req_body, infos):
             if info: rl.estimated_size = info['size']
             else: rl.estimated_size = 0
 
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# Names of the Flinn-Engdahl regions of events, looked up once per cell
+#
+# ----------------------------------------------------------------------
+
+
+"""Names of the Flinn-Engdahl regions of events, looked up once per cell
+
+Copyright (C) 2016 GEOFON team, Helmholtz-Zentrum Potsdam - Deutsches GeoForschungsZentrum GFZ
+
+A RegionResolver gives the region names of points with a single
+seiscomp3.Seismology.Regions object, shared by all the threads of a
+process and created when first needed. Points are grouped in cells of
+step degrees (0.01 by default, about 1 km) and every cell is looked up
+once, at its south-west corner. The Flinn-Engdahl regions are made of
+whole degrees, so all the points of a cell are in the same region.
+This does not hold for the polygons of the .fep files, which
+getRegionName consults first: a point within step degrees of a boundary
+not on the grid of cells may be given the name of its neighbour. A step
+of 0 looks up every point at its own coordinates. The names of the most
+recently used cells (or points) are kept in an LRUCache.
+
+names() resolves many points at once, e.g. the columns of latitudes and
+longitudes of an EventData, looking up every cell only once. The number
+of lookups and the time spent in them are counted, see stats().
+
+
+This program is free software; you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 2, or (at your option) any later
+version. For more information, see http://www.gnu.org/
+
+"""
+
+import threading
+import time
+
+from lrucache import LRUCache
+
+# Size of a cell in degrees (0: every point looked up exactly), and
+# number of cells kept
+STEP = 0.01
+MAX_CELLS = 100000
+
+
+class RegionResolver(object):
+    """Region names of points, with regions = factory() created once."""
+
+    def __init__(self, factory, step=STEP, maxsize=MAX_CELLS):
+        self.factory = factory
+        self.perdegree = int(round(1.0 / step)) if step > 0 else None
+        self.cache = LRUCache(maxsize, None, lambda name: 1)
+
+        self.__regions = None
+        self.__lock = threading.Lock()
+
+        self.__lookups = 0
+        self.__seconds = 0.0
+
+    def __cell(self, lat, lon):
+        """Cell of a point, or None if its coordinates are not numbers.
+        Without cells, the point itself.
+
+        """
+
+        try:
+            if self.perdegree is None:
+                return (float(lat), float(lon))
+
+            return (int(float(lat) * self.perdegree // 1),
+                    int(float(lon) * self.perdegree // 1))
+
+        except (TypeError, ValueError):
+            return None
+
+    def __lookup(self, cell):
+        name = self.cache.get(cell)
+        if name is not None:
+            return name
+
+        if self.perdegree is None:
+            (lat, lon) = cell
+        else:
+            (lat, lon) = (float(cell[0]) / self.perdegree,
+                          float(cell[1]) / self.perdegree)
+
+        with self.__lock:
+            if self.__regions is None:
+                self.__regions = self.factory()
+
+            start = time.time()
+            name = self.__regions.getRegionName(lat, lon)
+            self.__seconds += time.time() - start
+            self.__lookups += 1
+
+        self.cache.put(cell, name)
+        return name
+
+    def name(self, lat, lon):
+        """Region name of a point, or None if lat or lon is not a number."""
+
+        cell = self.__cell(lat, lon)
+        if cell is None:
+            return None
+
+        return self.__lookup(cell)
+
+    def names(self, lats, lons):
+        """Region names of many points, as a list (see name())."""
+
+        found = {None: None}
+        result = []
+        for (lat, lon) in zip(lats, lons):
+            cell = self.__cell(lat, lon)
+            if cell not in found:
+                found[cell] = self.__lookup(cell)
+
+            result.append(found[cell])
+
+        return result
+
+    def stats(self):
+        """Counters of the cache, as LRUCache.stats(), and the lookups of
+        cells which were not in it, with the time spent in them.
+
+        """
+
+        stats = self.cache.stats()
+        with self.__lock:
+            stats.update({'lookups': self.__lookups,
+                          'seconds': round(self.__seconds, 6)})
+
+        return stats
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+# Dispatch of requests of the web interface to the registered actions
+#
+# ----------------------------------------------------------------------
+
+
+"""Dispatch of requests of the web interface to the registered actions
+
+Copyright (C) 2016 GEOFON team, Helmholtz-Zentrum Potsdam - Deutsches GeoForschungsZentrum GFZ
+
+Actions are registered under a route, either a fixed path like
+"/metadata/networks" or a template with parameters in some of its
+components, like "/event/{service}". A Router finds the route of a path:
+fixed paths are a single dictionary lookup, templates are grouped by the
+fixed prefix before their first parameter and by their number of
+components, so that only the few templates which can match are tried.
+Fixed paths take precedence over templates, and longer prefixes over
+shorter ones.
+
+The parameters of a request are parsed once (see formdata) and handed to
+the action in a Request together with the parameters taken from the path.
+
+
+This program is free software; you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 2, or (at your option) any later
+version. For more information, see http://www.gnu.org/
+
+"""
+
+
+class Router(object):
+    """Routes of the registered actions."""
+
+    def __init__(self):
+        # path -> route, for routes without parameters
+        self.__fixed = {}
+
+        # (prefix, number of components after it) -> list of (components,
+        # route); a component is (True, name) for a parameter and
+        # (False, text) otherwise
+        self.__templates = {}
+
+    def add(self, route):
+        """Register a route, e.g. "/event/{service}"."""
+
+        if '{' not in route:
+            self.__fixed[route] = route
+            return
+
+        parts = route.split('/')
+        first = [i for i, p in enumerate(parts) if p.startswith('{')][0]
+        prefix = '/'.join(parts[:first]) + '/'
+
+        components = []
+        for p in parts[first:]:
+            if p.startswith('{') and p.endswith('}') and len(p) > 2:
+                components.append((True, p[1:-1]))
+            elif '{' in p or '}' in p:
+                raise ValueError('Invalid component "%s" in route %s' %
+                                 (p, route))
+            else:
+                components.append((False, p))
+
+        key = (prefix, len(components))
+        entries = self.__templates.setdefault(key, [])
+        entries[:] = [e for e in entries if e[1] != route]
+        entries.append((tuple(components), route))
+
+    def match(self, path):
+        """Route of a path and the parameters taken from it.
+
+        Returns (route, args), where args maps the names of the parameters
+        to the components of path, or None if no route matches.
+
+        """
+
+        route = self.__fixed.get(path)
+        if route is not None:
+            return (route, {})
+
+        if not self.__templates:
+            return None
+
+        slash = path.rfind('/')
+        while slash >= 0:
+            prefix = path[:slash + 1]
+            rest = path[slash + 1:].split('/')
+
+            for components, route in self.__templates.get((prefix, len(rest)),
+                                                          ()):
+                args = {}
+                for (param, text), value in zip(components, rest):
+                    if not param:
+                        if value != text:
+                            break
+                    elif value:
+                        args[text] = value
+                    else:
+                        break
+                else:
+                    return (route, args)
+
+            slash = path.rfind('/', 0, slash)
+
+        return None
+
+    def routes(self):
+        return sorted(self.__fixed.keys() +
+                      [route for entries in self.__templates.itervalues()
+                       for components, route in entries])
+
+
+class Request(dict):
+    """Parameters of a request, as handed to the actions.
+
+    As a dictionary it maps every parameter to its first value, or to the
+    list of its values if the action accepts several of them (see
+    WebInterface.registerAction). In addition:
+
+    environ - the WSGI environment
+    method  - the HTTP method
+    path    - PATH_INFO
+    route   - the route which matched path, e.g. "/event/{service}"
+    args    - parameters taken from the path, e.g. {'service': 'geofon'}
+    query   - every parameter to the list of its values
+
+    """
+
+    def __init__(self, environ, route, args, query, multipar=()):
+        dict.__init__(self)
+        self.environ = environ
+        self.method = environ.get('REQUEST_METHOD', 'GET')
+        self.path = environ.get('PATH_INFO', '')
+        self.route = route
+        self.args = args
+        self.query = query
+
+        for (k, values) in query.iteritems():
+            if k in multipar:
+                self[k] = values
+            else:
+                self[k] = values[0]
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+#
+# First arrivals of phases interpolated in precomputed tables
+#
+# ----------------------------------------------------------------------
+
+
+"""First arrivals of phases interpolated in precomputed tables
+
+Copyright (C) 2016 GEOFON team, Helmholtz-Zentrum Potsdam - Deutsches GeoForschungsZentrum GFZ
+
+Time windows relative to events only need the first arrival of a few sets
+of phases ("families", see firstArrivals()), which depend on the distance
+between event and station and on the depth of the event. Calling
+TravelTimeTable.compute() for every station is much more than that.
+
+A TravelTimeGrid computes once the first arrivals of every family at the
+nodes of a (depth, distance) grid and then gives them at any point by
+bilinear interpolation between the four nodes around it. Many points are
+interpolated in one call, with array operations if NumPy is available and
+in pure Python otherwise.
+
+Points outside the grid, or next to a node where the family does not arrive
+(e.g. PKP closer than ~110 degrees), get None: the caller must compute them
+exactly. The elevation of the station is not taken into account. validate()
+tells how far the interpolated arrivals are from the ones of compute().
+
+
+This program is free software; you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 2, or (at your option) any later
+version. For more information, see http://www.gnu.org/
+
+"""
+
+import bisect
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Families of phases. The list of phases P and S has been provided by
+# Joachim per email on 14.08.2013. Beyond PKP_DISTANCE degrees PKP arrives
+# earlier than P and friends.
+FAMILIES = ('P', 'S', 'PKP')
+P_PHASES = ('P', 'Pg', 'Pb', 'Pn', 'Pdif', 'Pdiff')
+S_PHASES = ('S', 'Sg', 'Sb', 'Sn', 'Sdif', 'Sdiff')
+PKP_DISTANCE = 120
+
+# Nodes of the grid: distances in degrees and depths in km. Depths are
+# closer near the surface, where most events are.
+DISTANCE_STEP = 1.0
+DEPTHS = (0, 5, 10, 15, 20, 25, 30, 35, 40, 50, 60, 70, 80, 100, 120, 150,
+          200, 250, 300, 350, 400, 450, 500, 550, 600, 650, 700, 750, 800)
+
+
+def family(ttphase):
+    """Family of a phase returned by compute(), or None."""
+
+    if ttphase in P_PHASES:
+        return 'P'
+
+    if ttphase in S_PHASES or ttphase.startswith('SKS'):
+        return 'S'
+
+    if ttphase.startswith('PKP') or ttphase.startswith('PKiKP'):
+        return 'PKP'
+
+    return None
+
+
+def firstArrivals(ttlist):
+    """First arrival of every family in the output of compute().
+
+    Assumption here is that compute() returns phases sorted by time.
+    Returns a dictionary family -> seconds after the origin time. Families
+    which do not arrive are missing. 'OT' (the origin time, 0) is present
+    if compute() returned any phase.
+
+    """
+
+    arrivals = {}
+    for tt in ttlist:
+        arrivals.setdefault('OT', 0)
+
+        fam = family(tt.phase)
+        if fam is not None and fam not in arrivals:
+            arrivals[fam] = tt.time
+
+    return arrivals
+
+
+class TravelTimeGrid(object):
+    """First arrivals of FAMILIES at the nodes of a (depth, distance) grid,
+    computed with ttt (a seiscomp3.Seismology.TravelTimeTable).
+
+    """
+
+    def __init__(self, ttt, step=DISTANCE_STEP, depths=DEPTHS):
+        self.step = float(step)
+        self.distances = [i * self.step
+                          for i in xrange(int(math.ceil(180.0 / self.step))
+                                          + 1)]
+        self.depths = [float(z) for z in depths]
+
+        # family -> one row per depth, one column per distance
+        rows = dict((fam, []) for fam in FAMILIES)
+        for z in self.depths:
+            row = dict((fam, []) for fam in FAMILIES)
+            for d in self.distances:
+                try:
+                    arrivals = firstArrivals(ttt.compute(0.0, 0.0, z,
+                                                         0.0, d, 0.0))
+                except Exception:
+                    arrivals = {}
+
+                for fam in FAMILIES:
+                    row[fam].append(arrivals.get(fam))
+
+            for fam in FAMILIES:
+                rows[fam].append(row[fam])
+
+        if numpy is not None:
+            self.tables = dict((fam, numpy.array(rows[fam], dtype=float))
+                               for fam in FAMILIES)
+        else:
+            self.tables = rows
+
+    def lookup(self, fam, deltas, depths):
+        """Interpolated first arrivals of a family.
+
+        deltas and depths are sequences of distances (degrees) and depths
+        (km) of the same length. Returns a list with the arrival in seconds
+        at every point, or None where it cannot be interpolated.
+
+        """
+
+        if numpy is not None:
+            return self.__lookup_numpy(self.tables[fam], deltas, depths)
+
+        return self.__lookup_python(self.tables[fam], deltas, depths)
+
+    def __lookup_numpy(self, table, deltas, depths):
+        d = numpy.asarray(deltas, dtype=float)
+        z = numpy.asarray(depths, dtype=float)
+        nodes = numpy.asarray(self.depths)
+
+        inside = (d >= 0) & (d <= self.distances[-1]) & \
+            (z >= nodes[0]) & (z <= nodes[-1])
+
+        j = numpy.clip(numpy.floor(d / self.step).astype(int), 0,
+                       len(self.distances) - 2)
+        i = numpy.clip(numpy.searchsorted(nodes, z, 'right') - 1, 0,
+                       len(nodes) - 2)
+        v = d / self.step - j
+        u = (z - nodes[i]) / (nodes[i + 1] - nodes[i])
+
+        # NaN at a corner gives NaN
+        t = (1 - u) * ((1 - v) * table[i, j] + v * table[i, j + 1]) + \
+            u * ((1 - v) * table[i + 1, j] + v * table[i + 1, j + 1])
+        t[~inside] = numpy.nan
+
+        return [None if math.isnan(x) else x for x in t.tolist()]
+
+    def __lookup_python(self, table, deltas, depths):
+        nodes = self.depths
+        last = len(self.distances) - 2
+
+        result = []
+        for d, z in zip(deltas, depths):
+            if not (0 <= d <= self.distances[-1] and
+                    nodes[0] <= z <= nodes[-1]):
+                result.append(None)
+                continue
+
+            j = min(int(d / self.step), last)
+            i = min(bisect.bisect_right(nodes, z) - 1, len(nodes) - 2)
+            v = d / self.step - j
+            u = (z - nodes[i]) / (nodes[i + 1] - nodes[i])
+
+            corners = (table[i][j], table[i][j + 1],
+                       table[i + 1][j], table[i + 1][j + 1])
+            if None in corners:
+                result.append(None)
+                continue
+
+            (t00, t01, t10, t11) = corners
+            result.append((1 - u) * ((1 - v) * t00 + v * t01) +
+                          u * ((1 - v) * t10 + v * t11))
+
+        return result
+
+    def arrivals(self, deltas, depths):
+        """Interpolated first arrivals of all the families.
+
+        Returns a list with one dictionary per point, as firstArrivals().
+
+        """
+
+        result = [{'OT': 0} for d in deltas]
+        for fam in FAMILIES:
+            for arrivals, t in zip(result, self.lookup(fam, deltas, depths)):
+                if t is not None:
+                    arrivals[fam] = t
+
+        return result
+
+    def validate(self, ttt, points, exact=None):
+        """Compare the interpolated first arrivals with those of compute().
+
+        points is a list of (ev_lat, ev_lon, ev_dep, st_lat, st_lon, st_alt,
+        delta). exact, if given, has the output of firstArrivals() for
+        every point, otherwise compute() is called. Returns a dictionary
+        family -> (number of points compared, maximum difference in
+        seconds).
+
+        """
+
+        interpolated = self.arrivals([p[6] for p in points],
+                                     [p[2] for p in points])
+
+        result = dict((fam, (0, 0.0)) for fam in FAMILIES)
+        for k, point in enumerate(points):
+            if exact is not None:
+                arrivals = exact[k]
+            else:
+                arrivals = firstArrivals(ttt.compute(*point[:6]))
+
+            for fam in FAMILIES:
+                if fam in arrivals and fam in interpolated[k]:
+                    (count, maxdiff) = result[fam]
+                    diff = abs(interpolated[k][fam] - arrivals[fam])
+                    result[fam] = (count + 1, max(maxdiff, diff))
+
+        return result
@@ -27,7 +27,6 @@ version. For more information, see http://www.gnu.org/
 import os
 import glob
 import imp
-import cgi
 import sys
 
 # JSON (since Python 2.6)
@@ -39,16 +38,20 @@ import seiscomp3.Config
 import seiscomp3.Logging
 
 from seiscomp import logs
+import wsgicomm
 from wsgicomm import *
 from inventorycache import InventoryCache
+from router import Router, Request
+from formdata import parseParameters, BodyTooLarge
 
 # Verbosity level a la SeisComP logging.level: 1=ERROR, ... 4=DEBUG
 # (global parameters, settable in wsgi file)
 verbosity = 3
 syslog_facility = 'local0'
 
-# Maximum size of POST data, in bytes? Or roubles?
-cgi.maxlen = 1000000
+# Maximum size of POST data, in bytes, for actions which do not set their
+# own (see registerAction)
+maxlen = 1000000
 
 ##################################################################
 
@@ -77,12 +80,21 @@ class WebInterface(object):
         self.__cfg = seiscomp3.Config.Config()
         env.initConfig(self.__cfg, appName, env.CS_FIRST, env.CS_LAST, True)
 
+        self.__router = Router()
         self.__action_table = {}
+        self.__validator_table = {}
         self.__modules = {}
 
         # Common config variables
         self.server_folder = self.getConfigString('SERVER_FOLDER', None)
 
+        # Compression of responses (see wsgicomm)
+        if self.getConfigBool('compression', True):
+            wsgicomm.COMPRESS_MIN = self.getConfigInt('compression.minsize',
+                                                      wsgicomm.COMPRESS_MIN)
+        else:
+            wsgicomm.COMPRESS_MIN = -1
+
         if not self.server_folder:
             err="%s: Cannot find server root, configuration not loaded" % (appName)
             raise Exception(err)
@@ -140,12 +152,51 @@ class WebInterface(object):
 
         self.__modules[modname] = mod.WI_Module(self)
 
-    def registerAction(self, name, func, *multipar):
-        self.__action_table[name] = (func, set(multipar))
+    def registerAction(self, name, func, *multipar, **options):
+        """Register an action under a route (see router.Router), e.g.
+        "/metadata/networks" or "/event/{service}".
+
+        func(environ, parameters) is called with a router.Request.
+        Parameters listed in multipar get all their values, the others
+        only the first one. Options:
+
+        maxsize - longest body of a request in bytes (default: maxlen)
+        uploads - names of the fields which may be large, whose values are
+                  formdata.Upload objects
+
+        """
+
+        self.__action_table[name] = (func, set(multipar),
+                                     options.get('maxsize', maxlen),
+                                     tuple(options.get('uploads', ())))
+        self.__router.add(name)
 
     def getAction(self, name):
         return self.__action_table.get(name)
 
+    def route(self, path):
+        """Route of the action handling path and the parameters taken from
+        path, as a tuple, or None.
+
+        """
+
+        return self.__router.match(path)
+
+    def registerValidator(self, name, func):
+        """Register the validators of the responses of an action.
+
+        func(environ, parameters) returns (etag, modified) for the response
+        the action would give (see wsgicomm.validators_headers), without
+        computing it, so that the client can use its own copy if it is
+        still valid.
+
+        """
+
+        self.__validator_table[name] = func
+
+    def getValidator(self, name):
+        return self.__validator_table.get(name)
+
     def getConfigBool(self, name, default):
         try:
             return self.__cfg.getBool(name)
@@ -255,35 +306,29 @@ def application(environ, start_response):
 
     logs.debug('fname: %s' % (fname))
 
-    item = wi.getAction(fname)
-    logs.debug('item: %s' % (str(item)))
+    match = wi.route(fname)
 
     # Among others, this will filter wrong function names,
     # but also the favicon.ico request, for instance.
-    if item is None:
+    if match is None:
        status = '404 Not Found'
        return send_html_response(status, 'Error! ' + status, start_response)
 
-    (action, multipar) = item
-    parameters = {}
+    (route, args) = match
+    (action, multipar, maxsize, uploads) = wi.getAction(route)
+    logs.debug('route: %s %s' % (route, args))
 
     try:
-        form = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ)
+        query = parseParameters(environ, maxsize, uploads)
 
-    except ValueError, e:
-        if str(e) == "Maximum content length exceeded":
-            # Add some user-friendliness (this message triggers an alert box on the client)
-            return send_plain_response("400 Bad Request", "maximum request size exceeded", start_response)
+    except BodyTooLarge:
+        # Add some user-friendliness (this message triggers an alert box on the client)
+        return send_plain_response("400 Bad Request", "maximum request size exceeded", start_response)
 
+    except ValueError, e:
         return send_plain_response("400 Bad Request", str(e), start_response)
 
-    if form:
-        for k in form.keys():
-            if k in multipar:
-                parameters[k] = form.getlist(k)
-
-            else:
-                parameters[k] = form.getfirst(k)
+    parameters = Request(environ, route, args, query, multipar)
 
     logs.debug('parameters: %s' % (parameters))
 
@@ -295,6 +340,23 @@ def application(environ, start_response):
     # status = '200 OK'
     # return send_plain_response(status, body, start_response)
 
+    # Responses which the client may have already
+    validator = wi.getValidator(route)
+    headers = []
+    if validator is not None:
+        try:
+            (etag, modified) = validator(environ, parameters)
+
+        except WIError:
+            # The action will report it
+            pass
+
+        else:
+            headers = validators_headers(etag, modified)
+            if not_modified(environ, etag, modified):
+                logs.debug('%s not modified' % fname)
+                return send_not_modified(start_response, headers)
+
     logs.debug('Calling %s' % action)
 
     try:
@@ -314,7 +376,22 @@ def application(environ, start_response):
     if isinstance(res_string, basestring):
         status = '200 OK'
         body = res_string
-        return send_plain_response(status, body, start_response)
+        return send_plain_response(status, body, start_response, environ,
+                                   headers)
+
+    elif isinstance(res_string, (JSONStream, TextStream)):
+        status = '200 OK'
+        body = res_string
+        try:
+            return send_stream_response(status, body, start_response,
+                                        environ, headers)
+
+        except WIError as error:
+            # Raised by the first chunks, read before the response starts;
+            # later, the response is cut short
+            logs.notice('Error page %s: "%s"' % (error.status, error.body))
+            return send_plain_response(error.status, error.body,
+                                       start_response)
 
     elif hasattr(res_string, 'filename'):
         status = '200 OK'
@@ -323,5 +400,6 @@ def application(environ, start_response):
 
     status = '200 OK'
     body = "\n".join(res_string)
-    return send_plain_response(status, body, start_response)
+    return send_plain_response(status, body, start_response, environ,
+                               headers)
 
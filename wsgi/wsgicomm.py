@@ -25,6 +25,19 @@ version. For more information, see http://www.gnu.org/
 
 """
 
+import email.utils
+import itertools
+import json
+import zlib
+
+# Bodies of responses shorter than this (in bytes) are never compressed.
+# A negative value disables compression. Set by the web interface from its
+# configuration.
+COMPRESS_MIN = 1024
+
+# zlib compression level, from 1 (fastest) to 9 (smallest)
+COMPRESS_LEVEL = 6
+
 
 ##################################################################
 #
@@ -117,15 +130,36 @@ def send_html_response(status, body, start_response):
     start_response(status, response_headers)
     return [ body ]
 
-def send_plain_response(status, body, start_response):
+def send_plain_response(status, body, start_response, environ=None,
+                        headers=()):
     """Sends a plain response in WSGI style.
-    
+
+    If environ is given, the body is compressed when the client accepts it
+    (see accepted_encoding) and it is at least COMPRESS_MIN bytes long.
+    Precompressed bodies are compressed only once. headers are added to
+    the response (e.g. those of validators_headers).
+
     Begun by Javier Quinteros <javier@gfz-potsdam.de>, GEOFON team, June 2013
     
     """
 
-    response_headers = [('Content-Type', 'text/plain'),
-                   ('Content-Length', str(len(body)))]
+    response_headers = [('Content-Type', 'text/plain')]
+    response_headers.extend(headers)
+
+    encoding = None
+    if environ is not None and 0 <= COMPRESS_MIN <= len(body):
+        response_headers.append(('Vary', 'Accept-Encoding'))
+        encoding = accepted_encoding(environ)
+
+    if encoding is not None:
+        if isinstance(body, Precompressed):
+            body = body.encoded(encoding)
+        else:
+            body = compress(body, encoding)
+
+        response_headers.append(('Content-Encoding', encoding))
+
+    response_headers.append(('Content-Length', str(len(body))))
     start_response(status, response_headers)
     return [ body ]
 
@@ -141,3 +175,315 @@ def send_file_response(status, body, start_response):
     start_response(status, response_headers)
     return body
 
+def send_stream_response(status, body, start_response, environ=None,
+                         headers=()):
+    """Sends an iterable of strings whose total length is not known in
+    advance, e.g. a JSONStream. Without Content-Length the server sends it
+    in chunks as they are produced.
+
+    If environ is given, the chunks are compressed while they are sent when
+    the client accepts it. The first chunks are read before, and if the
+    body turns out to be shorter than COMPRESS_MIN it is sent as it is.
+
+    Caller must set the content_type attribute of body. headers are added
+    to the response.
+
+    """
+    response_headers = [('Content-Type', body.content_type)]
+    response_headers.extend(headers)
+
+    if environ is None or COMPRESS_MIN < 0:
+        start_response(status, response_headers)
+        return body
+
+    chunks = iter(body)
+    head = []
+    size = 0
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size >= COMPRESS_MIN:
+            break
+
+    else:
+        # The whole body is short
+        return send_plain_response(status, ''.join(head), start_response,
+                                   environ, headers)
+
+    response_headers.append(('Vary', 'Accept-Encoding'))
+    chunks = itertools.chain(head, chunks)
+
+    encoding = accepted_encoding(environ)
+    if encoding is not None:
+        response_headers.append(('Content-Encoding', encoding))
+        chunks = compress_stream(chunks, encoding)
+
+    start_response(status, response_headers)
+    return chunks
+
+
+def send_not_modified(start_response, headers=()):
+    """Tells the client that its copy of the response is still valid."""
+
+    start_response('304 Not Modified', list(headers))
+    return []
+
+
+##################################################################
+#
+# Conditional requests
+#
+##################################################################
+
+def validators_headers(etag, modified=None):
+    """Headers with the validators of a response: etag, a string, and
+    modified, the time (epoch) of its last change or None. The client must
+    check them (with If-None-Match or If-Modified-Since) before using its
+    copy again.
+
+    """
+
+    headers = [('ETag', etag), ('Cache-Control', 'no-cache')]
+    if modified is not None:
+        headers.append(('Last-Modified',
+                        email.utils.formatdate(modified, usegmt=True)))
+
+    return headers
+
+
+def not_modified(environ, etag, modified=None):
+    """Tell whether the copy of the client, as described by the
+    If-None-Match and If-Modified-Since headers in environ, is still valid
+    for a response with validators etag and modified (see
+    validators_headers).
+
+    ETags are compared as weak ones. If-Modified-Since is only checked
+    if there is no If-None-Match.
+
+    """
+
+    def weak(tag):
+        tag = tag.strip()
+        return tag[2:] if tag.startswith('W/') else tag
+
+    match = environ.get('HTTP_IF_NONE_MATCH')
+    if match is not None:
+        return any(tag.strip() == '*' or weak(tag) == weak(etag)
+                   for tag in match.split(','))
+
+    since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if since is not None and modified is not None:
+        parsed = email.utils.parsedate_tz(since)
+        if parsed is not None:
+            return int(modified) <= email.utils.mktime_tz(parsed)
+
+    return False
+
+
+##################################################################
+#
+# Compression of responses
+#
+##################################################################
+
+def accepted_encoding(environ):
+    """Preferred content coding of the client among gzip and deflate,
+    according to its Accept-Encoding header, or None.
+
+    """
+
+    header = environ.get('HTTP_ACCEPT_ENCODING')
+    if not header:
+        return None
+
+    quality = {}
+    for item in header.split(','):
+        params = item.split(';')
+        q = 1.0
+        for param in params[1:]:
+            (name, sep, value) = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+
+        quality[params[0].strip().lower()] = q
+
+    # gzip wins if both have the same quality
+    (best, encoding) = (0.0, None)
+    for name in ('gzip', 'deflate'):
+        q = quality.get(name, quality.get('*', 0.0))
+        if q > best:
+            (best, encoding) = (q, name)
+
+    return encoding
+
+
+def _compressor(encoding):
+    if encoding == 'gzip':
+        return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED,
+                                16 + zlib.MAX_WBITS)
+
+    # "deflate" in HTTP is the zlib format
+    return zlib.compressobj(COMPRESS_LEVEL)
+
+
+def compress(body, encoding):
+    """body compressed with encoding ('gzip' or 'deflate')."""
+
+    compressor = _compressor(encoding)
+    return compressor.compress(body) + compressor.flush()
+
+
+def compress_stream(chunks, encoding):
+    """Compress an iterable of strings while it is consumed."""
+
+    compressor = _compressor(encoding)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
+class Precompressed(str):
+    """A body which is sent many times without changes (e.g. the
+    configuration). It is a string, and it is compressed at most once with
+    every encoding.
+
+    """
+
+    def encoded(self, encoding):
+        """The body compressed with encoding."""
+
+        try:
+            return self.__compressed[encoding]
+
+        except AttributeError:
+            self.__compressed = {}
+
+        except KeyError:
+            pass
+
+        data = self.__compressed[encoding] = compress(self, encoding)
+        return data
+
+
+##################################################################
+#
+# Streamed responses
+#
+##################################################################
+
+class JSONStream(object):
+    """JSON text of a list, produced in chunks while its items are consumed.
+
+    The items of rows are encoded one at a time, so the text of the whole
+    list is never in memory. The output is the same as json.dumps(list(rows),
+    indent=indent, separators=separators, cls=cls). Chunks are about
+    chunksize bytes long.
+
+    If complete is given, it is called with the whole text when the last
+    chunk has been produced, provided that it is at most keep bytes long
+    (e.g. to store it in a cache).
+
+    """
+
+    content_type = 'text/plain'
+
+    def __init__(self, rows, indent=None, separators=None, cls=None,
+                 chunksize=65536, complete=None, keep=0):
+        self.rows = rows
+        self.indent = indent
+        self.separators = separators
+        self.cls = cls
+        self.chunksize = chunksize
+        self.complete = complete
+        self.keep = keep
+
+    def __iter__(self):
+        if self.indent is not None:
+            prefix = ' ' * self.indent
+            (first, sep, last) = ('[\n' + prefix, ', \n' + prefix, '\n]')
+        else:
+            prefix = None
+            (first, sep, last) = ('[', ', ', ']')
+
+        if self.separators is not None:
+            sep = self.separators[0] + sep[2:]
+
+        # Chunks kept for complete, until they are too long
+        kept = [] if self.complete is not None else None
+        keptsize = 0
+
+        pending = []
+        size = 0
+        empty = True
+
+        for row in self.rows:
+            text = json.dumps(row, indent=self.indent,
+                              separators=self.separators, cls=self.cls)
+            if prefix is not None:
+                text = text.replace('\n', '\n' + prefix)
+
+            pending.append(first if empty else sep)
+            pending.append(text)
+            size += len(text)
+            empty = False
+
+            if size >= self.chunksize:
+                chunk = ''.join(pending)
+                (kept, keptsize) = self.__keep(kept, keptsize, chunk)
+                yield chunk
+
+                pending = []
+                size = 0
+
+        chunk = '[]' if empty else ''.join(pending) + last
+        (kept, keptsize) = self.__keep(kept, keptsize, chunk)
+        yield chunk
+
+        if kept is not None:
+            self.complete(''.join(kept))
+
+    def __keep(self, kept, keptsize, chunk):
+        if kept is None:
+            return (None, 0)
+
+        keptsize += len(chunk)
+        if keptsize > self.keep:
+            return (None, 0)
+
+        kept.append(chunk)
+        return (kept, keptsize)
+
+
+
+class TextStream(object):
+    """Text given in parts, e.g. the lines of a table, sent in chunks of
+    about chunksize bytes while the parts are produced.
+
+    """
+
+    def __init__(self, parts, content_type='text/plain', chunksize=65536):
+        self.parts = parts
+        self.content_type = content_type
+        self.chunksize = chunksize
+
+    def __iter__(self):
+        pending = []
+        size = 0
+
+        for part in self.parts:
+            pending.append(part)
+            size += len(part)
+
+            if size >= self.chunksize:
+                yield ''.join(pending)
+                pending = []
+                size = 0
+
+        if pending:
+            yield ''.join(pending)